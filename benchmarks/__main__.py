@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Spatial Media benchmarks
+
+Benchmarks loading, parsing, injecting and saving synthesized MP4 files and
+compares the results against a baseline.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+path = os.path.dirname(sys.modules[__name__].__file__)
+path = os.path.join(path, '..')
+sys.path.insert(0, path)
+from benchmarks import runner
+
+
+def main():
+  """Main function for running the benchmarks."""
+
+  parser = argparse.ArgumentParser(
+      usage=
+      "%(prog)s [options] [scenarios...]\n\nBy default runs all scenarios "
+      "except the large ones and prints their timings in milliseconds.")
+  parser.add_argument(
+      "scenarios",
+      nargs="*",
+      help="scenarios to run, see --list")
+  parser.add_argument(
+      "--list",
+      action="store_true",
+      help="lists the scenarios and their synthesis parameters")
+  parser.add_argument(
+      "--large",
+      action="store_true",
+      help="also runs the scenarios copying gigabytes of (sparse) media data")
+  parser.add_argument(
+      "-n",
+      "--repeat",
+      action="store",
+      type=int,
+      default=3,
+      help="number of repetitions, the best time is reported "
+      "(default: %(default)s)")
+  parser.add_argument(
+      "--work-dir",
+      action="store",
+      default=None,
+      metavar="DIR",
+      help="directory for the synthesized files (default: a temporary "
+      "directory)")
+  parser.add_argument(
+      "-o",
+      "--output",
+      action="store",
+      default=None,
+      metavar="FILE",
+      help="saves the results to FILE, for use as a baseline")
+  parser.add_argument(
+      "-b",
+      "--baseline",
+      action="store",
+      default=None,
+      metavar="FILE",
+      help="compares the results against the baseline FILE and exits with "
+      "status 1 on regressions")
+  parser.add_argument(
+      "--threshold",
+      action="store",
+      type=float,
+      default=0.25,
+      help="allowed relative slowdown of each phase (default: %(default)s)")
+  parser.add_argument(
+      "--rss-threshold",
+      action="store",
+      type=float,
+      default=0.25,
+      help="allowed relative growth of the peak RSS (default: %(default)s)")
+
+  args = parser.parse_args()
+
+  if args.list:
+    for name, parameters in runner.SCENARIOS.items():
+      large = " (large)" if name in runner.LARGE_SCENARIOS else ""
+      print("%s%s: %s" % (name, large, parameters))
+    return 0
+
+  for name in args.scenarios:
+    if name not in runner.SCENARIOS:
+      print("Unknown scenario: %s" % name)
+      return 2
+  names = args.scenarios or [
+      name for name in runner.SCENARIOS
+      if args.large or name not in runner.LARGE_SCENARIOS]
+
+  baseline = None
+  if args.baseline:
+    baseline = runner.load_results(args.baseline)
+
+  def report(name, result):
+    print(runner.format_result(name, result))
+    sys.stdout.flush()
+
+  print(runner.format_header())
+  if args.work_dir:
+    results = runner.run(names, args.work_dir, args.repeat, report)
+  else:
+    with tempfile.TemporaryDirectory() as work_dir:
+      results = runner.run(names, work_dir, args.repeat, report)
+
+  if args.output:
+    runner.save_results(args.output, results)
+
+  if baseline is not None:
+    regressions = runner.compare(results, baseline, args.threshold,
+                                 args.rss_threshold)
+    for regression in regressions:
+      print("Regression: %s" % regression)
+    if regressions:
+      return 1
+    print("No regressions against %s" % args.baseline)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
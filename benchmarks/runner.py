@@ -0,0 +1,240 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Times loading, parsing, injecting and saving synthesized files.
+
+Each scenario is synthesized, then benchmarked in a fresh process so its
+peak resident set size is not affected by other scenarios.
+"""
+
+import collections
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from benchmarks import synthesize
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+
+RESULTS_VERSION = 1
+
+# Timed phases, each reported as the best of all repetitions in seconds.
+PHASES = ["load", "parse", "inject", "save_moov", "save"]
+
+SCENARIOS = collections.OrderedDict([
+    ("moov-first", dict()),
+    ("moov-last", dict(moov_first=False)),
+    ("stco-100k", dict(chunks=100000)),
+    ("stco-100k-moov-last", dict(chunks=100000, moov_first=False)),
+    ("co64-100k", dict(chunks=100000, co64=True)),
+    ("sound-v1", dict(sound_version=1)),
+    ("sound-v2", dict(sound_version=2)),
+    ("aac", dict(audio_codec="mp4a")),
+    ("tracks-16", dict(video_tracks=8, audio_tracks=8, chunks=10000)),
+    ("mdat-1g", dict(mdat_size=1024 ** 3)),
+    ("mdat-5g", dict(mdat_size=5 * 1024 ** 3, moov_first=False)),
+])
+
+# Scenarios copying gigabytes of media data, only run when asked for.
+LARGE_SCENARIOS = frozenset(["mdat-1g", "mdat-5g"])
+
+# Slowdowns smaller than this are treated as noise, in seconds.
+MIN_SIGNIFICANT_TIME = 0.002
+
+
+def quiet_console(contents):
+    pass
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def injected_metadata(parsed_metadata):
+    metadata = metadata_utils.Metadata()
+    metadata.video = metadata_utils.generate_spherical_xml("top-bottom")
+    description = metadata_utils.get_spatial_audio_description(
+        parsed_metadata.num_audio_channels)
+    if description.is_supported:
+        metadata.audio = metadata_utils.get_spatial_audio_metadata(
+            description.order, description.has_head_locked_stereo)
+    return metadata
+
+
+def benchmark_file(path, output_path, repeat):
+    """Times each phase of injecting metadata into a file.
+
+    Returns:
+      dictionary of the best time of each phase and the peak RSS.
+    """
+    timings = collections.defaultdict(list)
+    for _ in range(repeat):
+        with open(path, "rb") as in_fh:
+            start = time.perf_counter()
+            mpeg4_file = mpeg.load(in_fh)
+            timings["load"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            parsed_metadata = metadata_utils.parse_spherical_mpeg4(
+                mpeg4_file, in_fh, quiet_console)
+            timings["parse"].append(time.perf_counter() - start)
+
+            metadata = injected_metadata(parsed_metadata)
+            start = time.perf_counter()
+            metadata_utils.mpeg4_add_metadata(
+                mpeg4_file, in_fh, metadata, quiet_console)
+            timings["inject"].append(time.perf_counter() - start)
+
+            # Saving moov alone isolates rewriting the chunk offset tables.
+            mpeg4_file.resize()
+            start = time.perf_counter()
+            mpeg4_file.moov_box.save(in_fh, io.BytesIO(),
+                                     mpeg4_file.mdat_delta())
+            timings["save_moov"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with open(output_path, "wb") as out_fh:
+                mpeg4_file.save(in_fh, out_fh)
+            timings["save"].append(time.perf_counter() - start)
+        os.remove(output_path)
+
+    result = collections.OrderedDict()
+    for phase in PHASES:
+        result[phase] = min(timings[phase])
+    result["peak_rss"] = peak_rss()
+    return result
+
+
+def run_scenario(name, work_dir, repeat):
+    """Synthesizes and benchmarks a scenario.
+
+    Returns:
+      dictionary, file size, phase timings and peak RSS.
+    """
+    path = os.path.join(work_dir, name + ".mp4")
+    output_path = os.path.join(work_dir, name + ".out.mp4")
+    file_size = synthesize.synthesize(path, **SCENARIOS[name])
+    try:
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(1) as pool:
+            result = pool.apply(benchmark_file, (path, output_path, repeat))
+    finally:
+        os.remove(path)
+    result["file_size"] = file_size
+    return result
+
+
+def run(names, work_dir, repeat=3, report=None):
+    """Benchmarks scenarios.
+
+    Args:
+      names: list of strings, scenario names.
+      work_dir: string, directory for synthesized files.
+      repeat: int, number of repetitions of each scenario.
+      report: function or None, called with the name and result of each
+        scenario once benchmarked.
+
+    Returns:
+      dictionary, results by scenario name.
+    """
+    results = collections.OrderedDict()
+    for name in names:
+        results[name] = run_scenario(name, work_dir, repeat)
+        if report is not None:
+            report(name, results[name])
+    return results
+
+
+def save_results(path, results):
+    with open(path, "w") as out_fh:
+        json.dump({"version": RESULTS_VERSION,
+                   "python": sys.version.split()[0],
+                   "results": results}, out_fh, indent=2)
+
+
+def load_results(path):
+    with open(path) as in_fh:
+        stored = json.load(in_fh)
+    if stored.get("version") != RESULTS_VERSION:
+        raise ValueError("unsupported results version in %s" % path)
+    return stored["results"]
+
+
+def compare(results, baseline, threshold=0.25, rss_threshold=0.25):
+    """Compares results against a baseline.
+
+    Args:
+      results: dictionary, results by scenario name.
+      baseline: dictionary, baseline results by scenario name.
+      threshold: float, allowed relative slowdown of each phase.
+      rss_threshold: float, allowed relative growth of the peak RSS.
+
+    Returns:
+      list of strings, description of each regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        for phase in PHASES:
+            if phase not in base:
+                continue
+            if (result[phase] > base[phase] * (1 + threshold) and
+                    result[phase] - base[phase] > MIN_SIGNIFICANT_TIME):
+                regressions.append(
+                    "%s: %s took %.1f ms, baseline %.1f ms" %
+                    (name, phase, result[phase] * 1000, base[phase] * 1000))
+        if (result["peak_rss"] and base.get("peak_rss") and
+                result["peak_rss"] > base["peak_rss"] * (1 + rss_threshold)):
+            regressions.append(
+                "%s: peak RSS %.1f MB, baseline %.1f MB" %
+                (name, result["peak_rss"] / 2.0 ** 20,
+                 base["peak_rss"] / 2.0 ** 20))
+    return regressions
+
+
+def format_result(name, result):
+    """Returns a table row for the result of a scenario."""
+    row = "%-22s %10.1f" % (name, result["file_size"] / 2.0 ** 20)
+    for phase in PHASES:
+        row += " %9.2f" % (result[phase] * 1000)
+    if result["peak_rss"]:
+        row += " %8.1f" % (result["peak_rss"] / 2.0 ** 20)
+    return row
+
+
+def format_header():
+    """Returns the table header of format_result rows, times are in ms."""
+    header = "%-22s %10s" % ("scenario", "size MB")
+    for phase in PHASES:
+        header += " %9s" % phase
+    header += " %8s" % "RSS MB"
+    return header
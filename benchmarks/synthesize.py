@@ -0,0 +1,232 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Synthesizes MP4/MOV files with controllable structure for benchmarking.
+
+The files have valid box structures and sample tables but no decodable media:
+the mdat payload is a byte pattern, or a hole in a sparse file.
+"""
+
+import struct
+
+# Files with larger mdat boxes are written as sparse files by default.
+SPARSE_MIN_SIZE = 64 * 1024 * 1024
+
+PATTERN = bytes(bytearray(range(256))) * 4096
+
+# AudioSpecificConfig sampling frequency index of 48 kHz.
+AAC_FREQUENCY_INDEX_48000 = 3
+
+AUDIO_CODECS = ["sowt", "mp4a"]
+
+
+def box(name, payload):
+    return struct.pack(">I", 8 + len(payload)) + name + payload
+
+
+def full_box(name, version, flags, payload):
+    return box(name, struct.pack(">I", (version << 24) | flags) + payload)
+
+
+def box_header(name, size):
+    """Returns a box header, 64 bit sized when size does not fit 32 bits."""
+    if size + 8 <= 0xFFFFFFFF:
+        return struct.pack(">I", size + 8) + name
+    return struct.pack(">I", 1) + name + struct.pack(">Q", size + 16)
+
+
+def descriptor(tag, payload):
+    """Returns an MPEG-4 descriptor with a 4 byte length."""
+    length = len(payload)
+    size = bytearray()
+    for shift in (21, 14, 7):
+        size.append(0x80 | ((length >> shift) & 0x7F))
+    size.append(length & 0x7F)
+    return struct.pack(">B", tag) + bytes(size) + payload
+
+
+def visual_sample_entry(width=1920, height=1080):
+    payload = (b"\0" * 6 + struct.pack(">H", 1) + b"\0" * 16 +
+               struct.pack(">HHII", width, height, 0x480000, 0x480000) +
+               b"\0" * 4 + struct.pack(">H", 1) + b"\0" * 32 +
+               struct.pack(">Hh", 24, -1))
+    return box(b"avc1", payload)
+
+
+def sound_sample_entry(codec, version, channels, sample_rate=48000):
+    """Returns a sound sample description of the given version.
+
+    Args:
+      codec: string, "sowt" for PCM or "mp4a" for AAC with an esds box.
+      version: int, 0, 1 or 2, the QuickTime sound description version.
+      channels: int, number of audio channels.
+    """
+    payload = (b"\0" * 6 + struct.pack(">H", 1) +
+               struct.pack(">hhi", version, 0, 0))
+    if version in (0, 1):
+        payload += struct.pack(">hhhhI", channels, 16, 0, 0,
+                               sample_rate << 16)
+        if version == 1:
+            payload += struct.pack(">IIII", 1, 2, 2 * channels, 2)
+    elif version == 2:
+        payload += struct.pack(">hhhhiid", 3, 16, -2, 0, 65536, 72,
+                               float(sample_rate))
+        payload += struct.pack(">iIIIII", channels, 0x7F000000, 16, 0,
+                               2 * channels, 1)
+    else:
+        raise ValueError("unsupported sound sample description version")
+
+    if codec == "mp4a":
+        audio_specific_config = struct.pack(
+            ">H", (2 << 11) | (AAC_FREQUENCY_INDEX_48000 << 7) |
+            (channels << 3))
+        decoder_config = descriptor(
+            4, struct.pack(">BBBHII", 0x40, 0x15, 0, 0, 0, 0) +
+            descriptor(5, audio_specific_config))
+        es_descriptor = descriptor(3, struct.pack(">HB", 1, 0) +
+                                   decoder_config + descriptor(6, b"\2"))
+        payload += full_box(b"esds", 0, 0, es_descriptor)
+        return box(b"mp4a", payload)
+    return box(codec.encode("ascii"), payload)
+
+
+def sample_table(entry, offsets, sample_size, co64):
+    """Returns a stbl box with one sample per chunk at the given offsets."""
+    count = len(offsets)
+    stsd = full_box(b"stsd", 0, 0, struct.pack(">I", 1) + entry)
+    stts = full_box(b"stts", 0, 0, struct.pack(">III", 1, count, 1000))
+    stsc = full_box(b"stsc", 0, 0, struct.pack(">IIII", 1, 1, 1, 1))
+    stsz = full_box(b"stsz", 0, 0, struct.pack(">II", sample_size, count))
+    if co64:
+        chunk_offsets = full_box(b"co64", 0, 0, struct.pack(
+            ">I%dQ" % count, count, *offsets))
+    else:
+        chunk_offsets = full_box(b"stco", 0, 0, struct.pack(
+            ">I%dI" % count, count, *offsets))
+    return box(b"stbl", stsd + stts + stsc + stsz + chunk_offsets)
+
+
+def track(track_id, handler, entry, offsets, sample_size, co64):
+    duration = len(offsets) * 1000
+    tkhd = full_box(b"tkhd", 0, 7, struct.pack(
+        ">IIIII", 0, 0, track_id, 0, duration) + b"\0" * 8 +
+        struct.pack(">hhhh", 0, 0, 0x100, 0) +
+        struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000) +
+        struct.pack(">II", 1920 << 16, 1080 << 16))
+    mdhd = full_box(b"mdhd", 0, 0, struct.pack(
+        ">IIIIHH", 0, 0, 1000, duration, 0x55C4, 0))
+    hdlr = full_box(b"hdlr", 0, 0, b"\0" * 4 + handler + b"\0" * 12 +
+                    b"synthesized\0")
+    minf = box(b"minf", box(b"dinf", b"") +
+               sample_table(entry, offsets, sample_size, co64))
+    return box(b"trak", tkhd + box(b"mdia", mdhd + hdlr + minf))
+
+
+def movie(payload_start, video_tracks, audio_tracks, chunks, co64,
+          mdat_size, audio_codec, sound_version, channels):
+    """Returns a moov box whose chunks are interleaved across the mdat."""
+    tracks = video_tracks + audio_tracks
+    total_chunks = max(1, tracks * chunks)
+    sample_size = max(1, mdat_size // total_chunks)
+
+    traks = b""
+    for index in range(tracks):
+        offsets = [payload_start + (chunk * tracks + index) * sample_size
+                   for chunk in range(chunks)]
+        if index < video_tracks:
+            traks += track(index + 1, b"vide", visual_sample_entry(),
+                           offsets, sample_size, co64)
+        else:
+            entry = sound_sample_entry(audio_codec, sound_version, channels)
+            traks += track(index + 1, b"soun", entry, offsets, sample_size,
+                           co64)
+
+    mvhd = full_box(b"mvhd", 0, 0, struct.pack(
+        ">IIII", 0, 0, 1000, chunks * 1000) + struct.pack(">IH", 0x10000,
+        0x100) + b"\0" * 10 + struct.pack(
+        ">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000) +
+        b"\0" * 24 + struct.pack(">I", tracks + 1))
+    return box(b"moov", mvhd + traks)
+
+
+def write_payload(out_fh, size, sparse):
+    if sparse:
+        out_fh.seek(size, 1)
+        out_fh.truncate()
+        return
+    while size > 0:
+        chunk = PATTERN[:min(size, len(PATTERN))]
+        out_fh.write(chunk)
+        size -= len(chunk)
+
+
+def synthesize(path, video_tracks=1, audio_tracks=1, chunks=1000, co64=None,
+               moov_first=True, audio_codec="sowt", sound_version=0,
+               channels=4, mdat_size=16 * 1024 * 1024, sparse=None):
+    """Writes a synthetic MP4 file.
+
+    Args:
+      path: string, output file.
+      video_tracks: int, number of video tracks.
+      audio_tracks: int, number of audio tracks.
+      chunks: int, number of chunk offset entries in each track.
+      co64: bool or None, use co64 instead of stco boxes. None selects co64
+        only when offsets do not fit 32 bits.
+      moov_first: bool, write moov before mdat rather than after it.
+      audio_codec: string, one of AUDIO_CODECS.
+      sound_version: int, version of the sound sample descriptions.
+      channels: int, number of channels of the audio tracks.
+      mdat_size: int, size of the mdat payload.
+      sparse: bool or None, leave the payload as a hole in a sparse file.
+        None selects sparse files for payloads of SPARSE_MIN_SIZE or more.
+
+    Returns:
+      int, size of the written file.
+    """
+    if audio_codec not in AUDIO_CODECS:
+        raise ValueError("unsupported audio codec: %s" % audio_codec)
+    if sparse is None:
+        sparse = mdat_size >= SPARSE_MIN_SIZE
+
+    ftyp = box(b"ftyp", b"isom\0\0\0\0isommp41")
+    mdat_header = box_header(b"mdat", mdat_size)
+
+    def build(payload_start, use_co64, size):
+        return movie(payload_start, video_tracks, audio_tracks, chunks,
+                     use_co64, size, audio_codec, sound_version, channels)
+
+    def payload_position(use_co64):
+        # The size of moov does not depend on the chunk offsets.
+        if moov_first:
+            return len(ftyp) + len(build(0, use_co64, 0)) + len(mdat_header)
+        return len(ftyp) + len(mdat_header)
+
+    if payload_position(bool(co64)) + mdat_size > 0xFFFFFFFF and not co64:
+        if co64 is not None:
+            raise ValueError("chunk offsets do not fit stco boxes")
+        co64 = True
+    moov = build(payload_position(bool(co64)), bool(co64), mdat_size)
+
+    with open(path, "wb") as out_fh:
+        out_fh.write(ftyp)
+        if moov_first:
+            out_fh.write(moov)
+        out_fh.write(mdat_header)
+        write_payload(out_fh, mdat_size, sparse)
+        if not moov_first:
+            out_fh.write(moov)
+        return out_fh.tell()
@@ -20,7 +20,11 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-__all__ = ["metadata_utils", "mpeg"]
+__all__ = ["batch", "metadata_async", "metadata_cache", "metadata_utils",
+           "mpeg"]
 
+import spatialmedia.batch
+import spatialmedia.metadata_async
+import spatialmedia.metadata_cache
 import spatialmedia.metadata_utils
 import spatialmedia.mpeg
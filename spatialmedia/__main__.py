@@ -27,13 +27,48 @@ import sys
 path = os.path.dirname(sys.modules[__name__].__file__)
 path = os.path.join(path, '..')
 sys.path.insert(0, path)
+from spatialmedia import batch
+from spatialmedia import metadata_cache
 from spatialmedia import metadata_utils
+from spatialmedia import mpeg
 
 
 def console(contents):
   print(contents)
 
 
+def stderr_console(contents):
+  sys.stderr.write("%s\n" % contents)
+
+
+def inject_stream(args, metadata):
+  """Injects metadata when the input or output file is "-" (stdin/stdout).
+
+  Messages go to stderr so they cannot mix with the output stream.
+  """
+  if args.in_place:
+    stderr_console("--in-place cannot be combined with streaming.")
+    return
+
+  stdin = getattr(sys.stdin, "buffer", sys.stdin)
+  stdout = getattr(sys.stdout, "buffer", sys.stdout)
+  in_stream = stdin if args.file[0] == "-" else open(args.file[0], "rb")
+  out_stream = stdout if args.file[1] == "-" else open(args.file[1], "wb")
+
+  # Errors printed while processing must not end up in the output stream.
+  text_stdout = sys.stdout
+  sys.stdout = sys.stderr
+  try:
+    metadata_utils.inject_mpeg4_stream(
+        in_stream, out_stream, metadata, stderr_console, args.spatial_audio,
+        args.faststart, args.padding)
+  finally:
+    sys.stdout = text_stdout
+    for stream in (in_stream, out_stream):
+      if stream is not stdin and stream is not stdout:
+        stream.close()
+
+
 def main():
   """Main function for printing and injecting spatial media metadata."""
 
@@ -47,7 +82,111 @@ def main():
       action="store_true",
       help=
       "injects spatial media metadata into the first file specified (.mp4 or "
-      ".mov) and saves the result to the second file specified")
+      ".mov) and saves the result to the second file specified. Either file "
+      "may be - to stream from stdin or to stdout")
+  parser.add_argument(
+      "--probe",
+      action="store_true",
+      help=
+      "when printing metadata, reads only the top level box headers and the "
+      "moov box of each file")
+  parser.add_argument(
+      "--in-place",
+      action="store_true",
+      help=
+      "with --inject, injects metadata into the single file specified by "
+      "rewriting only its moov box, leaving the media data untouched")
+  parser.add_argument(
+      "--faststart",
+      action="store_true",
+      help=
+      "with --inject, saves the moov box in front of the media data so "
+      "playback can start before the whole file is downloaded")
+  parser.add_argument(
+      "--padding",
+      action="store",
+      type=int,
+      default=None,
+      metavar="BYTES",
+      help=
+      "with --inject, reserves a free box of BYTES bytes after the moov box "
+      "so later injections can be done with --in-place")
+  parser.add_argument(
+      "--json",
+      action="store_true",
+      help=
+      "when printing metadata, prints one JSON line per file with the "
+      "spherical metadata, stereo mode, crop, spatial audio metadata, number "
+      "of audio channels, duration, resolution and errors")
+  parser.add_argument(
+      "-j",
+      "--jobs",
+      action="store",
+      type=int,
+      default=None,
+      metavar="N",
+      help=
+      "when printing metadata or with --manifest, processes files in N "
+      "processes. When printing metadata, implies --json and results are "
+      "printed in the order the files were given")
+  parser.add_argument(
+      "-r",
+      "--recursive",
+      action="store_true",
+      help=
+      "when printing metadata, includes the .mp4 and .mov files found in "
+      "directories and their subdirectories. Implies --json")
+  parser.add_argument(
+      "-m",
+      "--manifest",
+      action="store",
+      default=None,
+      metavar="FILE",
+      help=
+      "injects metadata into the files listed in FILE, a CSV (with a header "
+      "row) or JSON lines file with the fields input, output, stereo, crop, "
+      "metadata_version, projection, spatial_audio, faststart and padding. "
+      "Prints one JSON line per file; "
+      "rerunning resumes an interrupted run")
+  parser.add_argument(
+      "--journal",
+      action="store",
+      default=None,
+      metavar="FILE",
+      help="with --manifest, journal of completed files (default: "
+      "<manifest>.journal)")
+  parser.add_argument(
+      "--per-device",
+      action="store",
+      type=int,
+      default=batch.DEFAULT_PER_DEVICE,
+      metavar="N",
+      help=
+      "with --manifest, maximum number of files injected at once that use "
+      "the same device (default: %(default)s)")
+  parser.add_argument(
+      "--trace",
+      action="store",
+      default=None,
+      metavar="FILE",
+      help=
+      "writes timing and I/O statistics of each loading, parsing, injection "
+      "and saving phase to FILE as JSON lines")
+  parser.add_argument(
+      "--cache-dir",
+      action="store",
+      default=None,
+      metavar="DIR",
+      help=
+      "caches parsed files in DIR so printing the metadata of unchanged files "
+      "does not read them again")
+  parser.add_argument(
+      "--cache-size",
+      action="store",
+      type=int,
+      default=metadata_cache.DEFAULT_MAX_SIZE,
+      metavar="BYTES",
+      help="with --cache-dir, maximum size of the cache (default: %(default)s)")
   video_group = parser.add_argument_group("Spherical Video")
   video_group.add_argument("-s",
                            "--stereo",
@@ -67,6 +206,22 @@ def main():
       " where w=CroppedAreaImageWidthPixels h=CroppedAreaImageHeightPixels "
       "f_w=FullPanoWidthPixels f_h=FullPanoHeightPixels "
       "x=CroppedAreaLeftPixels y=CroppedAreaTopPixels")
+  video_group.add_argument(
+      "--metadata-version",
+      action="store",
+      choices=metadata_utils.METADATA_VERSIONS,
+      default="1",
+      help=
+      "spherical video metadata to inject: the version 1 uuid box, the "
+      "version 2 st3d and sv3d boxes or both (default: %(default)s)")
+  video_group.add_argument(
+      "--projection",
+      action="store",
+      choices=metadata_utils.PROJECTIONS,
+      default="equirectangular",
+      help=
+      "projection (equirectangular | cubemap). cubemap requires "
+      "--metadata-version 2")
   audio_group = parser.add_argument_group("Spatial Audio")
   audio_group.add_argument(
       "-a",
@@ -75,18 +230,57 @@ def main():
       help=
       "spatial audio. First-order periphonic ambisonics with ACN channel "
       "ordering and SN3D normalization")
-  parser.add_argument("file", nargs="+", help="input/output files")
+  parser.add_argument("file", nargs="*", help="input/output files")
 
   args = parser.parse_args()
 
+  if args.trace:
+    with open(args.trace, "a") as trace_fh:
+      mpeg.instrumentation.set_sink(
+          mpeg.instrumentation.JsonLinesSink(trace_fh))
+      try:
+        run(args, parser)
+      finally:
+        mpeg.instrumentation.set_sink(None)
+    return
+
+  run(args, parser)
+
+
+def run(args, parser):
+  """Prints or injects metadata as selected by the parsed arguments."""
+  if args.cache_dir:
+    metadata_cache.set_default_cache(
+        metadata_cache.MetadataCache(args.cache_dir, args.cache_size))
+
+  if args.manifest:
+    batch.inject_manifest(args.manifest, sys.stdout, args.jobs or 1,
+                          args.journal, args.per_device)
+    return
+
   if args.inject:
-    if len(args.file) != 2:
+    if args.in_place:
+      if args.faststart:
+        console("--faststart cannot be combined with --in-place.")
+        return
+      if len(args.file) != 1:
+        console("Injecting metadata in place requires a single file.")
+        return
+    elif len(args.file) != 2:
       console("Injecting metadata requires both an input file and output file.")
       return
 
     metadata = metadata_utils.Metadata()
-    metadata.video = metadata_utils.generate_spherical_xml(args.stereo_mode,
-                                                           args.crop)
+    generated = metadata_utils.generate_metadata(
+        metadata, args.stereo_mode, args.crop, args.metadata_version,
+        args.projection)
+
+    if "-" in args.file:
+      if generated:
+        inject_stream(args, metadata)
+      else:
+        stderr_console("Failed to generate metadata.")
+      return
 
     if args.spatial_audio:
       parsed_metadata = metadata_utils.parse_metadata(args.file[0], console)
@@ -102,13 +296,19 @@ def main():
                   "spatial audio format." % (parsed_metadata.num_audio_channels))
           return
 
-    if metadata.video:
-      metadata_utils.inject_metadata(args.file[0], args.file[1], metadata,
-                                     console)
+    if generated:
+      metadata_utils.inject_metadata(args.file[0], args.file[-1], metadata,
+                                     console, args.in_place,
+                                     args.faststart, args.padding)
     else:
       console("Failed to generate metadata.")
     return
 
+  if args.json or args.jobs is not None or args.recursive:
+    batch.scan(args.file, sys.stdout, args.jobs or 1, args.recursive,
+               args.probe)
+    return
+
   if len(args.file) > 0:
     for input_file in args.file:
       if args.spatial_audio:
@@ -116,7 +316,7 @@ def main():
         metadata.audio = metadata_utils.get_spatial_audio_description(
             parsed_metadata.num_channels)
 
-      metadata_utils.parse_metadata(input_file, console)
+      metadata_utils.parse_metadata(input_file, console, args.probe)
     return
 
   parser.print_help()
@@ -0,0 +1,497 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batch processing of spatial media metadata over many files.
+
+Files are processed in a pool of worker processes and the results are
+reported as JSON lines. Scans report files in the order they were given,
+manifest injections report files as they complete and journal them so an
+interrupted run can be resumed.
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import io
+import json
+import os
+
+from spatialmedia import metadata_cache
+from spatialmedia import metadata_utils
+
+# Number of submitted files per worker that have not been reported yet.
+IN_FLIGHT_PER_JOB = 4
+
+# Number of files injected at once using the same device for input or output.
+DEFAULT_PER_DEVICE = 2
+
+JOURNAL_SUFFIX = ".journal"
+PARTIAL_SUFFIX = ".partial"
+
+STEREO_MODES = ["none", "top-bottom", "left-right"]
+
+CROP_TAGS = ["CroppedAreaImageWidthPixels",
+             "CroppedAreaImageHeightPixels",
+             "FullPanoWidthPixels",
+             "FullPanoHeightPixels",
+             "CroppedAreaLeftPixels",
+             "CroppedAreaTopPixels"]
+
+
+def find_files(paths, recursive=False):
+    """Yields the files to process, walking directories in sorted order.
+
+    Args:
+      paths: list of strings, files and directories.
+      recursive: bool, include MP4/MOV files found below directories.
+        Otherwise directories are yielded as given and reported as errors.
+    """
+    for path in paths:
+        if not recursive or not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                extension = os.path.splitext(name)[1].lower()
+                if extension in metadata_utils.MPEG_FILE_EXTENSIONS:
+                    yield os.path.join(root, name)
+
+
+def crop_string(video):
+    """Returns the crop of parsed spherical metadata as "w:h:f_w:f_h:x:y"."""
+    if not all(tag in video for tag in CROP_TAGS):
+        return None
+    return ":".join(video[tag] for tag in CROP_TAGS)
+
+
+def metadata_record(path, parsed_metadata, messages):
+    """Returns the JSON serializable result of parsing a file.
+
+    Args:
+      path: string, parsed file.
+      parsed_metadata: metadata_utils.ParsedMetadata or None.
+      messages: list of strings, messages printed while parsing.
+    """
+    record = collections.OrderedDict()
+    record["file"] = path
+    record["spherical"] = collections.OrderedDict()
+    record["spherical_v2"] = collections.OrderedDict()
+    record["stereo_mode"] = None
+    record["crop"] = None
+    record["spatial_audio"] = None
+    record["num_audio_channels"] = 0
+    record["duration"] = None
+    record["width"] = None
+    record["height"] = None
+    record["errors"] = [message for message in messages
+                        if "Error" in message]
+
+    if parsed_metadata is None:
+        if not record["errors"]:
+            record["errors"].append(
+                messages[-1] if messages else "File could not be parsed.")
+        return record
+
+    for track_name in sorted(parsed_metadata.video):
+        video = parsed_metadata.video[track_name] or dict()
+        record["spherical"][track_name] = video
+        if record["stereo_mode"] is None and "StereoMode" in video:
+            record["stereo_mode"] = video["StereoMode"]
+        if record["crop"] is None:
+            record["crop"] = crop_string(video)
+
+    for track_name in sorted(parsed_metadata.video_v2):
+        video_v2 = parsed_metadata.video_v2[track_name]
+        record["spherical_v2"][track_name] = video_v2
+        if record["stereo_mode"] is None and "StereoMode" in video_v2:
+            record["stereo_mode"] = video_v2["StereoMode"]
+
+    audio = parsed_metadata.audio
+    if audio is not None:
+        record["spatial_audio"] = collections.OrderedDict([
+            ("ambisonic_type", audio.ambisonic_type_name()),
+            ("head_locked_stereo", audio.head_locked_stereo),
+            ("ambisonic_order", audio.ambisonic_order),
+            ("ambisonic_channel_ordering",
+             audio.ambisonic_channel_ordering_name()),
+            ("ambisonic_normalization", audio.ambisonic_normalization_name()),
+            ("num_channels", audio.num_channels),
+            ("channel_map", list(audio.channel_map)),
+        ])
+    record["num_audio_channels"] = parsed_metadata.num_audio_channels
+    record["duration"] = parsed_metadata.duration
+    record["width"] = parsed_metadata.width
+    record["height"] = parsed_metadata.height
+    return record
+
+
+def scan_file(path, probe=False):
+    """Parses the metadata of a file.
+
+    Messages printed by the mpeg module are captured instead of being written
+    to stdout.
+
+    Returns:
+      dictionary, see metadata_record.
+    """
+    messages = []
+    printed = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(printed):
+            parsed_metadata = metadata_utils.parse_metadata(
+                path, messages.append, probe)
+    except Exception as e:
+        parsed_metadata = None
+        messages.append("Error: %s" % e)
+    messages.extend(printed.getvalue().splitlines())
+    return metadata_record(os.path.abspath(path), parsed_metadata, messages)
+
+
+def run_ordered(function, items, jobs, initializer=None, initargs=()):
+    """Yields function(*item) for all items, in order.
+
+    Args:
+      function: picklable function run in worker processes.
+      items: iterable of argument tuples, consumed as work is submitted.
+      jobs: int, number of worker processes, or 1 to run in this process.
+      initializer, initargs: run in each worker process before any work.
+    """
+    if jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield function(*item)
+        return
+
+    max_in_flight = jobs * IN_FLIGHT_PER_JOB
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=initializer, initargs=initargs) as executor:
+        for item in items:
+            pending.append(executor.submit(function, *item))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def scan(paths, output, jobs=1, recursive=False, probe=False):
+    """Writes one JSON line with the metadata of each file to output.
+
+    Args:
+      paths: list of strings, files and directories to scan.
+      output: text file, receives the JSON lines.
+      jobs: int, number of worker processes.
+      recursive: bool, scan MP4/MOV files below directories.
+      probe: bool, read only the top level box headers and the moov box.
+
+    Returns:
+      int, number of files with errors.
+    """
+    items = ((path, probe) for path in find_files(paths, recursive))
+    failures = 0
+    for record in run_ordered(scan_file, items, jobs,
+                              metadata_cache.set_default_cache,
+                              (metadata_cache.default_cache,)):
+        if record["errors"]:
+            failures += 1
+        output.write(json.dumps(record) + "\n")
+        output.flush()
+    return failures
+
+
+def read_manifest(path):
+    """Reads the rows of an injection manifest.
+
+    Manifests are CSV files with a header row, or JSON lines files when named
+    .jsonl or .json. Rows have the fields input, output, stereo, crop,
+    metadata_version, projection, spatial_audio, faststart and padding; all
+    but input are optional. An empty output injects in place. Relative paths
+    are resolved against the directory of the manifest.
+
+    Returns:
+      list of dictionaries.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline="") as manifest_fh:
+        if extension in [".jsonl", ".json"]:
+            rows = [json.loads(line) for line in manifest_fh if line.strip()]
+        else:
+            rows = list(csv.DictReader(manifest_fh))
+
+    base = os.path.dirname(os.path.abspath(path))
+    manifest = []
+    for row in rows:
+        row = dict((key.strip(), value) for key, value in row.items()
+                   if key is not None)
+        for key, value in row.items():
+            if isinstance(value, str):
+                value = value.strip()
+            row[key] = None if value == "" else value
+        row["input"] = os.path.join(base, row.get("input") or "")
+        if row.get("output"):
+            row["output"] = os.path.join(base, row["output"])
+        else:
+            row["output"] = None
+        manifest.append(row)
+    return manifest
+
+
+def read_journal(path):
+    """Returns the (row, input, output) of rows completed by earlier runs."""
+    done = set()
+    try:
+        journal_fh = open(path)
+    except IOError:
+        return done
+    with journal_fh:
+        for line in journal_fh:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line of a crashed run may be incomplete.
+                continue
+            if entry.get("status") == "done":
+                done.add((entry["row"], entry["input"], entry["output"]))
+    return done
+
+
+def parse_flag(value):
+    return str(value).lower() in ["true", "yes", "1"]
+
+
+def spatial_audio_order(value):
+    """Returns the ambisonic order requested by a manifest spatial_audio field.
+
+    Returns:
+      0 for no spatial audio, None to derive the order from the audio track,
+      or the order.
+    """
+    value = str(value).lower()
+    if value in ["none", "false", "no", "0"]:
+        return 0
+    if value in ["true", "yes", "auto"]:
+        return None
+    if value.isdigit():
+        return int(value)
+    raise ValueError("invalid spatial_audio value: %s" % value)
+
+
+def row_metadata(row, console):
+    """Returns the metadata_utils.Metadata to inject for a manifest row."""
+    stereo = row.get("stereo") or "none"
+    if stereo not in STEREO_MODES:
+        console("Error invalid stereo mode: %s" % stereo)
+        return None
+
+    version = str(row.get("metadata_version") or "1")
+    if version not in metadata_utils.METADATA_VERSIONS:
+        console("Error invalid metadata version: %s" % version)
+        return None
+    projection = row.get("projection") or "equirectangular"
+    if projection not in metadata_utils.PROJECTIONS:
+        console("Error invalid projection: %s" % projection)
+        return None
+
+    metadata = metadata_utils.Metadata()
+    if not metadata_utils.generate_metadata(
+            metadata, stereo, row.get("crop"), version, projection):
+        console("Error failed to generate metadata.")
+        return None
+
+    order = spatial_audio_order(row.get("spatial_audio"))
+    if order == 0:
+        return metadata
+
+    parsed_metadata = metadata_utils.parse_metadata(
+        row["input"], lambda contents: None)
+    if parsed_metadata is None:
+        console("Error failed to read audio channels.")
+        return None
+    description = metadata_utils.get_spatial_audio_description(
+        parsed_metadata.num_audio_channels)
+    if not description.is_supported or order not in [None, description.order]:
+        console("Error audio has %d channel(s) and is not a supported "
+                "spatial audio format." % parsed_metadata.num_audio_channels)
+        return None
+    metadata.audio = metadata_utils.get_spatial_audio_metadata(
+        description.order, description.has_head_locked_stereo)
+    return metadata
+
+
+def inject_row(index, row):
+    """Injects the metadata of a manifest row.
+
+    The output is written next to its destination and renamed once complete,
+    so an interrupted run never leaves a partial output file behind.
+
+    Returns:
+      dictionary, journal entry of the row.
+    """
+    messages = []
+    printed = io.StringIO()
+    output = row["output"]
+    partial = None
+    try:
+        with contextlib.redirect_stdout(printed):
+            metadata = row_metadata(row, messages.append)
+            padding = row.get("padding")
+            padding = None if padding is None else int(padding)
+            if metadata is not None and (output is None or
+                                         output == row["input"]):
+                metadata_utils.inject_metadata(
+                    row["input"], None, metadata, messages.append, True,
+                    False, padding)
+            elif metadata is not None:
+                partial = output + PARTIAL_SUFFIX
+                metadata_utils.inject_metadata(
+                    row["input"], partial, metadata, messages.append, False,
+                    parse_flag(row.get("faststart")), padding)
+    except Exception as e:
+        messages.append("Error: %s" % e)
+    messages.extend(printed.getvalue().splitlines())
+
+    errors = [message for message in messages if "Error" in message]
+    if partial is not None and os.path.exists(partial):
+        if errors:
+            os.remove(partial)
+        else:
+            os.replace(partial, output)
+    elif partial is not None and not errors:
+        errors.append("Error output was not written.")
+
+    entry = collections.OrderedDict()
+    entry["row"] = index
+    entry["input"] = row["input"]
+    entry["output"] = output
+    entry["status"] = "failed" if errors else "done"
+    entry["errors"] = errors
+    return entry
+
+
+def path_device(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+def row_devices(row):
+    """Returns the devices read or written when injecting a manifest row."""
+    devices = set([path_device(row["input"])])
+    if row["output"] is not None:
+        devices.add(path_device(os.path.dirname(row["output"])))
+    devices.discard(None)
+    return tuple(sorted(devices))
+
+
+class DeviceThrottle(object):
+    """Queues tasks so at most limit running tasks use each device."""
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.queues = collections.OrderedDict()
+        self.busy = collections.Counter()
+
+    def add(self, devices, task):
+        self.queues.setdefault(devices, collections.deque()).append(task)
+
+    def pending(self):
+        return bool(self.queues)
+
+    def next(self):
+        """Returns (devices, task) of the next task that may run, or None."""
+        for devices, queue in self.queues.items():
+            if all(self.busy[device] < self.limit for device in devices):
+                task = queue.popleft()
+                if not queue:
+                    del self.queues[devices]
+                for device in devices:
+                    self.busy[device] += 1
+                return devices, task
+        return None
+
+    def release(self, devices):
+        for device in devices:
+            self.busy[device] -= 1
+
+
+def inject_manifest(manifest, output, jobs=1, journal=None,
+                    per_device=DEFAULT_PER_DEVICE):
+    """Injects metadata into the files listed in a manifest.
+
+    Rows completed by an earlier run with the same journal are skipped.
+
+    Args:
+      manifest: string, path of the manifest, see read_manifest.
+      output: text file, receives the journal entry of each row.
+      jobs: int, number of worker processes.
+      journal: string, path of the journal, defaults to the manifest path
+        followed by .journal.
+      per_device: int, maximum number of files injected at once that read
+        from or write to the same device.
+
+    Returns:
+      int, number of rows that failed.
+    """
+    rows = read_manifest(manifest)
+    journal = journal or manifest + JOURNAL_SUFFIX
+    done = read_journal(journal)
+    tasks = [(index, row) for index, row in enumerate(rows)
+             if (index, row["input"], row["output"]) not in done]
+
+    failures = [0]
+    with open(journal, "a") as journal_fh:
+
+        def report(entry):
+            line = json.dumps(entry) + "\n"
+            journal_fh.write(line)
+            journal_fh.flush()
+            os.fsync(journal_fh.fileno())
+            if entry["status"] != "done":
+                failures[0] += 1
+            output.write(line)
+            output.flush()
+
+        if jobs <= 1:
+            for index, row in tasks:
+                report(inject_row(index, row))
+            return failures[0]
+
+        throttle = DeviceThrottle(per_device)
+        for index, row in tasks:
+            throttle.add(row_devices(row), (index, row))
+
+        running = dict()
+        with concurrent.futures.ProcessPoolExecutor(
+                jobs, initializer=metadata_cache.set_default_cache,
+                initargs=(metadata_cache.default_cache,)) as executor:
+            while throttle.pending() or running:
+                while len(running) < jobs:
+                    scheduled = throttle.next()
+                    if scheduled is None:
+                        break
+                    devices, task = scheduled
+                    running[executor.submit(inject_row, *task)] = devices
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    throttle.release(running.pop(future))
+                    report(future.result())
+    return failures[0]
@@ -0,0 +1,222 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asyncio counterparts of metadata_utils.parse_metadata/inject_metadata.
+
+Parsing and injection run in a thread pool so they never block the event
+loop. Messages are delivered as Events on an EventStream instead of through
+a console function. Injections copy media data in chunks and stop at the
+next chunk once cancelled.
+
+Example:
+    injector = AsyncInjector(concurrency=16)
+    events = EventStream()
+    ok = await injector.inject_metadata(src, dest, metadata, events)
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import os
+import threading
+import weakref
+
+from spatialmedia import metadata_utils
+
+DEFAULT_CONCURRENCY = 8
+
+# Event kinds.
+EVENT_MESSAGE = "message"
+EVENT_ERROR = "error"
+EVENT_PROGRESS = "progress"
+EVENT_DONE = "done"
+EVENT_CANCELLED = "cancelled"
+
+Event = collections.namedtuple("Event", "kind path message bytes_read")
+
+
+class Cancelled(Exception):
+    """Raised in worker threads to abort a cancelled injection."""
+
+
+class EventStream(object):
+    """Asynchronous iterator over the events of parses and injections.
+
+    Events may be emitted from any thread. Iteration ends once close is
+    called and all events emitted before have been consumed.
+    """
+
+    def __init__(self, maxsize=0):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+        self.closed = False
+
+    def emit(self, event):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+    def close(self):
+        self.emit(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        event = await self.queue.get()
+        if event is None:
+            self.closed = True
+            raise StopAsyncIteration
+        return event
+
+
+def event_console(events, path):
+    """Returns a console function emitting its messages as Events."""
+    def console(contents):
+        if events is None:
+            return
+        kind = EVENT_ERROR if "Error" in contents else EVENT_MESSAGE
+        events.emit(Event(kind, path, contents, 0))
+    return console
+
+
+class AsyncInjector(object):
+    """Runs parses and injections with at most concurrency at a time.
+
+    The limit applies to each event loop the injector is used from, so an
+    injector can outlive the loop of an asyncio.run call.
+
+    Args:
+      concurrency: int, maximum number of files processed at once.
+      executor: concurrent.futures.Executor, runs the blocking work. Defaults
+        to a thread pool with one thread per concurrent file.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, executor=None):
+        self.concurrency = concurrency
+        self.semaphores = weakref.WeakKeyDictionary()
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(
+            concurrency)
+
+    def semaphore(self):
+        """Returns the semaphore limiting concurrency on the running loop."""
+        loop = asyncio.get_running_loop()
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.semaphores[loop] = asyncio.Semaphore(
+                self.concurrency)
+        return semaphore
+
+    async def parse_metadata(self, src, events=None, probe=False):
+        """Parses the spatial media metadata of a file.
+
+        Cancelling the returned coroutine stops waiting for the parse, which
+        is left to complete in the background.
+
+        Returns:
+          metadata_utils.ParsedMetadata or None.
+        """
+        loop = asyncio.get_running_loop()
+        async with self.semaphore():
+            parsed_metadata = await loop.run_in_executor(
+                self.executor, metadata_utils.parse_metadata, src,
+                event_console(events, src), probe)
+        if events is not None:
+            events.emit(Event(EVENT_DONE, src, "", 0))
+        return parsed_metadata
+
+    async def inject_metadata(self, src, dest, metadata, events=None,
+                              in_place=False, faststart=False, padding=None):
+        """Injects metadata into a file, see metadata_utils.inject_metadata.
+
+        Progress events report the amount of data read from src. Cancelling
+        the returned coroutine aborts the copy at the next chunk and removes
+        the incomplete dest. In place injections only rewrite the moov box
+        and always complete.
+
+        Returns:
+          bool, whether the metadata was injected without errors.
+        """
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+        errors = []
+        bytes_read = [0]
+        console = event_console(events, src)
+
+        def record(contents):
+            if "Error" in contents:
+                errors.append(contents)
+            console(contents)
+
+        def checkpoint(size):
+            if cancelled.is_set():
+                raise Cancelled()
+            bytes_read[0] += size
+            # Only the chunks of media data copies are reported.
+            if (events is not None and
+                    size == metadata_utils.CHECKPOINT_CHUNK_SIZE):
+                events.emit(Event(EVENT_PROGRESS, src, "", bytes_read[0]))
+
+        inject = functools.partial(
+            metadata_utils.inject_metadata, src, dest, metadata, record,
+            in_place, faststart, padding, checkpoint=checkpoint)
+
+        async with self.semaphore():
+            future = loop.run_in_executor(self.executor, inject)
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                cancelled.set()
+                await asyncio.wait([future])
+                if future.exception() is not None and not in_place:
+                    try:
+                        os.remove(dest)
+                    except OSError:
+                        pass
+                if events is not None:
+                    events.emit(Event(EVENT_CANCELLED, src, "", bytes_read[0]))
+                raise
+
+        if result:
+            errors.append(result)
+            console(result)
+        if events is not None:
+            events.emit(Event(EVENT_DONE, src, "", bytes_read[0]))
+        return not errors
+
+
+default_injector = None
+
+
+def get_default_injector():
+    global default_injector
+    if default_injector is None:
+        default_injector = AsyncInjector()
+    return default_injector
+
+
+async def parse_metadata(src, events=None, probe=False):
+    """Parses a file with the default AsyncInjector."""
+    return await get_default_injector().parse_metadata(src, events, probe)
+
+
+async def inject_metadata(src, dest, metadata, events=None, in_place=False,
+                          faststart=False, padding=None):
+    """Injects metadata into a file with the default AsyncInjector."""
+    return await get_default_injector().inject_metadata(
+        src, dest, metadata, events, in_place, faststart, padding)
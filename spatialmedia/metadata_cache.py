@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""On-disk cache of parsed MP4/MOV box trees and spatial media metadata.
+
+Entries are keyed by the (device, inode, size, mtime_ns) of the parsed file,
+so looking up an unchanged file costs a single stat. Entries are pickles and
+the cache directory must only be writable by trusted users.
+"""
+
+import collections
+import os
+import pickle
+import tempfile
+
+# Bumped whenever the layout of cached entries changes.
+CACHE_VERSION = 7
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+CACHE_ENTRY_SUFFIX = ".pickle"
+
+CacheEntry = collections.namedtuple(
+    "CacheEntry", "mpeg4 metadata messages")
+
+default_cache = None
+
+
+def set_default_cache(cache):
+    """Sets the cache used by metadata_utils when none is passed explicitly.
+
+    Args:
+      cache: MetadataCache or None to disable caching.
+    """
+    global default_cache
+    default_cache = cache
+
+
+def file_key(stat_result):
+    """Returns the cache key identifying a version of a file."""
+    return "v%d-%x-%x-%x-%x" % (CACHE_VERSION,
+                                stat_result.st_dev,
+                                stat_result.st_ino,
+                                stat_result.st_size,
+                                stat_result.st_mtime_ns)
+
+
+class MetadataCache(object):
+    """Directory of parsed metadata entries with least recently used eviction.
+
+    The modification time of an entry file records its last use, so several
+    processes can share a cache directory.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.size = None
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + CACHE_ENTRY_SUFFIX)
+
+    def lookup(self, path):
+        """Returns the CacheEntry stored for the current version of a file.
+
+        Args:
+          path: string, path of the parsed file.
+
+        Returns:
+          CacheEntry, or None when the file is not cached or has changed.
+        """
+        try:
+            entry_path = self.entry_path(file_key(os.stat(path)))
+            with open(entry_path, "rb") as entry_fh:
+                entry = pickle.load(entry_fh)
+            os.utime(entry_path, None)
+        except (OSError, IOError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError):
+            return None
+        return entry
+
+    def store(self, stat_result, mpeg4_file, metadata, messages):
+        """Stores a parsed file.
+
+        Args:
+          stat_result: os.stat_result of the file taken before parsing.
+          mpeg4_file: mpeg4_container.Mpeg4Container, parsed box tree.
+          metadata: metadata_utils.ParsedMetadata, decoded metadata.
+          messages: list of strings, console messages printed while parsing.
+
+        Raises:
+          pickle.PicklingError, TypeError, AttributeError, RecursionError:
+            the entry cannot be pickled, as parsed files always should be.
+        """
+        entry = CacheEntry(mpeg4_file, metadata, list(messages))
+        contents = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        if len(contents) > self.max_size:
+            return
+
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory,
+                                             suffix=".tmp")
+            with os.fdopen(fd, "wb") as entry_fh:
+                entry_fh.write(contents)
+            os.replace(temp_path, self.entry_path(file_key(stat_result)))
+        except (OSError, IOError):
+            return
+
+        if self.size is not None:
+            self.size += len(contents)
+        if self.size is None or self.size > self.max_size:
+            self.evict()
+
+    def invalidate(self, path):
+        """Removes the entry stored for the current version of a file."""
+        try:
+            os.remove(self.entry_path(file_key(os.stat(path))))
+        except OSError:
+            pass
+
+    def entries(self):
+        """Returns (last use, size, path) of all stored entries."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_ENTRY_SUFFIX):
+                continue
+            entry_path = os.path.join(self.directory, name)
+            try:
+                stat_result = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append(
+                (stat_result.st_mtime, stat_result.st_size, entry_path))
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until under max_size."""
+        entries = sorted(self.entries())
+        self.size = sum(entry[1] for entry in entries)
+        for _, entry_size, entry_path in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            self.size -= entry_size
+
+    def clear(self):
+        """Removes all stored entries."""
+        for _, _, entry_path in self.entries():
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+        self.size = 0
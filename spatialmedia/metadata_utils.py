@@ -19,16 +19,27 @@
 
 import collections
 import os
+import pickle
 import re
-import struct
+import tempfile
 import traceback
 import xml.etree
 import xml.etree.ElementTree
 
+from spatialmedia import metadata_cache
 from spatialmedia import mpeg
 
 MPEG_FILE_EXTENSIONS = [".mp4", ".mov"]
 
+# Stream contents held in memory before spilling to a temporary file.
+STREAM_SPOOL_SIZE = 64 * 1024 * 1024
+
+# Stream contents held before the moov box, in memory and on disk.
+STREAM_SPOOL_LIMIT = 4 * 1024 * 1024 * 1024
+
+# Largest read between two calls to an injection checkpoint.
+CHECKPOINT_CHUNK_SIZE = 4 * 1024 * 1024
+
 SPHERICAL_UUID_ID = (
     b"\xff\xcc\x82\x63\xf8\x55\x4a\x93\x88\x14\x58\x7a\x02\x52\x1f\xdd")
 
@@ -86,16 +97,29 @@ SPHERICAL_TAGS_LIST = [
     "CroppedAreaTopPixels",
 ]
 
+# Spherical video metadata versions written by inject_mpeg4.
+METADATA_VERSIONS = ["1", "2", "both"]
+
+PROJECTIONS = ["equirectangular", "cubemap"]
+
 class Metadata(object):
     def __init__(self):
         self.video = None
+        self.video_v2 = None
         self.audio = None
 
 class ParsedMetadata(object):
     def __init__(self):
         self.video = dict()
+        self.video_v2 = dict()
         self.audio = None
         self.num_audio_channels = 0
+        # Duration in seconds and size in pixels of the first video track.
+        self.duration = None
+        self.width = None
+        self.height = None
+        self.bytes_read = 0
+        self.seeks = 0
 
 SPHERICAL_PREFIX = "{http://ns.google.com/videos/1.0/spherical/}"
 SPHERICAL_TAGS = dict()
@@ -144,6 +168,7 @@ def spherical_uuid(metadata):
     return uuid_leaf
 
 
+@mpeg.instrumentation.instrumented("add_spherical")
 def mpeg4_add_spherical(mpeg4_file, in_fh, metadata):
     """Adds a spherical uuid box to an mpeg4 file for all video tracks.
 
@@ -152,30 +177,78 @@ def mpeg4_add_spherical(mpeg4_file, in_fh, metadata):
       in_fh: file handle, Source for uncached file contents.
       metadata: string, xml metadata to inject into spherical tag.
     """
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            added = False
-            element.remove(mpeg.constants.TAG_UUID)
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_MDIA:
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if mdia_sub_element.name != mpeg.constants.TAG_HDLR:
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if in_fh.read(4) == mpeg.constants.TRAK_TYPE_VIDE:
-                        added = True
-                        break
-
-                if added:
-                    if not element.add(spherical_uuid(metadata)):
-                        return False
+    tracks = get_tracks(mpeg4_file, in_fh)
+    mpeg4_file.moov_box.remove_all([mpeg.constants.TAG_UUID], "trak")
+    for track in tracks:
+        del track.uuids[:]
+        if track.is_video():
+            uuid_leaf = spherical_uuid(metadata)
+            if not track.trak.add(uuid_leaf):
+                return False
+            track.uuids.append((SPHERICAL_UUID_ID, uuid_leaf))
+
+    mpeg4_file.resize()
+    return True
+
+@mpeg.instrumentation.instrumented("add_spherical_v2")
+def mpeg4_add_spherical_v2(mpeg4_file, in_fh, video_v2, console):
+    """Adds st3d and sv3d boxes to the sample descriptions of video tracks.
+
+    Existing st3d and sv3d boxes are replaced. The new boxes are inserted
+    before any clap or pasp box.
+
+    Args:
+      mpeg4_file: mpeg4, Mpeg4 file structure to add metadata.
+      in_fh: file handle, Source for uncached file contents.
+      video_v2: dictionary, see generate_spherical_v2.
+      console: function, receives error messages.
+    """
+    for track in get_tracks(mpeg4_file, in_fh):
+        if not track.is_video():
+            continue
+        if len(track.visual_descriptions) != len(track.sample_descriptions):
+            console("Error: unsupported video sample description.")
+            return False
+
+        del track.st3d_boxes[:]
+        del track.sv3d_boxes[:]
+        for sample_description in track.visual_descriptions:
+            sample_description.remove_all(
+                [mpeg.constants.TAG_ST3D, mpeg.constants.TAG_SV3D])
+            st3d, sv3d = spherical_v2_boxes(video_v2)
+            index = len(sample_description.contents)
+            for i, element in enumerate(sample_description.contents):
+                if element.name in [mpeg.constants.TAG_CLAP,
+                                    mpeg.constants.TAG_PASP]:
+                    index = i
                     break
+            sample_description.insert(index, sv3d)
+            sample_description.insert(index, st3d)
+            track.st3d_boxes.append(st3d)
+            track.sv3d_boxes.append(sv3d)
 
     mpeg4_file.resize()
     return True
 
+def spherical_v2_boxes(video_v2):
+    """Returns the st3d and sv3d boxes holding spherical video V2 metadata.
+
+    Args:
+      video_v2: dictionary, see generate_spherical_v2.
+    """
+    st3d = mpeg.sv3d.ST3DBox.create(
+        mpeg.sv3d.STEREO_MODES[video_v2["stereo_mode"]])
+    if video_v2["projection"] == "cubemap":
+        projection_box = mpeg.sv3d.CbmpBox.create(0, 0)
+    elif video_v2["projection"] == "mesh":
+        projection_box = mpeg.sv3d.MSHPBox.create(video_v2["meshes"])
+    else:
+        projection_box = mpeg.sv3d.EquiBox.create(*video_v2["bounds"])
+    sv3d = mpeg.sv3d.create_sv3d(projection_box, video_v2["pose"],
+                                 video_v2["metadata_source"])
+    return st3d, sv3d
+
+@mpeg.instrumentation.instrumented("add_spatial_audio")
 def mpeg4_add_spatial_audio(mpeg4_file, in_fh, audio_metadata, console):
     """Adds spatial audio metadata to the first audio track of the input
        mpeg4_file. Returns False on failure.
@@ -187,19 +260,10 @@ def mpeg4_add_spatial_audio(mpeg4_file, in_fh, audio_metadata, console):
       'ambisonic_order': int, 'head_locked_stereo': Bool),
       Supports 'periphonic' ambisonic type only.
     """
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_MDIA:
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if mdia_sub_element.name != mpeg.constants.TAG_HDLR:
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if in_fh.read(4) == mpeg.constants.TAG_SOUN:
-                        return inject_spatial_audio_atom(
-                            in_fh, sub_element, audio_metadata, console)
+    for track in get_tracks(mpeg4_file, in_fh):
+        if track.is_audio():
+            return inject_spatial_audio_atom(
+                in_fh, track, audio_metadata, console)
     return True
 
 def mpeg4_add_audio_metadata(mpeg4_file, in_fh, audio_metadata, console):
@@ -210,45 +274,39 @@ def mpeg4_add_audio_metadata(mpeg4_file, in_fh, audio_metadata, console):
 
     return mpeg4_add_spatial_audio(mpeg4_file, in_fh, audio_metadata, console)
 
-def inject_spatial_audio_atom(
-    in_fh, audio_media_atom, audio_metadata, console):
-    for atom in audio_media_atom.contents:
-        if atom.name != mpeg.constants.TAG_MINF:
-            continue
-        for element in atom.contents:
-            if element.name != mpeg.constants.TAG_STBL:
-                continue
-            for sub_element in element.contents:
-                if sub_element.name != mpeg.constants.TAG_STSD:
-                    continue
-                for sample_description in sub_element.contents:
-                    if sample_description.name in\
-                            mpeg.constants.SOUND_SAMPLE_DESCRIPTIONS:
-                        in_fh.seek(sample_description.position +
-                                   sample_description.header_size + 16)
-                        num_channels = get_num_audio_channels(
-                            sub_element, in_fh)
-                        expected_num_channels = \
-                            get_expected_num_audio_channels(
-                                audio_metadata["ambisonic_type"],
-                                audio_metadata["ambisonic_order"],
-                                audio_metadata["head_locked_stereo"])
-                        if num_channels != expected_num_channels:
-                            head_locked_stereo_msg = (" with head-locked stereo" if
-                                            audio_metadata["head_locked_stereo"] else "")
-                            err_msg = "Error: Found %d audio channel(s). "\
-                                  "Expected %d channel(s) for %s ambisonics "\
-                                  "of order %d%s."\
-                                % (num_channels,
-                                   expected_num_channels,
-                                   audio_metadata["ambisonic_type"],
-                                   audio_metadata["ambisonic_order"],
-                                   head_locked_stereo_msg)
-                            console(err_msg)
-                            return False
-                        sa3d_atom = mpeg.SA3DBox.create(
-                            num_channels, audio_metadata)
-                        sample_description.contents.append(sa3d_atom)
+def inject_spatial_audio_atom(in_fh, track, audio_metadata, console):
+    """Adds an SA3D box to each sound sample description of a track.
+
+    Args:
+      in_fh: file handle, Source for uncached file contents.
+      track: mpeg.Track, indexed audio track.
+      audio_metadata: dictionary, spatial audio metadata.
+      console: function, receives error messages.
+    """
+    for sample_description in track.sound_descriptions:
+        num_channels = track.num_audio_channels
+        expected_num_channels = \
+            get_expected_num_audio_channels(
+                audio_metadata["ambisonic_type"],
+                audio_metadata["ambisonic_order"],
+                audio_metadata["head_locked_stereo"])
+        if num_channels != expected_num_channels:
+            head_locked_stereo_msg = (" with head-locked stereo" if
+                            audio_metadata["head_locked_stereo"] else "")
+            err_msg = "Error: Found %d audio channel(s). "\
+                  "Expected %d channel(s) for %s ambisonics "\
+                  "of order %d%s."\
+                % (num_channels,
+                   expected_num_channels,
+                   audio_metadata["ambisonic_type"],
+                   audio_metadata["ambisonic_order"],
+                   head_locked_stereo_msg)
+            console(err_msg)
+            return False
+        sa3d_atom = mpeg.SA3DBox.create(
+            num_channels, audio_metadata)
+        sample_description.append(sa3d_atom)
+        track.sa3d_boxes.append(sa3d_atom)
     return True
 
 def parse_spherical_xml(contents, console):
@@ -279,20 +337,21 @@ def parse_spherical_xml(contents, console):
             return
 
     sphericalDictionary = dict()
-    for child in parsed_xml.getchildren():
+    for child in list(parsed_xml):
         if child.tag in SPHERICAL_TAGS.keys():
             console("\t\t" + SPHERICAL_TAGS[child.tag]
                     + " = " + child.text)
             sphericalDictionary[SPHERICAL_TAGS[child.tag]] = child.text
         else:
             tag = child.tag
-            if child.tag[:len(spherical_prefix)] == spherical_prefix:
-                tag = child.tag[len(spherical_prefix):]
+            if child.tag[:len(SPHERICAL_PREFIX)] == SPHERICAL_PREFIX:
+                tag = child.tag[len(SPHERICAL_PREFIX):]
             console("\t\tUnknown: " + tag + " = " + child.text)
 
     return sphericalDictionary
 
 
+@mpeg.instrumentation.instrumented("parse_spherical")
 def parse_spherical_mpeg4(mpeg4_file, fh, console):
     """Returns spherical metadata for a loaded mpeg4 file.
 
@@ -304,91 +363,276 @@ def parse_spherical_mpeg4(mpeg4_file, fh, console):
       Dictionary stored as (trackName, metadataDictionary)
     """
     metadata = ParsedMetadata()
-    track_num = 0
-    for element in mpeg4_file.moov_box.contents:
-        if element.name == mpeg.constants.TAG_TRAK:
-            trackName = "Track %d" % track_num
-            console("\t%s" % trackName)
-            track_num += 1
-            for sub_element in element.contents:
-                if sub_element.name == mpeg.constants.TAG_UUID:
+    metadata.duration = mpeg4_file.duration(fh)
+    for track in get_tracks(mpeg4_file, fh):
+        resolution = track.resolution(fh)
+        if resolution is not None:
+            metadata.width, metadata.height = resolution
+            break
+
+    for track_num, track in enumerate(get_tracks(mpeg4_file, fh)):
+        trackName = "Track %d" % track_num
+        console("\t%s" % trackName)
+        for sub_element in track.trak.contents:
+            if sub_element.name == mpeg.constants.TAG_UUID:
+                if track.usertype(sub_element) == SPHERICAL_UUID_ID:
                     if sub_element.contents:
-                        sub_element_id = sub_element.contents[:16]
+                        contents = sub_element.contents[16:]
                     else:
-                        fh.seek(sub_element.content_start())
-                        sub_element_id = fh.read(16)
-
-                    if sub_element_id == SPHERICAL_UUID_ID:
-                        if sub_element.contents:
-                            contents = sub_element.contents[16:]
-                        else:
-                            contents = fh.read(sub_element.content_size - 16)
-                        metadata.video[trackName] = \
-                            parse_spherical_xml(contents.decode("utf-8"), console)
-
-                if sub_element.name == mpeg.constants.TAG_MDIA:
-                    for mdia_sub_element in sub_element.contents:
-                        if mdia_sub_element.name != mpeg.constants.TAG_MINF:
-                            continue
-                        for stbl_elem in mdia_sub_element.contents:
-                            if stbl_elem.name != mpeg.constants.TAG_STBL:
-                                continue
-                            for stsd_elem in stbl_elem.contents:
-                                if stsd_elem.name != mpeg.constants.TAG_STSD:
-                                    continue
-                                for sa3d_container_elem in stsd_elem.contents:
-                                    if sa3d_container_elem.name not in \
-                                            mpeg.constants.SOUND_SAMPLE_DESCRIPTIONS:
-                                        continue
-                                    metadata.num_audio_channels = \
-                                        get_num_audio_channels(stsd_elem, fh)
-                                    for sa3d_elem in sa3d_container_elem.contents:
-                                        if sa3d_elem.name == mpeg.constants.TAG_SA3D:
-                                            sa3d_elem.print_box(console)
-                                            metadata.audio = sa3d_elem
+                        fh.seek(sub_element.content_start() + 16)
+                        contents = fh.read(sub_element.content_size - 16)
+                    metadata.video[trackName] = \
+                        parse_spherical_xml(contents.decode("utf-8"), console)
+
+            if sub_element is track.mdia:
+                for sample_description in track.visual_descriptions:
+                    video_v2 = mpeg.sv3d.spherical_metadata(sample_description)
+                    if not video_v2:
+                        continue
+                    console("\t\tSpherical Video V2")
+                    for name, value in video_v2:
+                        console("\t\t\t%s = %s" % (name, value))
+                    metadata.video_v2.setdefault(trackName, dict(video_v2))
+
+            if sub_element is track.mdia and track.sound_descriptions:
+                metadata.num_audio_channels = track.num_audio_channels
+                for sa3d_elem in track.sa3d_boxes:
+                    sa3d_elem.print_box(console)
+                    metadata.audio = sa3d_elem
     return metadata
 
-def parse_mpeg4(input_file, console):
+def parse_mpeg4(input_file, console, probe=False, cache=None):
+    """Parses the spherical metadata of an mpeg4 file.
+
+    Args:
+      input_file: string, path of the file to parse.
+      console: function, receives status and error messages.
+      probe: bool, read only the top level box headers and the moov box,
+        parsing the metadata from memory.
+      cache: metadata_cache.MetadataCache, stores the parsed file if given.
+
+    Returns:
+      ParsedMetadata, including the amount of data read and seeks issued.
+    """
     with open(input_file, "rb") as in_fh:
-        mpeg4_file = mpeg.load(in_fh)
+        stat_result = os.fstat(in_fh.fileno())
+        messages = []
+
+        def record(contents):
+            messages.append(contents)
+            console(contents)
+
+        counted_fh = mpeg.probe.CountingFile(
+            mpeg.instrumentation.wrap(in_fh))
+        if probe:
+            mpeg4_file, reader = mpeg.probe.load(counted_fh)
+        else:
+            mpeg4_file = mpeg.load(counted_fh)
+            reader = counted_fh
         if mpeg4_file is None:
             console("Error, file could not be opened.")
             return
 
-        console("Loaded file...")
-        return parse_spherical_mpeg4(mpeg4_file, in_fh, console)
+        record("Loaded file...")
+        metadata = parse_spherical_mpeg4(mpeg4_file, reader, record)
+        metadata.bytes_read = counted_fh.bytes_read
+        metadata.seeks = counted_fh.seeks
+        if probe:
+            console("Read %d bytes with %d seeks"
+                    % (metadata.bytes_read, metadata.seeks))
+        if cache is not None:
+            try:
+                cache.store(stat_result, mpeg4_file, metadata, messages)
+            except (pickle.PicklingError, TypeError, AttributeError,
+                    RecursionError) as e:
+                console("Warning parsed file could not be cached: %s" % e)
+        return metadata
 
     console("Error \"" + input_file + "\" does not exist or do not have "
             "permission.")
 
 
-def inject_mpeg4(input_file, output_file, metadata, console):
-    with open(input_file, "rb") as in_fh:
+def inject_mpeg4(input_file, output_file, metadata, console, in_place=False,
+                 faststart=False, padding=None, checkpoint=None):
+    """Injects metadata into an mpeg4 file.
+
+    Args:
+      input_file: string, path of the file to inject metadata into.
+      output_file: string, path of the file to save, ignored when in_place.
+      metadata: Metadata, spherical video and spatial audio to inject.
+      console: function, receives status and error messages.
+      in_place: bool, rewrite only the moov box of input_file, leaving the
+        media data untouched on disk.
+      faststart: bool, save the moov box in front of the media data.
+      padding: int or None, size of a free box to reserve after the moov box
+        so later injections can be done in place. None keeps existing free
+        space as is. In place, only a moov box at the end of the file can
+        change its padding.
+      checkpoint: function or None, called with the size of each chunk read
+        from input_file, at most CHECKPOINT_CHUNK_SIZE bytes, when not
+        in_place. It may raise to abort the injection. Data is then copied
+        through Python rather than by the kernel.
+    """
+    if in_place and faststart:
+        console("Error faststart cannot be combined with in place injection.")
+        return
+
+    mode = "r+b" if in_place else "rb"
+    with open(input_file, mode) as in_fh:
+        in_fh = mpeg.instrumentation.wrap(in_fh)
+        if checkpoint is not None and not in_place:
+            in_fh = mpeg.box.CheckpointFile(in_fh, checkpoint,
+                                            CHECKPOINT_CHUNK_SIZE)
 
         mpeg4_file = mpeg.load(in_fh)
         if mpeg4_file is None:
             console("Error file could not be opened.")
+            return
 
-        if not mpeg4_add_spherical(mpeg4_file, in_fh, metadata.video):
-            console("Error failed to insert spherical data")
+        mpeg4_add_metadata(mpeg4_file, in_fh, metadata, console)
 
-        if metadata.audio:
-            if not mpeg4_add_audio_metadata(
-                mpeg4_file, in_fh, metadata.audio, console):
-                    console("Error failed to insert spatial audio data")
+        if in_place:
+            if not mpeg4_file.save_in_place(in_fh, padding):
+                console("Error metadata could not be injected in place.")
+                return
+            console("Free space after moov box: %d bytes"
+                    % mpeg4_file.free_space())
+            return
 
-        console("Saved file settings")
-        parse_spherical_mpeg4(mpeg4_file, in_fh, console)
+        mpeg4_set_layout(mpeg4_file, console, faststart, padding)
 
         with open(output_file, "wb") as out_fh:
-            mpeg4_file.save(in_fh, out_fh)
+            mpeg4_file.save(in_fh, mpeg.instrumentation.wrap(out_fh))
+        if padding is not None:
+            console("Free space after moov box: %d bytes"
+                    % mpeg4_file.free_space())
         return
 
     console("Error file: \"" + input_file + "\" does not exist or do not have "
             "permission.")
 
-def parse_metadata(src, console):
+
+def inject_mpeg4_stream(in_stream, out_stream, metadata, console,
+                        spatial_audio=False, faststart=False, padding=None,
+                        spool_limit=STREAM_SPOOL_LIMIT):
+    """Injects metadata into an mpeg4 file read from a stream such as a pipe.
+
+    Boxes up to moov are held in a temporary file, which stays in memory up
+    to STREAM_SPOOL_SIZE bytes, and the rest of the stream is copied straight
+    through once the modified boxes have been written. Streams whose moov box
+    follows more than spool_limit bytes are rejected.
+
+    Args:
+      in_stream: file handle, stream to read the mpeg4 file from.
+      out_stream: file handle, stream to write the injected file to.
+      metadata: Metadata, spherical video and spatial audio to inject.
+      console: function, receives status and error messages.
+      spatial_audio: bool, derive spatial audio metadata from the number of
+        audio channels, as the stream cannot be parsed beforehand.
+      faststart: bool, save the moov box in front of the media data.
+      padding: int or None, size of a free box to reserve after the moov box.
+      spool_limit: int or None, largest amount of data held before the moov
+        box, None for no limit.
+    """
+    in_stream = mpeg.instrumentation.wrap(in_stream)
+    out_stream = mpeg.instrumentation.wrap(out_stream)
+    with tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_SIZE) as spool:
+        mpeg4_file = mpeg.stream.load(in_stream, spool, spool_limit)
+        if mpeg4_file is None:
+            console("Error stream could not be loaded.")
+            return
+
+        if spatial_audio:
+            num_channels = parse_spherical_mpeg4(
+                mpeg4_file, spool, lambda *args: None).num_audio_channels
+            description = get_spatial_audio_description(num_channels)
+            if not description.is_supported:
+                console("Audio has %d channel(s) and is not a supported "
+                        "spatial audio format." % num_channels)
+                return
+            metadata.audio = get_spatial_audio_metadata(
+                description.order, description.has_head_locked_stereo)
+
+        loaded_size = mpeg4_file.content_size
+        mpeg4_add_metadata(mpeg4_file, spool, metadata, console)
+        mpeg4_set_layout(mpeg4_file, console, faststart, padding)
+
+        mpeg4_file.save(spool, out_stream)
+        mpeg.stream.copy_remaining(
+            in_stream, out_stream, mpeg4_file.content_size - loaded_size)
+        out_stream.flush()
+
+
+def mpeg4_add_metadata(mpeg4_file, in_fh, metadata, console):
+    """Adds spherical video and spatial audio metadata to an mpeg4 file.
+
+    Args:
+      mpeg4_file: mpeg4, Mpeg4 file structure to add metadata.
+      in_fh: file handle, Source for uncached file contents.
+      metadata: Metadata, spherical video and spatial audio to inject.
+      console: function, receives status and error messages.
+    """
+    if metadata.video:
+        if not mpeg4_add_spherical(mpeg4_file, in_fh, metadata.video):
+            console("Error failed to insert spherical data")
+
+    if metadata.video_v2:
+        if not mpeg4_add_spherical_v2(
+            mpeg4_file, in_fh, metadata.video_v2, console):
+                console("Error failed to insert spherical video V2 data")
+
+    if metadata.audio:
+        if not mpeg4_add_audio_metadata(
+            mpeg4_file, in_fh, metadata.audio, console):
+                console("Error failed to insert spatial audio data")
+
+    console("Saved file settings")
+    parse_spherical_mpeg4(mpeg4_file, in_fh, console)
+
+
+def mpeg4_set_layout(mpeg4_file, console, faststart=False, padding=None):
+    """Arranges the top level boxes of an mpeg4 file before saving it.
+
+    Args:
+      mpeg4_file: mpeg4, Mpeg4 file structure to arrange.
+      console: function, receives status and error messages.
+      faststart: bool, move the moov box in front of the media data.
+      padding: int or None, size of a free box to reserve after the moov box.
+    """
+    if faststart and not mpeg4_file.move_moov_before_mdat():
+        console("Error failed to move moov box before media data")
+
+    if padding is not None and not mpeg4_file.set_padding(padding):
+        console("Error failed to reserve %d bytes after moov box" % padding)
+
+
+def parse_metadata(src, console, probe=False, cache=None):
+    """Parses the spatial media metadata of a file.
+
+    Args:
+      src: string, path of the file to parse.
+      console: function, receives status and error messages.
+      probe: bool, read only the top level box headers and the moov box.
+      cache: metadata_cache.MetadataCache, defaults to
+        metadata_cache.default_cache. Unchanged files found in the cache are
+        not read, their messages are replayed to console.
+
+    Returns:
+      ParsedMetadata or None.
+    """
     infile = os.path.abspath(src)
+    if cache is None:
+        cache = metadata_cache.default_cache
+
+    if cache is not None:
+        entry = cache.lookup(infile)
+        if entry is not None:
+            console("Processing: " + infile)
+            for contents in entry.messages:
+                console(contents)
+            entry.metadata.bytes_read = 0
+            entry.metadata.seeks = 0
+            return entry.metadata
 
     try:
         in_fh = open(infile, "rb")
@@ -401,18 +645,25 @@ def parse_metadata(src, console):
     extension = os.path.splitext(infile)[1].lower()
 
     if extension in MPEG_FILE_EXTENSIONS:
-        return parse_mpeg4(infile, console)
+        with mpeg.instrumentation.phase("parse", file=infile):
+            return parse_mpeg4(infile, console, probe, cache)
 
     console("Unknown file type")
     return None
 
 
-def inject_metadata(src, dest, metadata, console):
+def inject_metadata(src, dest, metadata, console, in_place=False,
+                    faststart=False, padding=None, cache=None,
+                    checkpoint=None):
     infile = os.path.abspath(src)
-    outfile = os.path.abspath(dest)
-
-    if infile == outfile:
-        return "Input and output cannot be the same"
+    if in_place:
+        outfile = infile
+    else:
+        outfile = os.path.abspath(dest)
+        if infile == outfile:
+            return "Input and output cannot be the same"
+    if cache is None:
+        cache = metadata_cache.default_cache
 
     try:
         in_fh = open(infile, "rb")
@@ -427,12 +678,82 @@ def inject_metadata(src, dest, metadata, console):
     extension = os.path.splitext(infile)[1].lower()
 
     if (extension in MPEG_FILE_EXTENSIONS):
-        inject_mpeg4(infile, outfile, metadata, console)
+        if cache is not None:
+            cache.invalidate(outfile)
+        try:
+            with mpeg.instrumentation.phase("inject", file=infile):
+                inject_mpeg4(infile, outfile, metadata, console, in_place,
+                             faststart, padding, checkpoint)
+        finally:
+            # Writes within the mtime resolution keep size and mtime_ns.
+            if cache is not None:
+                cache.invalidate(outfile)
         return
 
     console("Unknown file type")
 
 
+def parse_crop(crop):
+    """Parses and validates a crop given as "w:h:f_w:f_h:x:y".
+
+    Returns:
+      tuple of the 6 crop integers, or None after printing an error.
+    """
+    crop_match = re.match(crop_regex, crop)
+    if not crop_match:
+        print("Error: Invalid crop params: {crop}".format(crop=crop))
+        return None
+
+    cropped_width_pixels = int(crop_match.group(1))
+    cropped_height_pixels = int(crop_match.group(2))
+    full_width_pixels = int(crop_match.group(3))
+    full_height_pixels = int(crop_match.group(4))
+    cropped_offset_left_pixels = int(crop_match.group(5))
+    cropped_offset_top_pixels = int(crop_match.group(6))
+
+    # This should never happen based on the crop regex.
+    if full_width_pixels <= 0 or full_height_pixels <= 0:
+        print("Error with crop params: full pano dimensions are "\
+                "invalid: width = {width} height = {height}".format(
+                    width=full_width_pixels,
+                    height=full_height_pixels))
+        return None
+
+    if (cropped_width_pixels <= 0 or
+            cropped_height_pixels <= 0 or
+            cropped_width_pixels > full_width_pixels or
+            cropped_height_pixels > full_height_pixels):
+        print("Error with crop params: cropped area dimensions are "\
+                "invalid: width = {width} height = {height}".format(
+                    width=cropped_width_pixels,
+                    height=cropped_height_pixels))
+        return None
+
+    # We are pretty restrictive and don't allow anything strange. There
+    # could be use-cases for a horizontal offset that essentially
+    # translates the domain, but we don't support this (so that no
+    # extra work has to be done on the client).
+    total_width = cropped_offset_left_pixels + cropped_width_pixels
+    total_height = cropped_offset_top_pixels + cropped_height_pixels
+    if (cropped_offset_left_pixels < 0 or
+            cropped_offset_top_pixels < 0 or
+            total_width > full_width_pixels or
+            total_height > full_height_pixels):
+            print("Error with crop params: cropped area offsets are "\
+                    "invalid: left = {left} top = {top} "\
+                    "left+cropped width: {total_width} "\
+                    "top+cropped height: {total_height}".format(
+                        left=cropped_offset_left_pixels,
+                        top=cropped_offset_top_pixels,
+                        total_width=total_width,
+                        total_height=total_height))
+            return None
+
+    return (cropped_width_pixels, cropped_height_pixels,
+            full_width_pixels, full_height_pixels,
+            cropped_offset_left_pixels, cropped_offset_top_pixels)
+
+
 def generate_spherical_xml(stereo=None, crop=None):
     # Configure inject xml.
     additional_xml = ""
@@ -443,60 +764,11 @@ def generate_spherical_xml(stereo=None, crop=None):
         additional_xml += SPHERICAL_XML_CONTENTS_LEFT_RIGHT
 
     if crop:
-        crop_match = re.match(crop_regex, crop)
-        if not crop_match:
-            print("Error: Invalid crop params: {crop}".format(crop=crop))
+        crop_values = parse_crop(crop)
+        if crop_values is None:
             return False
-        else:
-            cropped_width_pixels = int(crop_match.group(1))
-            cropped_height_pixels = int(crop_match.group(2))
-            full_width_pixels = int(crop_match.group(3))
-            full_height_pixels = int(crop_match.group(4))
-            cropped_offset_left_pixels = int(crop_match.group(5))
-            cropped_offset_top_pixels = int(crop_match.group(6))
-
-            # This should never happen based on the crop regex.
-            if full_width_pixels <= 0 or full_height_pixels <= 0:
-                print("Error with crop params: full pano dimensions are "\
-                        "invalid: width = {width} height = {height}".format(
-                            width=full_width_pixels,
-                            height=full_height_pixels))
-                return False
-
-            if (cropped_width_pixels <= 0 or
-                    cropped_height_pixels <= 0 or
-                    cropped_width_pixels > full_width_pixels or
-                    cropped_height_pixels > full_height_pixels):
-                print("Error with crop params: cropped area dimensions are "\
-                        "invalid: width = {width} height = {height}".format(
-                            width=cropped_width_pixels,
-                            height=cropped_height_pixels))
-                return False
-
-            # We are pretty restrictive and don't allow anything strange. There
-            # could be use-cases for a horizontal offset that essentially
-            # translates the domain, but we don't support this (so that no
-            # extra work has to be done on the client).
-            total_width = cropped_offset_left_pixels + cropped_width_pixels
-            total_height = cropped_offset_top_pixels + cropped_height_pixels
-            if (cropped_offset_left_pixels < 0 or
-                    cropped_offset_top_pixels < 0 or
-                    total_width > full_width_pixels or
-                    total_height > full_height_pixels):
-                    print("Error with crop params: cropped area offsets are "\
-                            "invalid: left = {left} top = {top} "\
-                            "left+cropped width: {total_width} "\
-                            "top+cropped height: {total_height}".format(
-                                left=cropped_offset_left_pixels,
-                                top=cropped_offset_top_pixels,
-                                total_width=total_width,
-                                total_height=total_height))
-                    return False
-
-            additional_xml += SPHERICAL_XML_CONTENTS_CROP_FORMAT.format(
-                cropped_width_pixels, cropped_height_pixels,
-                full_width_pixels, full_height_pixels,
-                cropped_offset_left_pixels, cropped_offset_top_pixels)
+        additional_xml += SPHERICAL_XML_CONTENTS_CROP_FORMAT.format(
+            *crop_values)
 
     spherical_xml = (SPHERICAL_XML_HEADER +
                      SPHERICAL_XML_CONTENTS +
@@ -505,18 +777,99 @@ def generate_spherical_xml(stereo=None, crop=None):
     return spherical_xml
 
 
+def generate_spherical_v2(stereo=None, crop=None,
+                          projection="equirectangular", meshes=None):
+    """Returns the spherical video V2 metadata to inject.
+
+    The crop is stored as the equirectangular projection bounds, the
+    fractions of the full panorama cropped from each edge in 0.32 fixed
+    point.
+
+    Args:
+      meshes: list of mpeg.mesh.Mesh, the mesh, or the left and right eye
+        meshes, of the mesh projection, e.g. from mpeg.mesh.fisheye_mesh.
+
+    Returns:
+      dictionary with the stereo_mode, projection, bounds (top, bottom,
+      left, right), meshes, pose (yaw, pitch, roll) and metadata_source, or
+      False after printing an error.
+    """
+    if ((projection == "mesh") != bool(meshes) or
+            len(meshes or []) > 2):
+        print("Error: the mesh projection requires 1 or 2 meshes.")
+        return False
+    if stereo == "stereo-custom" and len(meshes or []) != 2:
+        print("Error: stereo-custom requires a mesh for each eye.")
+        return False
+
+    bounds = (0, 0, 0, 0)
+    if crop:
+        if projection != "equirectangular":
+            print("Error: crop params require the equirectangular "
+                  "projection.")
+            return False
+        crop_values = parse_crop(crop)
+        if crop_values is None:
+            return False
+        width, height, full_width, full_height, left, top = crop_values
+        bounds = (fixed_point_fraction(top, full_height),
+                  fixed_point_fraction(full_height - top - height,
+                                       full_height),
+                  fixed_point_fraction(left, full_width),
+                  fixed_point_fraction(full_width - left - width,
+                                       full_width))
+
+    return {
+        "stereo_mode": stereo or "none",
+        "projection": projection,
+        "bounds": bounds,
+        "meshes": meshes,
+        "pose": (0, 0, 0),
+        "metadata_source": mpeg.sv3d.DEFAULT_METADATA_SOURCE,
+    }
+
+
+def fixed_point_fraction(numerator, denominator):
+    """Returns numerator / denominator in 0.32 fixed point."""
+    return min((numerator << 32) // denominator, 0xFFFFFFFF)
+
+
+def generate_metadata(metadata, stereo=None, crop=None, version="1",
+                      projection="equirectangular"):
+    """Sets the spherical video metadata to inject.
+
+    Args:
+      metadata: Metadata, receives the V1 xml and / or V2 metadata.
+      stereo: string, stereo mode.
+      crop: string, crop region as "w:h:f_w:f_h:x:y".
+      version: string, one of METADATA_VERSIONS.
+      projection: string, one of PROJECTIONS, cubemap requires version 2.
+
+    Returns:
+      Bool, whether the metadata could be generated.
+    """
+    # Version 1 metadata only describes equirectangular projections.
+    if version != "2" and projection != "equirectangular":
+        print("Error: {projection} projection requires --metadata-version "
+              "2.".format(projection=projection))
+        return False
+
+    if version in ["1", "both"]:
+        metadata.video = generate_spherical_xml(stereo, crop)
+        if not metadata.video:
+            return False
+    if version in ["2", "both"]:
+        metadata.video_v2 = generate_spherical_v2(stereo, crop, projection)
+        if not metadata.video_v2:
+            return False
+    return True
+
+
 def get_descriptor_length(in_fh):
     """Derives the length of the MP4 elementary stream descriptor at the
        current position in the input file.
     """
-    descriptor_length = 0
-    for i in range(4):
-        size_byte = struct.unpack(">c", in_fh.read(1))[0]
-        descriptor_length = (descriptor_length << 7 |
-                             ord(size_byte) & int("0x7f", 0))
-        if (ord(size_byte) != int("0x80", 0)):
-            break
-    return descriptor_length
+    return mpeg.track.descriptor_length(in_fh)
 
 
 def get_expected_num_audio_channels(
@@ -536,117 +889,36 @@ def get_num_audio_channels(stsd, in_fh):
         print("get_num_audio_channels should be given a STSD box")
         return -1
     for sample_description in stsd.contents:
-        if sample_description.name == mpeg.constants.TAG_MP4A:
-            return get_aac_num_channels(sample_description, in_fh)
-        elif sample_description.name in mpeg.constants.SOUND_SAMPLE_DESCRIPTIONS:
-            return get_sample_description_num_channels(sample_description, in_fh)
+        if sample_description.name in mpeg.constants.SOUND_SAMPLE_DESCRIPTIONS:
+            return mpeg.track.num_audio_channels(sample_description, in_fh)
     return -1
 
 def get_sample_description_num_channels(sample_description, in_fh):
     """Reads the number of audio channels from a sound sample description.
     """
-    p = in_fh.tell()
-    in_fh.seek(sample_description.content_start() + 8)
-
-    version = struct.unpack(">h", in_fh.read(2))[0]
-    revision_level = struct.unpack(">h", in_fh.read(2))[0]
-    vendor = struct.unpack(">i", in_fh.read(4))[0]
-    if version == 0:
-        num_audio_channels = struct.unpack(">h", in_fh.read(2))[0]
-        sample_size_bytes = struct.unpack(">h", in_fh.read(2))[0]
-    elif version == 1:
-        num_audio_channels = struct.unpack(">h", in_fh.read(2))[0]
-        sample_size_bytes = struct.unpack(">h", in_fh.read(2))[0]
-        samples_per_packet = struct.unpack(">i", in_fh.read(4))[0]
-        bytes_per_packet = struct.unpack(">i", in_fh.read(4))[0]
-        bytes_per_frame = struct.unpack(">i", in_fh.read(4))[0]
-        bytes_per_sample = struct.unpack(">i", in_fh.read(4))[0]
-    elif version == 2:
-        always_3 = struct.unpack(">h", in_fh.read(2))[0]
-        always_16 = struct.unpack(">h", in_fh.read(2))[0]
-        always_minus_2 = struct.unpack(">h", in_fh.read(2))[0]
-        always_0 = struct.unpack(">h", in_fh.read(2))[0]
-        always_65536 = struct.unpack(">i", in_fh.read(4))[0]
-        size_of_struct_only = struct.unpack(">i", in_fh.read(4))[0]
-        audio_sample_rate = struct.unpack(">d", in_fh.read(8))[0]
-        num_audio_channels = struct.unpack(">i", in_fh.read(4))[0]
-    else:
-        print("Unsupported version for " + sample_description.name + " box")
-        return -1
-
-    in_fh.seek(p)
-    return num_audio_channels
+    return mpeg.track.sample_description_num_channels(
+        sample_description, in_fh)
 
 def get_aac_num_channels(box, in_fh):
     """Reads the number of audio channels from AAC's AudioSpecificConfig
        descriptor within the esds child box of the input mp4a or wave box.
     """
-    p = in_fh.tell()
-    if box.name not in [mpeg.constants.TAG_MP4A, mpeg.constants.TAG_WAVE]:
-        return -1
+    return mpeg.track.aac_num_channels(box, in_fh)
 
-    for element in box.contents:
-        if element.name == mpeg.constants.TAG_WAVE:
-            # Handle .mov with AAC audio, where the structure is:
-            #     stsd -> mp4a -> wave -> esds
-            channel_configuration = get_aac_num_channels(element, in_fh)
-            break
 
-        if element.name != mpeg.constants.TAG_ESDS:
-          continue
-        in_fh.seek(element.content_start() + 4)
-        descriptor_tag = struct.unpack(">c", in_fh.read(1))[0]
-
-        # Verify the read descriptor is an elementary stream descriptor
-        if ord(descriptor_tag) != 3:  # Not an MP4 elementary stream.
-            print("Error: failed to read elementary stream descriptor.")
-            return -1
-        get_descriptor_length(in_fh)
-        in_fh.seek(3, 1)  # Seek to the decoder configuration descriptor
-        config_descriptor_tag = struct.unpack(">c", in_fh.read(1))[0]
-
-        # Verify the read descriptor is a decoder config. descriptor.
-        if ord(config_descriptor_tag) != 4:
-            print("Error: failed to read decoder config. descriptor.")
-            return -1
-        get_descriptor_length(in_fh)
-        in_fh.seek(13, 1) # offset to the decoder specific config descriptor.
-        decoder_specific_descriptor_tag = struct.unpack(">c", in_fh.read(1))[0]
-
-        # Verify the read descriptor is a decoder specific info descriptor
-        if ord(decoder_specific_descriptor_tag) != 5:
-            print("Error: failed to read MP4 audio decoder specific config.")
-            return -1
-        audio_specific_descriptor_size = get_descriptor_length(in_fh)
-        assert audio_specific_descriptor_size >= 2
-        decoder_descriptor = struct.unpack(">h", in_fh.read(2))[0]
-        object_type = (int("F800", 16) & decoder_descriptor) >> 11
-        sampling_frequency_index = (int("0780", 16) & decoder_descriptor) >> 7
-        if sampling_frequency_index == 0:
-            # TODO: If the sample rate is 96kHz an additional 24 bit offset
-            # value here specifies the actual sample rate.
-            print("Error: Greater than 48khz audio is currently not supported.")
-            return -1
-        channel_configuration = (int("0078", 16) & decoder_descriptor) >> 3
-    in_fh.seek(p)
-    return channel_configuration
+def get_tracks(mpeg4_file, in_fh):
+    """Returns the track index of an mpeg4 file, indexing it if needed."""
+    if mpeg4_file.tracks is None:
+        mpeg4_file.index_tracks(in_fh)
+    return mpeg4_file.tracks
 
 
 def get_num_audio_tracks(mpeg4_file, in_fh):
     """ Returns the number of audio track in the input mpeg4 file. """
     num_audio_tracks = 0
-    for element in mpeg4_file.moov_box.contents:
-        if (element.name == mpeg.constants.TAG_TRAK):
-            for sub_element in element.contents:
-                if (sub_element.name != mpeg.constants.TAG_MDIA):
-                    continue
-                for mdia_sub_element in sub_element.contents:
-                    if (mdia_sub_element.name != mpeg.constants.TAG_HDLR):
-                        continue
-                    position = mdia_sub_element.content_start() + 8
-                    in_fh.seek(position)
-                    if (in_fh.read(4) == mpeg.constants.TAG_SOUN):
-                        num_audio_tracks += 1
+    for track in get_tracks(mpeg4_file, in_fh):
+        if track.is_audio():
+            num_audio_tracks += 1
     return num_audio_tracks
 
 
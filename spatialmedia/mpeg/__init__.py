@@ -19,13 +19,31 @@ import spatialmedia.mpeg.sa3d
 import spatialmedia.mpeg.box
 import spatialmedia.mpeg.constants
 import spatialmedia.mpeg.container
+import spatialmedia.mpeg.fragment
+import spatialmedia.mpeg.instrumentation
+import spatialmedia.mpeg.mesh
 import spatialmedia.mpeg.mpeg4_container
+import spatialmedia.mpeg.probe
+import spatialmedia.mpeg.sample_table
+import spatialmedia.mpeg.schema
+import spatialmedia.mpeg.stream
+import spatialmedia.mpeg.sv3d
+import spatialmedia.mpeg.track
 
 load = mpeg4_container.load
+load_mmap = mpeg4_container.load_mmap
 
 Box = box.Box
 SA3DBox = sa3d.SA3DBox
+FragmentBox = fragment.FragmentBox
+ST3DBox = sv3d.ST3DBox
+MSHPBox = sv3d.MSHPBox
+Mesh = mesh.Mesh
 Container = container.Container
 Mpeg4Container = mpeg4_container.Mpeg4Container
+Track = track.Track
+SampleTable = sample_table.SampleTable
 
-__all__ = ["box", "mpeg4", "container", "constants", "sa3d"]
+__all__ = ["box", "mpeg4", "container", "constants", "fragment", "sa3d",
+           "probe", "stream", "instrumentation", "track", "sv3d",
+           "mesh", "schema", "sample_table"]
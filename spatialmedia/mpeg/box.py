@@ -21,9 +21,39 @@ Tool for loading mpeg4 files and manipulating atoms.
 """
 
 import io
+import os
+import stat
 import struct
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import instrumentation
+
+# NumPy types matching the bit packing modes of index entries.
+INDEX_DTYPES = {">I": ">u4", ">Q": ">u8"}
+
+# On 32-bit systems reading / writing is limited to 2GB chunks.
+# To prevent overflow, copy 64 MB chunks.
+COPY_BLOCK_SIZE = 64 * 1024 * 1024
+
+# Copies smaller than this are not worth flushing the output for.
+KERNEL_COPY_MIN_SIZE = 1024 * 1024
+
+# Largest block of zeros written at once for free boxes.
+ZERO_BLOCK_SIZE = 1024 * 1024
+
+# Linux ioctl cloning a block aligned range between files (reflink).
+FICLONERANGE = 0x4020940d
 
 def load(fh, position, end):
     """Loads the box located at a position in a mp4 file.
@@ -65,6 +95,48 @@ def load(fh, position, end):
     return new_box
 
 
+def load_buffer(buf, position, end, base=0):
+    """Loads the box located at a position in a buffer holding a mp4 file.
+
+    Args:
+      buf: buffer, file contents starting at file position base.
+      position: int, file position of the box.
+      end: int, file position the box must not extend beyond.
+      base: int, file position of the first byte in buf.
+
+    Returns:
+      box: box, box from loaded buffer location or None.
+    """
+    offset = position - base
+    if offset + 8 > len(buf):
+        print("Error: box header at {} exceeds buffer.".format(position))
+        return None
+
+    header_size = 8
+    size, name = struct.unpack_from(">I4s", buf, offset)
+
+    if size == 1:
+        size = struct.unpack_from(">Q", buf, offset + 8)[0]
+        header_size = 16
+
+    if size < 8:
+        print("Error, invalid size {} in {} at {}".format(size, name, position))
+        return None
+
+    if (position + size) > end:
+        print("Error: Leaf box size exceeds bounds.")
+        return None
+
+    new_box = Box()
+    new_box.name = name
+    new_box.position = position
+    new_box.header_size = header_size
+    new_box.content_size = size - header_size
+    new_box.contents = None
+
+    return new_box
+
+
 class Box(object):
     """MPEG4 box contents and behaviour true for all boxes."""
 
@@ -74,6 +146,7 @@ class Box(object):
         self.header_size = 0
         self.content_size = 0
         self.contents = None
+        self.parent = None
 
     def content_start(self):
         return self.position + self.header_size
@@ -86,13 +159,7 @@ class Box(object):
           out_fh: file handle, destination for written box contents.
           delta: int, index update amount.
         """
-        if self.header_size == 16:
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(self.name)
-            out_fh.write(struct.pack(">Q", self.size()))
-        elif self.header_size == 8:
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name)
+        self.save_header(out_fh)
 
         if self.content_start():
             in_fh.seek(self.content_start())
@@ -106,10 +173,42 @@ class Box(object):
         else:
             tag_copy(in_fh, out_fh, self.content_size)
 
+    def save_header(self, out_fh):
+        """Writes the box header.
+
+        Args:
+          out_fh: file handle, destination for the box header.
+        """
+        if self.header_size == 16:
+            out_fh.write(struct.pack(">I", 1))
+            out_fh.write(self.name)
+            out_fh.write(struct.pack(">Q", self.size()))
+        elif self.header_size == 8:
+            out_fh.write(struct.pack(">I", self.size()))
+            out_fh.write(self.name)
+
     def set(self, new_contents):
-        """Sets / overwrites the box contents."""
+        """Sets / overwrites the box contents, resizing containing boxes."""
+        size_change = len(new_contents) - self.content_size
         self.contents = new_contents
-        self.content_size = len(contents)
+        self.content_size = len(new_contents)
+        self.changed(size_change)
+
+    def changed(self, size_change=0):
+        """Marks the containing boxes as modified.
+
+        Walks up the parent boxes only, so the cost depends on the depth of
+        the box rather than on the size of the tree.
+
+        Args:
+          size_change: int, change of the size of this box, added to the
+            sizes of the containing boxes.
+        """
+        parent = self.parent
+        while parent is not None:
+            parent.content_size += size_change
+            parent.modified = True
+            parent = parent.parent
 
     def size(self):
         """Total size of a box.
@@ -126,30 +225,238 @@ class Box(object):
         print("{0} {1} [{2}, {3}]".format(indent, self.name, size1, size2))
 
 
+class FreeBox(Box):
+    """Free box created in memory, saved as its header followed by zeros."""
+
+    def save(self, in_fh, out_fh, delta):
+        """Saves the box header and zeroed contents.
+
+        Args:
+          in_fh: file handle, unused as the contents are zeros.
+          out_fh: file handle, destination for written box contents.
+          delta: int, unused.
+        """
+        self.save_header(out_fh)
+        zeros = bytes(min(self.content_size, ZERO_BLOCK_SIZE))
+        size = self.content_size
+        while size > 0:
+            out_fh.write(zeros[:min(size, len(zeros))])
+            size -= len(zeros)
+
+
+def free_box(size):
+    """Creates a free box spanning size bytes including its header.
+
+    Args:
+      size: int, total size of the box in bytes, at least 8.
+
+    Returns:
+      box: FreeBox, free box with a header large enough to hold size.
+    """
+    new_box = FreeBox()
+    new_box.name = constants.TAG_FREE
+    new_box.header_size = 8 if size <= 0xFFFFFFFF else 16
+    new_box.content_size = size - new_box.header_size
+    return new_box
+
+
 def tag_copy(in_fh, out_fh, size):
     """Copies a block of data from in_fh to out_fh.
 
+    Large copies between regular files are left to the kernel, see
+    kernel_copy. Anything else is copied through a single reused buffer.
+
+    Args:
+      in_fh: file handle, source of uncached file contents.
+      out_fh: file handle, destination for saved file.
+      size: int, amount of data to copy.
+    """
+    instrumentation.add("bytes_copied", size)
+    if size >= KERNEL_COPY_MIN_SIZE:
+        size -= kernel_copy(in_fh, out_fh, size)
+
+    block_size = min(size, COPY_BLOCK_SIZE)
+    view = memoryview(bytearray(block_size))
+    while size > 0:
+        count = in_fh.readinto(view[:min(size, block_size)])
+        if not count:
+            break
+        out_fh.write(view[:count])
+        size -= count
+
+
+def kernel_copy(in_fh, out_fh, size):
+    """Copies data between regular files without passing it through Python.
+
+    Whole filesystem blocks are cloned first when both files live on a
+    filesystem supporting reflinks (btrfs, XFS), the rest is copied with
+    copy_file_range or sendfile. Both file handles are left positioned
+    after the copied data.
+
     Args:
       in_fh: file handle, source of uncached file contents.
       out_fh: file handle, destination for saved file.
       size: int, amount of data to copy.
+
+    Returns:
+      Int, amount of data copied, which is 0 when no method is supported.
+    """
+    out_fd = regular_file_descriptor(out_fh)
+    in_fd = regular_file_descriptor(in_fh)
+    if out_fd is None or in_fd is None:
+        return 0
+
+    out_fh.flush()
+    in_position = in_fh.tell()
+    out_position = out_fh.tell()
+    copied = 0
+    for copy in (clone_copy, range_copy, send_copy):
+        copied += copy(in_fd, out_fd, in_position + copied,
+                       out_position + copied, size - copied)
+        if copied == size:
+            break
+
+    in_fh.seek(in_position + copied)
+    out_fh.seek(out_position + copied)
+    instrumentation.add("kernel_bytes_copied", copied)
+    instrumentation.add("bytes_read", copied)
+    instrumentation.add("bytes_written", copied)
+    return copied
+
+
+def regular_file_descriptor(fh):
+    """Returns the descriptor of a file handle of a regular file or None.
+
+    Spooled temporary files have no descriptor until written to disk, which
+    asking for it would do, so None is returned for them.
     """
+    if isinstance(fh, tempfile.SpooledTemporaryFile):
+        return None
+    try:
+        fd = fh.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    return fd
+
+
+def clone_copy(in_fd, out_fd, in_position, out_position, size):
+    """Clones the whole filesystem blocks of a copy with FICLONERANGE.
+
+    Returns:
+      Int, amount of data cloned.
+    """
+    if fcntl is None:
+        return 0
+    block_size = os.fstat(out_fd).st_blksize
+    if (block_size <= 0 or in_position % block_size or
+            out_position % block_size):
+        return 0
+
+    length = size - size % block_size
+    if length == 0:
+        return 0
+    try:
+        fcntl.ioctl(out_fd, FICLONERANGE, struct.pack(
+            "=qQQQ", in_fd, in_position, length, out_position))
+    except (OSError, ValueError):
+        return 0
+    return length
+
+
+def range_copy(in_fd, out_fd, in_position, out_position, size):
+    """Copies data with copy_file_range.
+
+    Returns:
+      Int, amount of data copied.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return 0
+
+    copied = 0
+    while copied < size:
+        try:
+            count = os.copy_file_range(
+                in_fd, out_fd, min(size - copied, COPY_BLOCK_SIZE),
+                in_position + copied, out_position + copied)
+        except OSError:
+            break
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+
+def send_copy(in_fd, out_fd, in_position, out_position, size):
+    """Copies data with sendfile, which writes at the output position.
 
-    # On 32-bit systems reading / writing is limited to 2GB chunks.
-    # To prevent overflow, read/write 64 MB chunks.
-    block_size = 64 * 1024 * 1024
-    while (size > block_size):
-        contents = in_fh.read(block_size)
-        out_fh.write(contents)
-        size = size - block_size
+    Returns:
+      Int, amount of data copied.
+    """
+    if not hasattr(os, "sendfile"):
+        return 0
+
+    os.lseek(out_fd, out_position, os.SEEK_SET)
+    copied = 0
+    while copied < size:
+        try:
+            count = os.sendfile(out_fd, in_fd, in_position + copied,
+                                min(size - copied, COPY_BLOCK_SIZE))
+        except OSError:
+            break
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+
+class CheckpointFile(object):
+    """Input file handle wrapper reading in chunks with a checkpoint between.
+
+    The wrapper has no fileno, so tag_copy copies through Python in chunks of
+    at most chunk_size bytes instead of leaving the copy to the kernel. The
+    checkpoint may raise to abort a long copy.
+    """
 
-    contents = in_fh.read(size)
-    out_fh.write(contents)
+    def __init__(self, fh, checkpoint, chunk_size):
+        self.fh = fh
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.chunk_size:
+            contents = bytearray()
+            while size < 0 or len(contents) < size:
+                chunk_size = self.chunk_size
+                if size >= 0:
+                    chunk_size = min(chunk_size, size - len(contents))
+                chunk = self.read(chunk_size)
+                if not chunk:
+                    break
+                contents += chunk
+            return bytes(contents)
+        self.checkpoint(size)
+        return self.fh.read(size)
+
+    def readinto(self, buf):
+        view = memoryview(buf)[:self.chunk_size]
+        self.checkpoint(len(view))
+        return self.fh.readinto(view)
+
+    def seek(self, offset, whence=0):
+        return self.fh.seek(offset, whence)
+
+    def tell(self):
+        return self.fh.tell()
 
 
 def index_copy(in_fh, out_fh, box, mode, mode_length, delta=0):
     """Update and copy index table for stco/co64 files.
 
+    The table is read with a single read and all entries are shifted at
+    once by shift_offsets.
+
     Args:
       in_fh: file handle, source to read index table from.
       out_fh: file handle, destination for index file.
@@ -158,23 +465,127 @@ def index_copy(in_fh, out_fh, box, mode, mode_length, delta=0):
       mode_length: int, number of bytes for index entires.
       delta: int, offset change for index entries.
     """
-    fh = in_fh
+    contents = read_index(in_fh, box)
+    values = struct.unpack_from(">I", contents, 4)[0]
+    table_end = 8 + values * mode_length
+    instrumentation.add("index_entries_rewritten", values)
+
+    out_fh.write(contents[:8])
+    out_fh.write(shift_offsets(contents[8:table_end], mode, delta))
+    out_fh.write(contents[table_end:])
+
+
+def read_index(in_fh, box):
+    """Reads the contents of a stco/co64 box with a single read.
+
+    Args:
+      in_fh: file handle, source to read index table from.
+      box: box, stco/co64 box to read.
+
+    Returns:
+      Memoryview, box contents including the version and entry count.
+    """
     if not box.contents:
-        fh.seek(box.content_start())
+        in_fh.seek(box.content_start())
+        return memoryview(in_fh.read(box.content_size))
+    return memoryview(box.contents)
+
+
+def index_max(in_fh, box, mode):
+    """Returns the largest entry of a stco/co64 index table.
+
+    Args:
+      in_fh: file handle, source to read index table from.
+      box: box, stco/co64 box to read.
+      mode: string, bit packing mode for index entries.
+
+    Returns:
+      Int, largest index entry or 0 for an empty table.
+    """
+    contents = read_index(in_fh, box)
+    values = struct.unpack_from(">I", contents, 4)[0]
+    if values == 0:
+        return 0
+
+    if numpy is not None:
+        return int(numpy.frombuffer(
+            contents, dtype=INDEX_DTYPES[mode], count=values, offset=8).max())
+    return max(struct.unpack_from(">{}{}".format(values, mode[1:]),
+                                  contents, 8))
+
+
+def stco_to_co64(in_fh, box):
+    """Converts a stco box into a co64 box holding the same offsets.
+
+    The converted index table is kept in memory as the box contents.
+
+    Args:
+      in_fh: file handle, source to read index table from.
+      box: box, stco box to convert.
+    """
+    contents = read_index(in_fh, box)
+    values = struct.unpack_from(">I", contents, 4)[0]
+    table = contents[8:8 + values * 4]
+    instrumentation.add("index_entries_promoted", values)
+
+    if numpy is not None:
+        offsets = numpy.frombuffer(table, dtype=INDEX_DTYPES[">I"])
+        offsets = offsets.astype(INDEX_DTYPES[">Q"]).tobytes()
     else:
-        fh = io.BytesIO(box.contents)
-
-    header = struct.unpack(">I", fh.read(4))[0]
-    values = struct.unpack(">I", fh.read(4))[0]
-
-    new_contents = []
-    new_contents.append(struct.pack(">I", header))
-    new_contents.append(struct.pack(">I", values))
-    for i in range(values):
-        content = fh.read(mode_length)
-        content = struct.unpack(mode, content)[0] + delta
-        new_contents.append(struct.pack(mode, content))
-    out_fh.write(b"".join(new_contents))
+        offsets = struct.pack(">{}Q".format(values),
+                              *struct.unpack(">{}I".format(values), table))
+
+    box.name = constants.TAG_CO64
+    box.set(bytes(contents[:8]) + offsets)
+
+
+def shift_offsets(table, mode, delta):
+    """Adds delta to every entry of a packed index table.
+
+    Uses NumPy when it is available and falls back to struct otherwise.
+
+    Args:
+      table: bytes-like, packed index entries.
+      mode: string, bit packing mode for index entries, ">I" or ">Q".
+      delta: int, offset change for index entries.
+
+    Returns:
+      Bytes, the updated index entries packed with mode.
+
+    Raises:
+      OverflowError: an updated entry does not fit in mode.
+    """
+    if delta == 0:
+        return bytes(table)
+
+    mode_length = struct.calcsize(mode)
+    count = len(table) // mode_length
+    limit = (1 << (8 * mode_length)) - 1
+
+    if numpy is not None:
+        offsets = numpy.frombuffer(
+            table, dtype=INDEX_DTYPES[mode], count=count).astype(numpy.uint64)
+        if count > 0:
+            if delta > 0 and int(offsets.max()) > limit - delta:
+                raise OverflowError(
+                    "Index entry exceeds {} bytes.".format(mode_length))
+            if delta < 0 and int(offsets.min()) < -delta:
+                raise OverflowError("Index entry below zero.")
+        if delta > 0:
+            offsets += numpy.uint64(delta)
+        else:
+            offsets -= numpy.uint64(-delta)
+        return offsets.astype(INDEX_DTYPES[mode]).tobytes()
+
+    table_mode = ">{}{}".format(count, mode[1:])
+    offsets = [offset + delta for offset in struct.unpack(table_mode, table)]
+    if count > 0:
+        if max(offsets) > limit:
+            raise OverflowError(
+                "Index entry exceeds {} bytes.".format(mode_length))
+        if min(offsets) < 0:
+            raise OverflowError("Index entry below zero.")
+    return struct.pack(table_mode, *offsets)
 
 
 def stco_copy(in_fh, out_fh, box, delta=0):
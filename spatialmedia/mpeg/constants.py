@@ -26,10 +26,35 @@ TAG_FREE = b"free"
 TAG_MDAT = b"mdat"
 TAG_XML = b"xml "
 TAG_HDLR = b"hdlr"
+TAG_MVHD = b"mvhd"
+TAG_TKHD = b"tkhd"
+TAG_MDHD = b"mdhd"
 TAG_FTYP = b"ftyp"
 TAG_ESDS = b"esds"
 TAG_SOUN = b"soun"
 TAG_SA3D = b"SA3D"
+TAG_TFHD = b"tfhd"
+TAG_TFRA = b"tfra"
+TAG_SIDX = b"sidx"
+TAG_CLAP = b"clap"
+TAG_PASP = b"pasp"
+
+# Sample table leaf types.
+TAG_STSZ = b"stsz"
+TAG_STZ2 = b"stz2"
+TAG_STSC = b"stsc"
+TAG_STTS = b"stts"
+TAG_CTTS = b"ctts"
+TAG_STSS = b"stss"
+
+# Spherical video V2 leaf types, see docs/spherical-video-v2-rfc.md.
+TAG_ST3D = b"st3d"
+TAG_SVHD = b"svhd"
+TAG_PRHD = b"prhd"
+TAG_EQUI = b"equi"
+TAG_CBMP = b"cbmp"
+TAG_MSHP = b"mshp"
+TAG_MESH = b"mesh"
 
 # Container types.
 TAG_MOOV = b"moov"
@@ -42,6 +67,14 @@ TAG_STBL = b"stbl"
 TAG_STSD = b"stsd"
 TAG_UUID = b"uuid"
 TAG_WAVE = b"wave"
+TAG_MVEX = b"mvex"
+TAG_TRAF = b"traf"
+TAG_SV3D = b"sv3d"
+TAG_PROJ = b"proj"
+
+# Fragment types, loaded as leaves and parsed on demand.
+TAG_MOOF = b"moof"
+TAG_MFRA = b"mfra"
 
 # Sound sample descriptions.
 TAG_NONE = b"NONE"
@@ -72,13 +105,64 @@ SOUND_SAMPLE_DESCRIPTIONS = frozenset([
     TAG_MP4A,
     ])
 
+# Visual sample descriptions, holding the spherical video V2 boxes.
+VISUAL_SAMPLE_DESCRIPTIONS = frozenset([
+    b"avc1",
+    b"avc3",
+    b"hvc1",
+    b"hev1",
+    b"mp4v",
+    b"vp08",
+    b"vp09",
+    b"av01",
+    b"dvh1",
+    b"dvhe",
+    b"encv",
+    b"apcn",
+    b"apch",
+    b"apcs",
+    b"apco",
+    b"ap4h",
+    b"ap4x",
+    ])
+
+# Size of the visual sample description fields preceding its child boxes.
+VISUAL_SAMPLE_DESCRIPTION_SIZE = 78
+
 CONTAINERS_LIST = frozenset([
     TAG_MDIA,
     TAG_MINF,
     TAG_MOOV,
+    TAG_MVEX,
+    TAG_PROJ,
     TAG_STBL,
     TAG_STSD,
+    TAG_SV3D,
+    TAG_TRAF,
     TAG_TRAK,
     TAG_UDTA,
     TAG_WAVE,
-    ]).union(SOUND_SAMPLE_DESCRIPTIONS)
+    ]).union(SOUND_SAMPLE_DESCRIPTIONS).union(VISUAL_SAMPLE_DESCRIPTIONS)
+
+# Boxes decoded by the spherical video V2 box classes.
+SPHERICAL_V2_BOXES = frozenset([
+    TAG_ST3D,
+    TAG_SVHD,
+    TAG_PRHD,
+    TAG_EQUI,
+    TAG_CBMP,
+    TAG_MSHP,
+    ])
+
+# Boxes holding file offsets of movie fragments.
+FRAGMENT_BOXES = frozenset([
+    TAG_MOOF,
+    TAG_MFRA,
+    TAG_SIDX,
+    ])
+
+# Boxes holding file offsets, rewritten when the media data moves.
+OFFSET_BOXES = frozenset([
+    TAG_STCO,
+    TAG_CO64,
+    ]).union(FRAGMENT_BOXES)
@@ -20,13 +20,21 @@
 Functions for loading MPEG files and manipulating boxes.
 """
 
+import collections
 import struct
 
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import fragment
+from spatialmedia.mpeg import instrumentation
 from spatialmedia.mpeg import sa3d
+from spatialmedia.mpeg import sv3d
+
+# Boxes removed by Container.remove_all and their total size in bytes.
+Removed = collections.namedtuple("Removed", "boxes size")
 
 def load(fh, position, end):
+    instrumentation.add("boxes_parsed")
     if position is None:
         position = fh.tell()
 
@@ -42,6 +50,10 @@ def load(fh, position, end):
     if is_box:
         if name == constants.TAG_SA3D:
             return sa3d.load(fh, position, end)
+        if name in constants.FRAGMENT_BOXES:
+            return fragment.load(fh, position, end)
+        if name in constants.SPHERICAL_V2_BOXES:
+            return sv3d.load(fh, position, end)
         return box.load(fh, position, end)
 
     if size == 1:
@@ -64,16 +76,13 @@ def load(fh, position, end):
         fh.seek(current_pos + 8)
         sample_description_version = struct.unpack(">h", fh.read(2))[0]
         fh.seek(current_pos)
-
-        if sample_description_version == 0:
-            padding = 28
-        elif sample_description_version == 1:
-            padding = 28 + 16
-        elif sample_description_version == 2:
-            padding = 64
-        else:
-            print("Unsupported sample description version:",
-                  sample_description_version)
+        padding = sample_description_padding(sample_description_version)
+    if name in constants.VISUAL_SAMPLE_DESCRIPTIONS:
+        padding = constants.VISUAL_SAMPLE_DESCRIPTION_SIZE
+        fh.seek(position + header_size)
+        contents = fh.read(size - header_size)
+        if not boxes_fit(contents, padding, size - header_size):
+            return box.load(fh, position, end)
 
     new_box = Container()
     new_box.name = name
@@ -81,12 +90,15 @@ def load(fh, position, end):
     new_box.header_size = header_size
     new_box.content_size = size - header_size
     new_box.padding = padding
+    new_box.modified = False
     new_box.contents = load_multiple(
         fh, position + header_size + padding, position + size)
 
     if new_box.contents is None:
         return None
 
+    for element in new_box.contents:
+        element.parent = new_box
     return new_box
 
 
@@ -103,8 +115,190 @@ def load_multiple(fh, position=None, end=None):
     return loaded
 
 
+def load_buffer(buf, position, end, base=0):
+    """Loads the box located at a position in a buffer holding a mp4 file.
+
+    Box headers are decoded directly from the buffer, so an mmap of the file
+    can be parsed without issuing a system call per box.
+
+    Args:
+      buf: buffer, file contents starting at file position base.
+      position: int, file position of the box.
+      end: int, file position the box must not extend beyond.
+      base: int, file position of the first byte in buf.
+
+    Returns:
+      box: box, box or container from loaded buffer location or None.
+    """
+    instrumentation.add("boxes_parsed")
+    offset = position - base
+    if offset + 8 > len(buf):
+        print("Error: box header at", position, "exceeds buffer.")
+        return None
+
+    header_size = 8
+    size, name = struct.unpack_from(">I4s", buf, offset)
+
+    is_box = name not in constants.CONTAINERS_LIST
+    # Handle the mp4a decompressor setting (wave -> mp4a).
+    if name == constants.TAG_MP4A and size == 12:
+        is_box = True
+    if is_box:
+        if name == constants.TAG_SA3D:
+            return sa3d.load_buffer(buf, position, end, base)
+        if name in constants.FRAGMENT_BOXES:
+            return fragment.load_buffer(buf, position, end, base)
+        if name in constants.SPHERICAL_V2_BOXES:
+            return sv3d.load_buffer(buf, position, end, base)
+        return box.load_buffer(buf, position, end, base)
+
+    if size == 1:
+        size = struct.unpack_from(">Q", buf, offset + 8)[0]
+        header_size = 16
+
+    if size < 8:
+        print("Error, invalid size", size, "in", name, "at", position)
+        return None
+
+    if (position + size) > end:
+        print("Error: Container box size exceeds bounds.")
+        return None
+
+    padding = 0
+    if name == constants.TAG_STSD:
+        padding = 8
+    if name in constants.SOUND_SAMPLE_DESCRIPTIONS:
+        sample_description_version = struct.unpack_from(
+            ">h", buf, offset + header_size + 8)[0]
+        padding = sample_description_padding(sample_description_version)
+    if name in constants.VISUAL_SAMPLE_DESCRIPTIONS:
+        padding = constants.VISUAL_SAMPLE_DESCRIPTION_SIZE
+        if not boxes_fit(buf, offset + header_size + padding, offset + size):
+            return box.load_buffer(buf, position, end, base)
+
+    new_box = Container()
+    new_box.name = name
+    new_box.position = position
+    new_box.header_size = header_size
+    new_box.content_size = size - header_size
+    new_box.padding = padding
+    new_box.modified = False
+    new_box.contents = load_multiple_buffer(
+        buf, position + header_size + padding, position + size, base)
+
+    if new_box.contents is None:
+        return None
+
+    for element in new_box.contents:
+        element.parent = new_box
+    return new_box
+
+
+def load_multiple_buffer(buf, position, end, base=0):
+    loaded = list()
+    while (position < end):
+        new_box = load_buffer(buf, position, end, base)
+        if new_box is None:
+            print("Error, failed to load box.")
+            return None
+        loaded.append(new_box)
+        position = new_box.position + new_box.size()
+
+    return loaded
+
+
+def sample_description_padding(version):
+    """Returns the size of the fields preceding a sound sample description's
+    child boxes.
+
+    Args:
+      version: int, sound sample description version.
+
+    Returns:
+      Int, number of bytes to skip before the child boxes.
+    """
+    if version == 0:
+        return 28
+    elif version == 1:
+        return 28 + 16
+    elif version == 2:
+        return 64
+
+    print("Unsupported sample description version:", version)
+    return 0
+
+
+def boxes_fit(buf, offset, end):
+    """Returns whether box headers exactly tile buf[offset:end].
+
+    Visual sample descriptions may end with bytes other than boxes, such as
+    zero padding, in which case they are loaded as leaves.
+    """
+    if end > len(buf) or offset > end:
+        return False
+    while offset < end:
+        if offset + 8 > end:
+            return False
+        size = struct.unpack_from(">I", buf, offset)[0]
+        if size == 1:
+            if offset + 16 > end:
+                return False
+            size = struct.unpack_from(">Q", buf, offset + 8)[0]
+        if size < 8 or offset + size > end:
+            return False
+        offset += size
+    return True
+
+
+def parse_path(path):
+    """Splits a box path such as "trak/mdia/hdlr" into box names.
+
+    Args:
+      path: string or bytes, box names separated by "/", where "*" matches
+        any box.
+
+    Returns:
+      list of bytes box names, None for wildcards.
+    """
+    if isinstance(path, bytes):
+        path = path.decode("latin1")
+    names = list()
+    for name in path.split("/"):
+        if name == "*":
+            names.append(None)
+        elif len(name) == 4:
+            names.append(name.encode("latin1"))
+        else:
+            raise ValueError("invalid box name {!r} in path {!r}".format(
+                name, path))
+    return names
+
+
+def iter_path(element, names):
+    """Yields the boxes below element matching a parsed path, in order."""
+    if not names:
+        yield element
+        return
+    if not isinstance(element, Container):
+        return
+    if names[0] is None:
+        children = element.contents
+    else:
+        children = element.children(names[0])
+    for child in children:
+        for match in iter_path(child, names[1:]):
+            yield match
+
+
 class Container(box.Box):
-    """MPEG4 container box contents / behaviour."""
+    """MPEG4 container box contents / behaviour.
+
+    Sizes are kept up to date by add, append, remove and Box.set, which
+    mark the containers above the change as modified. Containers left
+    untouched since loading are skipped by resize and copied as they are by
+    save. Other changes to the contents must be followed by a call to
+    changed on the changed box and to resize.
+    """
 
     def __init__(self, padding=0):
         self.name = ""
@@ -113,9 +307,68 @@ class Container(box.Box):
         self.content_size = 0
         self.contents = list()
         self.padding = padding
+        self.parent = None
+        # Containers created in memory have no contents in the file.
+        self.modified = True
+        self.offset_boxes = None
+        self.child_index = None
+        self.indexed_contents = None
+
+    def index_current(self):
+        """Returns whether the child index matches the contents.
+
+        Appending to or deleting from contents directly is detected, other
+        changes to contents or to child names need invalidate_index.
+        """
+        return (self.child_index is not None and
+                self.indexed_contents is self.contents and
+                self.indexed_length == len(self.contents))
+
+    def invalidate_index(self):
+        """Discards the child index, which is rebuilt on the next lookup."""
+        self.child_index = None
+        self.indexed_contents = None
+
+    def children(self, name):
+        """Returns the list of child boxes named name, in order.
+
+        The list belongs to the child index and must not be modified.
+        """
+        if not self.index_current():
+            self.child_index = dict()
+            for element in self.contents:
+                self.child_index.setdefault(element.name, []).append(element)
+            self.indexed_contents = self.contents
+            self.indexed_length = len(self.contents)
+        return self.child_index.get(name, ())
+
+    def first(self, name):
+        """Returns the first child box named name or None."""
+        children = self.children(name)
+        if children:
+            return children[0]
+        return None
+
+    def find_all(self, path):
+        """Returns all boxes matching a path below this container.
+
+        Args:
+          path: string, box names separated by "/", where "*" matches any
+            box, e.g. "trak/mdia/minf/stbl/stsd/*".
+
+        Returns:
+          list of boxes, in file order.
+        """
+        return list(iter_path(self, parse_path(path)))
+
+    def find(self, path):
+        """Returns the first box matching a path, see find_all, or None."""
+        return next(iter_path(self, parse_path(path)), None)
 
     def resize(self):
-        """Recomputes the box size and recurses on contents."""
+        """Recomputes the box size and recurses on modified contents."""
+        if not self.modified:
+            return
         self.content_size = self.padding
         for element in self.contents:
             if isinstance(element, Container):
@@ -144,17 +397,82 @@ class Container(box.Box):
             element = self.contents[i]
             element.print_structure(next_indent)
 
+    def contents_changed(self, size_change):
+        """Marks this container and those above it as modified.
+
+        Args:
+          size_change: int, change of the size of the contents.
+        """
+        self.content_size += size_change
+        self.modified = True
+        self.changed(size_change)
+
     def remove(self, tag):
         """Removes a tag recursively from all containers."""
-        new_contents = []
-        self.content_size = 0
-        for element in self.contents:
-            if element.name != tag:
-                new_contents.append(element)
-                if isinstance(element, Container):
-                    element.remove(tag)
-                self.content_size += element.size()
-        self.contents = new_contents
+        return self.remove_all([tag])
+
+    def remove_all(self, match, path=None):
+        """Removes boxes recursively from all containers in a single pass.
+
+        Args:
+          match: collection of box names to remove, or a function taking a
+            box and returning whether to remove it.
+          path: string or None, limits the removal to the containers
+            matching a path, see find_all, and the containers within them.
+
+        Returns:
+          Removed, the list of removed boxes and their total size.
+
+        The track index of the containing mpeg4 file, if any, drops the
+        removed boxes.
+        """
+        if not callable(match):
+            if isinstance(match, (bytes, str)):
+                match = [match]
+            names = frozenset(
+                name if isinstance(name, bytes) else name.encode("latin1")
+                for name in match)
+            match = lambda element: element.name in names
+
+        removed = list()
+        scopes = [self] if path is None else self.find_all(path)
+        for scope in scopes:
+            if isinstance(scope, Container):
+                scope.remove_matching(match, removed)
+        if removed:
+            self.boxes_removed(removed)
+        return Removed(removed, sum(element.size() for element in removed))
+
+    def boxes_removed(self, removed):
+        """Notifies the containers above of boxes removed from within this
+        one, so the root can update indexes of its boxes.
+        """
+        if self.parent is not None:
+            self.parent.boxes_removed(removed)
+
+    def remove_matching(self, match, removed):
+        """Removes boxes for which match is true, appending them to removed.
+
+        The contents list is only rebuilt when a box is removed from it.
+        """
+        kept = None
+        removed_size = 0
+        for index, element in enumerate(self.contents):
+            if match(element):
+                if kept is None:
+                    kept = self.contents[:index]
+                element.parent = None
+                removed.append(element)
+                removed_size += element.size()
+                continue
+            if kept is not None:
+                kept.append(element)
+            if isinstance(element, Container):
+                element.remove_matching(match, removed)
+        if kept is not None:
+            self.contents = kept
+            self.invalidate_index()
+            self.contents_changed(-removed_size)
 
     def add(self, element):
         """Adds an element, merging with containers of the same type.
@@ -162,15 +480,32 @@ class Container(box.Box):
         Returns:
           Int, increased size of container.
         """
-        for content in self.contents:
-            if content.name == element.name:
-                if isinstance(content, container_leaf):
-                    return content.merge(element)
-                print("Error, cannot merge leafs.")
-                return False
+        content = self.first(element.name)
+        if content is not None:
+            if isinstance(content, Container):
+                return content.merge(element)
+            print("Error, cannot merge leafs.")
+            return False
+
+        self.append(element)
+        return True
+
+    def insert(self, index, element):
+        """Inserts an element before the child box at index."""
+        self.contents.insert(index, element)
+        self.invalidate_index()
+        element.parent = self
+        self.contents_changed(element.size())
 
+    def append(self, element):
+        """Appends an element, even if a box of the same type exists."""
+        indexed = self.index_current()
         self.contents.append(element)
-        return True
+        if indexed:
+            self.child_index.setdefault(element.name, []).append(element)
+            self.indexed_length += 1
+        element.parent = self
+        self.contents_changed(element.size())
 
     def merge(self, element):
         """Merges structure with container.
@@ -179,7 +514,7 @@ class Container(box.Box):
           Int, increased size of container.
         """
         assert(self.name == element.name)
-        assert(isinstance(element, container_box))
+        assert(isinstance(element, Container))
         for sub_element in element.contents:
             if not self.add(sub_element):
                 return False
@@ -194,13 +529,14 @@ class Container(box.Box):
           out_fh: file_hande, destination for saved file.
           delta: int, file change size for updating stco and co64 files.
         """
-        if self.header_size == 16:
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(self.name)
-            out_fh.write(struct.pack(">Q", self.size()))
-        elif self.header_size == 8:
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name)
+        if not self.modified and (delta == 0 or
+                                  not self.contains_offsets()):
+            # Untouched boxes are copied as they are in the file.
+            in_fh.seek(self.position)
+            box.tag_copy(in_fh, out_fh, self.size())
+            return
+
+        self.save_header(out_fh)
 
         if self.padding > 0:
             in_fh.seek(self.content_start())
@@ -208,3 +544,15 @@ class Container(box.Box):
 
         for element in self.contents:
             element.save(in_fh, out_fh, delta)
+
+    def contains_offsets(self):
+        """Returns whether any box within holds file offsets."""
+        if self.offset_boxes is None:
+            self.offset_boxes = False
+            for element in self.contents:
+                if (element.name in constants.OFFSET_BOXES or
+                        (isinstance(element, Container) and
+                         element.contains_offsets())):
+                    self.offset_boxes = True
+                    break
+        return self.offset_boxes
@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG4 movie fragment processing classes.
+
+Fragmented files describe their samples in moof boxes following moov and
+index the fragments from sidx and mfra boxes. These boxes are loaded as
+leaves, so files with thousands of fragments stay cheap to load, and are
+only parsed when they are saved with moved media data.
+"""
+
+import struct
+
+from spatialmedia.mpeg import box
+from spatialmedia.mpeg import constants
+
+# tfhd flag signalling an explicit, absolute base_data_offset.
+TFHD_BASE_DATA_OFFSET_PRESENT = 0x000001
+
+
+def load(fh, position, end):
+    """Loads the moof, mfra or sidx box located at position in a mp4 file.
+
+    Args:
+      fh: file handle, input file handle.
+      position: int or None, current file position.
+      end: int, file position the box must not extend beyond.
+
+    Returns:
+      new_box: box, fragment box from the file location or None.
+    """
+    return from_box(box.load(fh, position, end))
+
+
+def load_buffer(buf, position, end, base=0):
+    """Loads the moof, mfra or sidx box located at position in a buffer.
+
+    Args:
+      buf: buffer, file contents starting at file position base.
+      position: int, file position of the box.
+      end: int, file position the box must not extend beyond.
+      base: int, file position of the first byte in buf.
+
+    Returns:
+      new_box: box, fragment box from the buffer location or None.
+    """
+    return from_box(box.load_buffer(buf, position, end, base))
+
+
+def from_box(leaf):
+    if leaf is None:
+        return None
+
+    new_box = FragmentBox()
+    new_box.name = leaf.name
+    new_box.position = leaf.position
+    new_box.header_size = leaf.header_size
+    new_box.content_size = leaf.content_size
+    return new_box
+
+
+def child_boxes(contents, start, end):
+    """Returns the (name, content start, end) of boxes within contents."""
+    children = list()
+    while start + 8 <= end:
+        header_size = 8
+        size, name = struct.unpack_from(">I4s", contents, start)
+        if size == 1:
+            size = struct.unpack_from(">Q", contents, start + 8)[0]
+            header_size = 16
+        if size < header_size or start + size > end:
+            print("Error, invalid size", size, "in", name, "at", start)
+            break
+        children.append((name, start + header_size, start + size))
+        start += size
+    return children
+
+
+def shift_offset(contents, offset, mode, delta):
+    """Adds delta to the file offset packed with mode at offset."""
+    value = struct.unpack_from(mode, contents, offset)[0] + delta
+    if value < 0 or value >= 1 << (8 * struct.calcsize(mode)):
+        raise OverflowError(
+            "Fragment offset {} does not fit {}.".format(value, mode))
+    struct.pack_into(mode, contents, offset, value)
+
+
+def shift_moof(contents, delta):
+    """Shifts the explicit base data offsets of a moof box's contents.
+
+    Sample data offsets in trun boxes are relative to the moof box or to
+    the base data offset, so they move along with the fragment.
+    """
+    for name, start, end in child_boxes(contents, 0, len(contents)):
+        if name != constants.TAG_TRAF:
+            continue
+        for child_name, child_start, _ in child_boxes(contents, start, end):
+            if child_name != constants.TAG_TFHD:
+                continue
+            flags = struct.unpack_from(">I", contents, child_start)[0]
+            if flags & TFHD_BASE_DATA_OFFSET_PRESENT:
+                shift_offset(contents, child_start + 8, ">Q", delta)
+
+
+def shift_mfra(contents, delta):
+    """Shifts the moof offsets of the tfra boxes within a mfra box."""
+    for name, start, _ in child_boxes(contents, 0, len(contents)):
+        if name != constants.TAG_TFRA:
+            continue
+        version = contents[start]
+        lengths, entries = struct.unpack_from(">II", contents, start + 8)
+        mode = ">Q" if version == 1 else ">I"
+        time_length = struct.calcsize(mode)
+        entry_length = (2 * time_length +
+                        ((lengths >> 4) & 3) + 1 +
+                        ((lengths >> 2) & 3) + 1 +
+                        (lengths & 3) + 1)
+        offset = start + 16 + time_length
+        for _ in range(entries):
+            shift_offset(contents, offset, mode, delta)
+            offset += entry_length
+
+
+def shift_sidx(contents, delta):
+    """Shifts the distance from a sidx box to the material it indexes."""
+    version = contents[0]
+    if version == 1:
+        shift_offset(contents, 20, ">Q", delta)
+    else:
+        shift_offset(contents, 16, ">I", delta)
+
+
+class FragmentBox(box.Box):
+    """MPEG4 moof, mfra or sidx box, holding offsets to movie fragments."""
+
+    def save(self, in_fh, out_fh, delta):
+        """Saves the box, updating file offsets when media data moved.
+
+        Args:
+          in_fh: file handle, source to read box contents from.
+          out_fh: file handle, destination for written box contents.
+          delta: int, change in position of the media data, or for sidx
+            boxes of the indexed material relative to the sidx box.
+        """
+        if delta == 0:
+            box.Box.save(self, in_fh, out_fh, delta)
+            return
+
+        in_fh.seek(self.content_start())
+        contents = bytearray(in_fh.read(self.content_size))
+        if self.name == constants.TAG_MOOF:
+            shift_moof(contents, delta)
+        elif self.name == constants.TAG_MFRA:
+            shift_mfra(contents, delta)
+        elif self.name == constants.TAG_SIDX:
+            shift_sidx(contents, delta)
+
+        self.save_header(out_fh)
+        out_fh.write(contents)
@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Structured instrumentation of loading, injecting and saving.
+
+Phases emit a start event and an end event carrying their duration and the
+counters accumulated while they ran, such as bytes read and written, seeks,
+boxes parsed and index entries rewritten. Counters are added to every phase
+active on the current thread, so outer phases include their inner phases.
+
+Events are dictionaries delivered to the sink set with set_sink. The default
+NullSink is disabled: phases and counters then return immediately and file
+handles are not wrapped.
+"""
+
+import collections
+import functools
+import json
+import threading
+import time
+
+PHASE_START = "phase_start"
+PHASE_END = "phase_end"
+
+
+class Sink(object):
+    """Receives instrumentation events."""
+
+    enabled = True
+
+    def emit(self, event):
+        """Receives an event, the base sink discards it."""
+        pass
+
+
+class NullSink(Sink):
+    """Discards events, disabling instrumentation."""
+
+    enabled = False
+
+
+class CallbackSink(Sink):
+    """Passes each event to a function."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, event):
+        self.callback(event)
+
+
+class JsonLinesSink(Sink):
+    """Writes each event as a line of JSON to a text file handle."""
+
+    def __init__(self, out_fh):
+        self.out_fh = out_fh
+        self.lock = threading.Lock()
+
+    def emit(self, event):
+        line = json.dumps(event) + "\n"
+        with self.lock:
+            self.out_fh.write(line)
+            self.out_fh.flush()
+
+
+sink = NullSink()
+
+local = threading.local()
+
+
+def set_sink(new_sink):
+    """Sets the sink receiving events, None disables instrumentation."""
+    global sink
+    sink = new_sink if new_sink is not None else NullSink()
+
+
+def active_phases():
+    phases = getattr(local, "phases", None)
+    if phases is None:
+        phases = local.phases = list()
+    return phases
+
+
+def add(counter, value=1):
+    """Adds value to a counter of the phases active on this thread."""
+    if not sink.enabled:
+        return
+    for active in active_phases():
+        active.counters[counter] += value
+
+
+class Phase(object):
+    """Context manager emitting the start and end events of a phase."""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.counters = collections.Counter()
+        self.active = False
+        self.start = 0
+
+    def event(self, kind):
+        event = collections.OrderedDict()
+        event["event"] = kind
+        event["phase"] = self.name
+        event["time"] = time.time()
+        event["thread"] = threading.current_thread().name
+        event.update(self.fields)
+        return event
+
+    def __enter__(self):
+        self.active = sink.enabled
+        if self.active:
+            sink.emit(self.event(PHASE_START))
+            active_phases().append(self)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if not self.active:
+            return False
+        duration = time.perf_counter() - self.start
+        phases = active_phases()
+        if self in phases:
+            phases.remove(self)
+        event = self.event(PHASE_END)
+        event["duration"] = duration
+        event["counters"] = dict(self.counters)
+        if exc_type is not None:
+            event["error"] = exc_type.__name__
+        sink.emit(event)
+        return False
+
+
+def phase(name, **fields):
+    """Returns a context manager instrumenting a phase.
+
+    Args:
+      name: string, phase name.
+      fields: JSON values added to the events of the phase, e.g. the file.
+    """
+    return Phase(name, fields)
+
+
+def instrumented(name):
+    """Decorator instrumenting every call of a function as a phase."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not sink.enabled:
+                return function(*args, **kwargs)
+            with Phase(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class InstrumentedFile(object):
+    """File handle wrapper counting bytes read and written and seeks.
+
+    The file number stays available, so copies left to the kernel still
+    apply; they are counted by box.kernel_copy.
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+
+    def read(self, size=-1):
+        contents = self.fh.read(size)
+        add("bytes_read", len(contents))
+        return contents
+
+    def readinto(self, buf):
+        count = self.fh.readinto(buf)
+        add("bytes_read", count or 0)
+        return count
+
+    def write(self, contents):
+        count = self.fh.write(contents)
+        add("bytes_written", len(contents) if count is None else count)
+        return count
+
+    def seek(self, offset, whence=0):
+        add("seeks")
+        return self.fh.seek(offset, whence)
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+
+def wrap(fh):
+    """Returns fh wrapped in an InstrumentedFile when instrumentation is on."""
+    if not sink.enabled:
+        return fh
+    return InstrumentedFile(fh)
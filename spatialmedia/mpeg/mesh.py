@@ -0,0 +1,525 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Projection meshes of the mesh projection (mshp) box.
+
+Encodes and decodes the mesh boxes held by mshp boxes, see
+docs/spherical-video-v2-rfc.md, and generates meshes for fisheye cameras, see
+docs/vr180.md. Coordinate and vertex index deltas are zig-zag coded and bit
+packed. Both are done on whole arrays with NumPy when it is available and
+with struct and strings otherwise.
+"""
+
+import collections
+import math
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from spatialmedia.mpeg import constants
+
+# Encodings of the mesh boxes within a mshp box.
+ENCODING_RAW = b"raw "
+ENCODING_DFL8 = b"dfl8"
+
+# Vertex list index types.
+TRIANGLES = 0
+TRIANGLE_STRIP = 1
+TRIANGLE_FAN = 2
+
+# Deflate compression level of mesh boxes. Level 1 compresses typical meshes
+# about 6% less than the zlib default in a third of the time.
+DEFLATE_LEVEL = 1
+
+# Number of Newton iterations solving the fisheye distortion polynomial.
+FISHEYE_ITERATIONS = 20
+
+VertexList = collections.namedtuple(
+    "VertexList", "texture_id index_type indices")
+
+COUNT = struct.Struct(">I")
+VERTEX_LIST_HEADER = struct.Struct(">BBI")
+
+
+class Mesh(object):
+    """Projection mesh of one eye.
+
+    Vertices are rows of 5 indices into coordinates, for x, y, z, u and v.
+    coordinates, vertices and the vertex list indices are NumPy arrays when
+    NumPy is available, lists otherwise.
+    """
+
+    def __init__(self, coordinates, vertices, vertex_lists):
+        self.coordinates = coordinates
+        self.vertices = vertices
+        self.vertex_lists = vertex_lists
+
+    def vertex_count(self):
+        return len(self.vertices)
+
+    def index_count(self):
+        return sum(len(vertex_list.indices)
+                   for vertex_list in self.vertex_lists)
+
+    def positions(self):
+        """Returns the (x, y, z, u, v) values of every vertex."""
+        if numpy is not None:
+            return numpy.asarray(self.coordinates)[
+                numpy.asarray(self.vertices)]
+        return [[self.coordinates[index] for index in vertex]
+                for vertex in self.vertices]
+
+
+def from_positions(positions, indices, index_type=TRIANGLES, texture_id=0):
+    """Returns a mesh sharing the coordinates of a list of vertices.
+
+    Args:
+      positions: sequence of (x, y, z, u, v) values of each vertex.
+      indices: sequence of vertex indices.
+      index_type: int, TRIANGLES, TRIANGLE_STRIP or TRIANGLE_FAN.
+      texture_id: int, 0 for the video frames of the track.
+
+    Returns:
+      Mesh, with a single vertex list.
+    """
+    if numpy is not None:
+        values = numpy.asarray(positions, dtype=">f4")
+        coordinates, vertices = numpy.unique(
+            values.ravel(), return_inverse=True)
+        vertices = vertices.reshape(values.shape).astype(numpy.int64)
+        indices = numpy.asarray(indices, dtype=numpy.int64).ravel()
+    else:
+        # Coordinates are stored as 32-bit floats, compare them as such.
+        values = [[float32(value) for value in vertex] for vertex in positions]
+        coordinates = sorted(set(value for vertex in values
+                                 for value in vertex))
+        coordinate_index = dict((value, index)
+                                for index, value in enumerate(coordinates))
+        vertices = [[coordinate_index[value] for value in vertex]
+                    for vertex in values]
+        indices = [int(index) for index in indices]
+    return Mesh(coordinates, vertices,
+                [VertexList(texture_id, index_type, indices)])
+
+
+def float32(value):
+    return struct.unpack(">f", struct.pack(">f", value))[0]
+
+
+def index_bits(count):
+    """Returns ceil(log2(count * 2)), the size of the index deltas."""
+    if count <= 0:
+        return 0
+    return (count * 2 - 1).bit_length()
+
+
+def zigzag_deltas(indices):
+    """Returns the zig-zag coded deltas of indices along the first axis."""
+    if numpy is not None:
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        deltas = numpy.diff(indices, axis=0,
+                            prepend=numpy.zeros_like(indices[:1]))
+        return (deltas << 1) ^ (deltas >> 63)
+
+    deltas = list()
+    previous = None
+    for row in indices:
+        values = row if isinstance(row, (list, tuple)) else [row]
+        if previous is None:
+            previous = [0] * len(values)
+        deltas.extend(2 * (value - last) if value >= last else
+                      2 * (last - value) - 1
+                      for value, last in zip(values, previous))
+        previous = values
+    return deltas
+
+
+def unzigzag_indices(values, width):
+    """Returns the indices whose zig-zag coded deltas are values.
+
+    Args:
+      values: sequence of zig-zag coded deltas, width per index.
+      width: int, number of interleaved index sequences, 5 for vertices.
+    """
+    if numpy is not None:
+        values = numpy.asarray(values, dtype=numpy.int64)
+        deltas = (values >> 1) ^ -(values & 1)
+        return numpy.cumsum(deltas.reshape(-1, width), axis=0)
+
+    indices = list()
+    previous = [0] * width
+    for start in range(0, len(values), width):
+        current = [last + (value >> 1 if value % 2 == 0 else
+                           -((value + 1) >> 1))
+                   for value, last in zip(values[start:start + width],
+                                          previous)]
+        indices.append(current)
+        previous = current
+    return indices
+
+
+def pack_bits(values, bits):
+    """Packs unsigned values of bits bits each, most significant bit first.
+
+    Returns:
+      bytes, padded with zero bits to a byte boundary.
+    """
+    if bits == 0 or len(values) == 0:
+        return b""
+    if numpy is not None:
+        # Index deltas fit in 32 bits, keep the low bits of each value.
+        values = numpy.asarray(values, dtype=">u4").ravel()
+        bit_array = numpy.unpackbits(values.view(numpy.uint8)).reshape(-1, 32)
+        return numpy.packbits(bit_array[:, 32 - bits:]).tobytes()
+
+    text = "".join(format(value, "0%db" % bits) for value in values)
+    text += "0" * (-len(text) % 8)
+    return int(text, 2).to_bytes(len(text) // 8, "big")
+
+
+def unpack_bits(buf, offset, count, bits):
+    """Unpacks count values of bits bits each, see pack_bits.
+
+    Returns:
+      (values, offset) where offset follows the padded values.
+
+    Raises:
+      ValueError: buf ends before the values.
+    """
+    size = (count * bits + 7) // 8
+    if offset + size > len(buf):
+        raise ValueError("mesh index table exceeds the mesh box")
+    if bits == 0:
+        values = [0] * count
+        if numpy is not None:
+            values = numpy.zeros(count, dtype=numpy.int64)
+        return values, offset
+
+    if numpy is not None:
+        bit_array = numpy.zeros((count, 32), dtype=numpy.uint8)
+        bit_array[:, 32 - bits:] = numpy.unpackbits(numpy.frombuffer(
+            buf, dtype=numpy.uint8, count=size, offset=offset))[
+                :count * bits].reshape(count, bits)
+        values = numpy.packbits(bit_array, axis=1).view(">u4").ravel()
+        return values.astype(numpy.int64), offset + size
+
+    text = format(int.from_bytes(bytes(buf[offset:offset + size]), "big"),
+                  "0%db" % (size * 8))
+    values = [int(text[start:start + bits], 2)
+              for start in range(0, count * bits, bits)]
+    return values, offset + size
+
+
+def encode(mesh):
+    """Returns the contents of the mesh box holding mesh."""
+    coordinate_count = len(mesh.coordinates)
+    vertex_count = len(mesh.vertices)
+    if numpy is not None:
+        coordinates = numpy.asarray(mesh.coordinates, dtype=">f4").tobytes()
+    else:
+        coordinates = struct.pack(">%df" % coordinate_count,
+                                  *mesh.coordinates)
+
+    contents = [COUNT.pack(coordinate_count), coordinates,
+                COUNT.pack(vertex_count),
+                pack_bits(zigzag_deltas(mesh.vertices),
+                          index_bits(coordinate_count)),
+                COUNT.pack(len(mesh.vertex_lists))]
+    vertex_bits = index_bits(vertex_count)
+    for vertex_list in mesh.vertex_lists:
+        contents.append(VERTEX_LIST_HEADER.pack(
+            vertex_list.texture_id, vertex_list.index_type,
+            len(vertex_list.indices)))
+        contents.append(pack_bits(zigzag_deltas(vertex_list.indices),
+                                  vertex_bits))
+    return b"".join(contents)
+
+
+def decode(buf, offset=0):
+    """Decodes the contents of a mesh box.
+
+    Args:
+      buf: bytes-like, holding the mesh box contents at offset.
+      offset: int, position of the contents in buf.
+
+    Returns:
+      Mesh.
+
+    Raises:
+      ValueError, struct.error: the contents are not a valid mesh.
+    """
+    coordinate_count = COUNT.unpack_from(buf, offset)[0] & 0x7FFFFFFF
+    offset += COUNT.size
+    if offset + coordinate_count * 4 > len(buf):
+        raise ValueError("mesh coordinates exceed the mesh box")
+    if numpy is not None:
+        coordinates = numpy.frombuffer(
+            buf, dtype=">f4", count=coordinate_count, offset=offset)
+    else:
+        coordinates = list(struct.unpack_from(
+            ">%df" % coordinate_count, buf, offset))
+    offset += coordinate_count * 4
+
+    vertex_count = COUNT.unpack_from(buf, offset)[0] & 0x7FFFFFFF
+    offset += COUNT.size
+    values, offset = unpack_bits(buf, offset, vertex_count * 5,
+                                 index_bits(coordinate_count))
+    vertices = unzigzag_indices(values, 5)
+
+    vertex_list_count = COUNT.unpack_from(buf, offset)[0] & 0x7FFFFFFF
+    offset += COUNT.size
+    vertex_bits = index_bits(vertex_count)
+    vertex_lists = list()
+    for i in range(vertex_list_count):
+        texture_id, index_type, index_count = \
+            VERTEX_LIST_HEADER.unpack_from(buf, offset)
+        offset += VERTEX_LIST_HEADER.size
+        values, offset = unpack_bits(buf, offset, index_count & 0x7FFFFFFF,
+                                     vertex_bits)
+        indices = unzigzag_indices(values, 1)
+        if numpy is not None:
+            indices = indices.ravel()
+        else:
+            indices = [row[0] for row in indices]
+        vertex_lists.append(VertexList(texture_id, index_type, indices))
+
+    return Mesh(coordinates, vertices, vertex_lists)
+
+
+def encode_meshes(meshes, encoding=ENCODING_DFL8, level=DEFLATE_LEVEL):
+    """Returns the mesh boxes of meshes, compressed with encoding.
+
+    Args:
+      meshes: list of Mesh, one, or the left and right eye meshes.
+      encoding: bytes, ENCODING_DFL8 or ENCODING_RAW.
+      level: int, deflate compression level.
+    """
+    boxes = list()
+    for mesh in meshes:
+        contents = encode(mesh)
+        boxes.append(struct.pack(">I4s", 8 + len(contents),
+                                 constants.TAG_MESH))
+        boxes.append(contents)
+    payload = b"".join(boxes)
+
+    if encoding == ENCODING_DFL8:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return compressor.compress(payload) + compressor.flush()
+    if encoding == ENCODING_RAW:
+        return payload
+    raise ValueError("unsupported mesh encoding {!r}".format(encoding))
+
+
+def decode_meshes(payload, encoding):
+    """Decodes the mesh boxes of a mshp box, ignoring other boxes.
+
+    Raises:
+      ValueError, struct.error, zlib.error: the payload is not valid.
+    """
+    if encoding == ENCODING_DFL8:
+        payload = zlib.decompress(bytes(payload), -15)
+    elif encoding != ENCODING_RAW:
+        raise ValueError("unsupported mesh encoding {!r}".format(encoding))
+
+    payload = memoryview(payload)
+    meshes = list()
+    offset = 0
+    while offset + 8 <= len(payload):
+        size, name = struct.unpack_from(">I4s", payload, offset)
+        if size < 8 or offset + size > len(payload):
+            raise ValueError("invalid box size {} in mesh projection".format(
+                size))
+        if name == constants.TAG_MESH:
+            meshes.append(decode(payload[:offset + size], offset + 8))
+        offset += size
+    return meshes
+
+
+def crc(encoding, payload):
+    """Returns the CRC32 of the mshp box bytes following its crc field."""
+    return zlib.crc32(payload, zlib.crc32(encoding)) & 0xFFFFFFFF
+
+
+class FisheyeCamera(object):
+    """Calibrated fisheye camera of one eye, see docs/vr180.md.
+
+    Points project with theta + d[0] * theta^3 + d[1] * theta^5 +
+    d[2] * theta^7 as their normalized distance to the principal point, where
+    theta is their angle to the optical axis and d the radial distortion.
+    """
+
+    def __init__(self, image_size, principal_point, focal_length,
+                 pixel_aspect_ratio=1.0, radial_distortion=(0, 0, 0),
+                 world_to_camera_rotation=None):
+        self.image_size = image_size
+        self.principal_point = principal_point
+        self.focal_length = focal_length
+        self.pixel_aspect_ratio = pixel_aspect_ratio
+        self.radial_distortion = radial_distortion
+        if world_to_camera_rotation is None:
+            world_to_camera_rotation = ((1, 0, 0), (0, 1, 0), (0, 0, 1))
+        self.world_to_camera_rotation = world_to_camera_rotation
+
+    def distortion(self, theta):
+        d = self.radial_distortion
+        theta2 = theta * theta
+        return theta * (1 + theta2 * (d[0] + theta2 * (d[1] + theta2 * d[2])))
+
+    def distortion_slope(self, theta):
+        d = self.radial_distortion
+        theta2 = theta * theta
+        return 1 + theta2 * (3 * d[0] + theta2 * (5 * d[1] +
+                                                   theta2 * 7 * d[2]))
+
+    def image_circle(self, theta=math.pi / 2):
+        """Returns the x and y radius of the image circle of 2 * theta."""
+        radius = self.distortion(theta) * self.focal_length
+        return radius, radius * self.pixel_aspect_ratio
+
+
+def demo_camera():
+    """Returns the example camera of the mesh generation demo."""
+    return FisheyeCamera((2160, 2160), (1080, 1080), 828, 1.2,
+                         (-0.032, -0.00243, 0.001))
+
+
+def fisheye_mesh(camera, grid_size_x=40, grid_size_y=40):
+    """Generates the mesh of a fisheye camera.
+
+    Vertices are laid on a grid covering the intersection of the 180 degree
+    image circle and the image, as in the demo of docs/vr180.md, and converted
+    to OpenGL coordinates.
+
+    Args:
+      camera: FisheyeCamera, calibrated camera of the eye.
+      grid_size_x, grid_size_y: int, number of vertices per row and column.
+
+    Returns:
+      Mesh, with a list of triangles.
+    """
+    if numpy is not None:
+        positions = fisheye_positions(camera, grid_size_x, grid_size_y)
+    else:
+        positions = [fisheye_position(camera, grid_size_x, grid_size_y, i, j)
+                     for j in range(grid_size_x)
+                     for i in range(grid_size_y)]
+    return from_positions(positions,
+                          grid_triangles(grid_size_x, grid_size_y))
+
+
+def grid_rows(camera, grid_size_y):
+    """Returns the first and last image y coordinates of the grid."""
+    radius_x, radius_y = camera.image_circle()
+    y_min = max(0, camera.principal_point[1] - radius_y)
+    y_max = min(camera.image_size[1], camera.principal_point[1] + radius_y)
+    return y_min, y_max
+
+
+def fisheye_positions(camera, grid_size_x, grid_size_y):
+    """Returns the (x, y, z, u, v) values of the grid, column by column."""
+    radius_x, radius_y = camera.image_circle()
+    y_min, y_max = grid_rows(camera, grid_size_y)
+    y = y_min + numpy.arange(grid_size_y) * (
+        (y_max - y_min) / float(max(grid_size_y - 1, 1)))
+    y_center = y - camera.principal_point[1]
+    x_radius = radius_x * numpy.sqrt(
+        numpy.clip(1 - y_center ** 2 / radius_y ** 2, 0, None))
+    x_min = numpy.maximum(0, camera.principal_point[0] - x_radius)
+    x_max = numpy.minimum(camera.image_size[0],
+                          camera.principal_point[0] + x_radius)
+
+    # Grid of (column, row), so vertex grid_size_y * j + i is row i of
+    # column j.
+    j = numpy.arange(grid_size_x)[:, None]
+    x = x_min + j * ((x_max - x_min) / float(max(grid_size_x - 1, 1)))
+    y = numpy.broadcast_to(y, x.shape)
+
+    xn = (x - camera.principal_point[0]) / camera.focal_length
+    yn = ((y - camera.principal_point[1]) / camera.focal_length /
+          camera.pixel_aspect_ratio)
+    rn = numpy.sqrt(xn * xn + yn * yn)
+    theta = rn.copy()
+    for iteration in range(FISHEYE_ITERATIONS):
+        theta -= ((camera.distortion(theta) - rn) /
+                  camera.distortion_slope(theta))
+    scale = numpy.divide(numpy.sin(theta), rn,
+                         out=numpy.zeros_like(rn), where=rn > 0)
+    points = numpy.stack([scale * xn, scale * yn, numpy.cos(theta)], axis=-1)
+    points = points.dot(numpy.asarray(camera.world_to_camera_rotation,
+                                      dtype=float))
+
+    positions = numpy.empty(x.shape + (5,))
+    positions[..., 0] = points[..., 0]
+    positions[..., 1] = -points[..., 1]
+    positions[..., 2] = -points[..., 2]
+    positions[..., 3] = x / camera.image_size[0]
+    positions[..., 4] = 1 - y / camera.image_size[1]
+    return positions.reshape(-1, 5)
+
+
+def fisheye_position(camera, grid_size_x, grid_size_y, i, j):
+    """Returns the (x, y, z, u, v) values of row i and column j."""
+    radius_x, radius_y = camera.image_circle()
+    y_min, y_max = grid_rows(camera, grid_size_y)
+    y = y_min + i * (y_max - y_min) / float(max(grid_size_y - 1, 1))
+    y_center = y - camera.principal_point[1]
+    x_radius = radius_x * math.sqrt(max(0, 1 - y_center ** 2 / radius_y ** 2))
+    x_min = max(0, camera.principal_point[0] - x_radius)
+    x_max = min(camera.image_size[0], camera.principal_point[0] + x_radius)
+    x = x_min + j * (x_max - x_min) / float(max(grid_size_x - 1, 1))
+
+    xn = (x - camera.principal_point[0]) / camera.focal_length
+    yn = ((y - camera.principal_point[1]) / camera.focal_length /
+          camera.pixel_aspect_ratio)
+    rn = math.sqrt(xn * xn + yn * yn)
+    theta = rn
+    for iteration in range(FISHEYE_ITERATIONS):
+        theta -= ((camera.distortion(theta) - rn) /
+                  camera.distortion_slope(theta))
+    scale = math.sin(theta) / rn if rn > 0 else 0
+    camera_point = (scale * xn, scale * yn, math.cos(theta))
+    rotation = camera.world_to_camera_rotation
+    point = [sum(rotation[k][axis] * camera_point[k] for k in range(3))
+             for axis in range(3)]
+    return (point[0], -point[1], -point[2],
+            x / camera.image_size[0], 1 - y / camera.image_size[1])
+
+
+def grid_triangles(grid_size_x, grid_size_y):
+    """Returns the indices of the triangles splitting each quad of the grid.
+    """
+    if numpy is not None:
+        i, j = numpy.meshgrid(numpy.arange(grid_size_y - 1),
+                              numpy.arange(grid_size_x - 1))
+        top_left = (grid_size_y * j + i).ravel()
+        top_right = top_left + grid_size_y
+        return numpy.stack([top_left, top_right, top_left + 1,
+                            top_left + 1, top_right, top_right + 1],
+                           axis=-1).ravel()
+
+    indices = list()
+    for j in range(grid_size_x - 1):
+        for i in range(grid_size_y - 1):
+            top_left = grid_size_y * j + i
+            top_right = top_left + grid_size_y
+            indices.extend([top_left, top_right, top_left + 1,
+                            top_left + 1, top_right, top_right + 1])
+    return indices
@@ -20,11 +20,37 @@
 Functions for loading MP4/MOV files and manipulating boxes.
 """
 
+import heapq
+import io
+import math
+import mmap
+import os
+
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
 from spatialmedia.mpeg import container
+from spatialmedia.mpeg import instrumentation
+from spatialmedia.mpeg import sample_table
+from spatialmedia.mpeg import schema
+from spatialmedia.mpeg import track
+
+# Instrumented phases of saving top level boxes.
+SAVE_PHASES = {
+    constants.TAG_MOOV: "save_moov",
+    constants.TAG_MDAT: "copy_media",
+}
+
+# Number of samples of a track whose positions are computed at once when
+# reading samples.
+SAMPLE_WINDOW = 65536
+
+# Samples at most this many bytes apart are prefetched as one range, up to
+# PREFETCH_SIZE bytes.
+COALESCE_GAP = 64 * 1024
+PREFETCH_SIZE = 16 * 1024 * 1024
 
 
+@instrumentation.instrumented("load")
 def load(fh):
     """Load the mpeg4 file structure of a file.
 
@@ -40,7 +66,51 @@ def load(fh):
     fh.seek(0, 2)
     size = fh.tell()
     contents = container.load_multiple(fh, 0, size)
+    return from_contents(contents, fh)
+
+
+@instrumentation.instrumented("load")
+def load_mmap(fh):
+    """Load the mpeg4 file structure of a file through a memory map.
+
+    Produces the same structure as load, decoding box headers from the
+    mapped file instead of issuing seeks and reads for every box.
 
+    Args:
+      fh: file handle, input file handle backed by a real file.
+
+    return:
+      mpeg4, the loaded mpeg4 structure.
+    """
+    fh.seek(0, 2)
+    size = fh.tell()
+    if size == 0:
+        print("Error, no boxes found.")
+        return None
+
+    mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        view = memoryview(mapped)
+        try:
+            contents = container.load_multiple_buffer(view, 0, size)
+        finally:
+            view.release()
+    finally:
+        mapped.close()
+    return from_contents(contents, fh)
+
+
+def from_contents(contents, fh=None):
+    """Creates the mpeg4 structure from its loaded top level boxes.
+
+    Args:
+      contents: list, top level boxes of the file or None.
+      fh: file handle or None, source for uncached file contents used to
+        index the tracks. Tracks are left unindexed when None.
+
+    return:
+      mpeg4, the loaded mpeg4 structure.
+    """
     if not contents:
         print("Error, failed to load .mp4 file.")
         return None
@@ -52,10 +122,9 @@ def load(fh):
     loaded_mpeg4.contents = contents
 
     for element in loaded_mpeg4.contents:
+        element.parent = loaded_mpeg4
         if (element.name == constants.TAG_MOOV):
             loaded_mpeg4.moov_box = element
-        if (element.name == constants.TAG_FREE):
-            loaded_mpeg4.free_box = element
         if (element.name == constants.TAG_MDAT
                 and not loaded_mpeg4.first_mdat_box):
             loaded_mpeg4.first_mdat_box = element
@@ -66,6 +135,12 @@ def load(fh):
         print("Error, file does not contain moov box.")
         return None
 
+    # Free space reserved directly after moov.
+    moov_index = loaded_mpeg4.contents.index(loaded_mpeg4.moov_box)
+    if (moov_index + 1 < len(loaded_mpeg4.contents) and
+            loaded_mpeg4.contents[moov_index + 1].name == constants.TAG_FREE):
+        loaded_mpeg4.free_box = loaded_mpeg4.contents[moov_index + 1]
+
     if not loaded_mpeg4.first_mdat_box:
         print("Error, file does not contain mdat box.")
         return None
@@ -79,9 +154,76 @@ def load(fh):
     for element in loaded_mpeg4.contents:
         loaded_mpeg4.content_size += element.size()
 
+    if fh is not None:
+        loaded_mpeg4.index_tracks(fh)
     return loaded_mpeg4
 
 
+def track_samples(selected, position, table, start, end, mapped,
+                  coalesce_gap):
+    """Yields the samples of a track within a time range, in file order.
+
+    Args:
+      selected: track.Track, track of the samples.
+      position: int, position of the track among the tracks read.
+      table: sample_table.SampleTable, samples of the track.
+      start, end: float or None, time range in seconds, see read_samples.
+      mapped: mmap, memory map of the file.
+      coalesce_gap: int, largest number of bytes between samples
+        prefetched together.
+
+    Yields:
+      (offset, position, sample_index, pts, size, track).
+    """
+    timescale = float(table.timescale or 1)
+    first = 0
+    stop = len(table)
+    if start is not None:
+        # Samples decoded before start are skipped.
+        first = sample_after(table, int(math.ceil(start * timescale)) - 1)
+    if end is not None:
+        stop = sample_after(table, int(math.ceil(end * timescale)) - 1)
+    prefetch = (hasattr(mapped, "madvise") and
+                hasattr(mmap, "MADV_WILLNEED"))
+
+    for window_start in range(first, stop, SAMPLE_WINDOW):
+        samples = table.samples(window_start,
+                                min(window_start + SAMPLE_WINDOW, stop))
+        ranges = list()
+        if prefetch:
+            ranges = sample_table.coalesce(samples, coalesce_gap,
+                                           PREFETCH_SIZE)
+            ranges.reverse()
+        offsets, sizes, presentation_times = [
+            values.tolist() if hasattr(values, "tolist") else values
+            for values in (samples.offsets, samples.sizes,
+                           samples.presentation_times)]
+        for i, offset in enumerate(offsets):
+            size = sizes[i]
+            if offset + size > len(mapped):
+                print("Error: sample {} exceeds the file.".format(
+                    window_start + i))
+                return
+            if ranges and ranges[-1][0] == i:
+                range_start, range_end = ranges.pop()[1:]
+                page_start = range_start - range_start % mmap.PAGESIZE
+                length = min(range_end, len(mapped)) - page_start
+                if length > 0:
+                    mapped.madvise(mmap.MADV_WILLNEED, page_start, length)
+            yield (offset, position, window_start + i,
+                   presentation_times[i] / timescale, size, selected)
+
+
+def sample_after(table, time):
+    """Returns the index of the first sample decoded after time."""
+    if time < 0:
+        return 0
+    index = table.sample_at(time)
+    if index is None:
+        return len(table)
+    return index + 1
+
+
 class Mpeg4Container(container.Container):
     """Specialized behaviour for the root mpeg4 container."""
 
@@ -95,12 +237,121 @@ class Mpeg4Container(container.Container):
         self.ftyp_box = None
         self.first_mdat_position = None
         self.padding = 0
+        self.parent = None
+        # The top level boxes are always resized, as they are rearranged
+        # directly.
+        self.modified = True
+        self.offset_boxes = None
+        self.child_index = None
+        self.indexed_contents = None
+        self.tracks = None
 
     def merge(self, element):
         """Mpeg4 containers do not support merging."""
         print("Cannot merge mpeg4 files")
         exit(0)
 
+    def index_tracks(self, fh):
+        """Indexes the tracks of the moov box in a single pass.
+
+        Loading functions index the tracks, which are then available as the
+        tracks attribute, a list of track.Track.
+
+        Args:
+          fh: file handle, source for uncached file contents.
+
+        Returns:
+          list of track.Track, in the order of the trak boxes.
+        """
+        self.tracks = track.index_tracks(self.moov_box, fh)
+        return self.tracks
+
+    def boxes_removed(self, removed):
+        """Drops removed boxes and the tracks of removed trak boxes from the
+        track index.
+        """
+        if self.tracks is None:
+            return
+        self.tracks = [indexed for indexed in self.tracks
+                       if track.attached(indexed.trak, self)]
+        for indexed in self.tracks:
+            indexed.drop_detached(self)
+
+    def movie_header(self, fh):
+        """Returns the decoded mvhd box of the moov box or None.
+
+        Args:
+          fh: file handle, source for uncached file contents.
+        """
+        if self.moov_box is None:
+            return None
+        mvhd = self.moov_box.first(constants.TAG_MVHD)
+        if mvhd is None:
+            return None
+        return schema.read(mvhd, fh)
+
+    def duration(self, fh):
+        """Returns the duration of the movie in seconds or None."""
+        movie_header = self.movie_header(fh)
+        if movie_header is None or not movie_header.timescale:
+            return None
+        return movie_header.duration / float(movie_header.timescale)
+
+    def read_samples(self, fh, tracks=None, start=None, end=None,
+                     coalesce_gap=COALESCE_GAP):
+        """Iterates over the samples of tracks through a memory map.
+
+        Samples are yielded in the order they are stored in the file,
+        interleaving the tracks. Their payloads are memoryviews of the mapped
+        file, valid until the iteration ends; bytes(payload) keeps a copy.
+        Samples stored close together are prefetched as one range where the
+        platform supports madvise.
+
+        Args:
+          fh: file handle, input file handle backed by a real file.
+          tracks: list of track.Track of the tracks attribute, all tracks by
+            default.
+          start: float, decode time in seconds of the first sample, or None.
+          end: float, decode time in seconds before which samples end, or
+            None.
+          coalesce_gap: int, largest number of bytes between samples
+            prefetched together.
+
+        Yields:
+          (track, sample_index, pts, payload), the track.Track, index of the
+          sample in the track, presentation time in seconds and memoryview
+          of the sample.
+        """
+        if self.tracks is None:
+            self.index_tracks(fh)
+        if tracks is None:
+            tracks = self.tracks
+
+        fh.seek(0, 2)
+        if fh.tell() == 0:
+            return
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            streams = list()
+            for position, selected in enumerate(tracks):
+                table = selected.sample_table(fh)
+                if table is not None:
+                    streams.append(track_samples(
+                        selected, position, table, start, end, mapped,
+                        coalesce_gap))
+            for offset, position, index, pts, size, selected in heapq.merge(
+                    *streams):
+                yield selected, index, pts, view[offset:offset + size]
+        finally:
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                # Payloads still referenced keep the map open until they
+                # are released.
+                pass
+
     def print_structure(self):
         """Print mpeg4 file structure recursively."""
         print("mpeg4 [{}]".format(self.content_size))
@@ -113,6 +364,32 @@ class Mpeg4Container(container.Container):
 
             self.contents[i].print_structure(next_indent)
 
+    def move_moov_before_mdat(self):
+        """Moves the moov box in front of the first mdat box.
+
+        Chunk offsets are updated when saving, like for any other change to
+        the size of the boxes preceding mdat. The moov box is not moved when
+        media data follows it, as that data would move by a different amount.
+
+        Returns:
+          Bool, whether the moov box now precedes the first mdat box.
+        """
+        moov_index = self.contents.index(self.moov_box)
+        mdat_index = self.contents.index(self.first_mdat_box)
+        if moov_index < mdat_index:
+            return True
+
+        for element in self.contents[moov_index + 1:]:
+            if element.name == constants.TAG_MDAT:
+                print("Error, cannot move moov box preceding an mdat box.")
+                return False
+
+        del self.contents[moov_index]
+        self.contents.insert(mdat_index, self.moov_box)
+        self.invalidate_index()
+        return True
+
+    @instrumentation.instrumented("save")
     def save(self, in_fh, out_fh):
         """Save mpeg4 filecontent to file.
 
@@ -121,13 +398,198 @@ class Mpeg4Container(container.Container):
           out_fh: file handle, destination file hand for saved file.
         """
         self.resize()
+        delta = self.mdat_delta()
+
+        # Offsets beyond 4 GiB need 64 bit chunk offset tables.
+        if delta > 0 and self.content_size > 0xFFFFFFFF:
+            index_maxima = dict()
+            with instrumentation.phase("promote_index_tables"):
+                while self.promote_index_tables(in_fh, delta, index_maxima):
+                    self.resize()
+                    delta = self.mdat_delta()
+
+        new_position = 0
+        for element in self.contents:
+            if element.name == constants.TAG_SIDX:
+                # sidx offsets are relative to the end of the sidx box.
+                element.save(in_fh, out_fh,
+                             delta - (new_position - element.position))
+            elif element.name in SAVE_PHASES:
+                with instrumentation.phase(SAVE_PHASES[element.name]):
+                    element.save(in_fh, out_fh, delta)
+            else:
+                element.save(in_fh, out_fh, delta)
+            new_position += element.size()
+
+    def mdat_delta(self):
+        """Returns how far the first mdat box's contents move when saved."""
         new_position = 0
         for element in self.contents:
             if element.name == constants.TAG_MDAT:
                 new_position += element.header_size
                 break
             new_position += element.size()
-        delta = new_position - self.first_mdat_position
+        return new_position - self.first_mdat_position
 
-        for element in self.contents:
-            element.save(in_fh, out_fh, delta)
+    def promote_index_tables(self, in_fh, delta, index_maxima):
+        """Converts stco boxes into co64 boxes when their offsets overflow.
+
+        Args:
+          in_fh: file handle, source file handle for uncached contents.
+          delta: int, offset change for index entries.
+          index_maxima: dict, largest entry of each stco box by id, filled
+            in as tables are read.
+
+        Returns:
+          Bool, whether any stco box was converted.
+        """
+        promoted = False
+        for stbl in self.moov_box.find_all("trak/mdia/minf/stbl"):
+            for element in stbl.children(constants.TAG_STCO):
+                if id(element) not in index_maxima:
+                    index_maxima[id(element)] = box.index_max(
+                        in_fh, element, ">I")
+                if index_maxima[id(element)] + delta > 0xFFFFFFFF:
+                    box.stco_to_co64(in_fh, element)
+                    # The box is renamed to co64.
+                    stbl.invalidate_index()
+                    promoted = True
+        return promoted
+
+    def set_padding(self, size):
+        """Reserves free space in a free box directly after the moov box.
+
+        Later injections can grow the moov box into this space in place, see
+        save_in_place.
+
+        Args:
+          size: int, size of the free box including its header, 0 removes it.
+
+        Returns:
+          Bool, whether the padding was set.
+        """
+        if size < 0 or 0 < size < 8:
+            print("Error, padding must be 0 or at least 8 bytes.")
+            return False
+
+        if self.free_box:
+            self.contents.remove(self.free_box)
+            self.free_box = None
+
+        if size > 0:
+            self.free_box = box.free_box(size)
+            self.free_box.parent = self
+            self.contents.insert(
+                self.contents.index(self.moov_box) + 1, self.free_box)
+        self.invalidate_index()
+        return True
+
+    def free_space(self):
+        """Returns the size of the free box directly after the moov box."""
+        if self.free_box:
+            return self.free_box.size()
+        return 0
+
+    @instrumentation.instrumented("save_in_place")
+    def save_in_place(self, fh, padding=None):
+        """Rewrite the moov box within its own file without moving mdat.
+
+        The new moov box is written over the old one and any free boxes
+        adjacent to it, with the remainder marked as a free box. When moov
+        is the last box in the file it may grow or shrink freely. When it
+        follows the first mdat box and no longer fits, moov is moved to the
+        end of the file, and its old location is marked as free only once
+        the new moov box has been synced to disk. Since media data never
+        moves, chunk offsets are left unchanged.
+
+        The loaded structure is stale afterwards and should be reloaded
+        before further use, except for free_box which describes the free
+        space left after moov.
+
+        Args:
+          fh: file handle, file opened for reading and writing ("r+b").
+          padding: int or None, size of the free box reserved after moov
+            when it is written at the end of the file. None keeps the free
+            box found after moov, or the free space left by moov when it
+            still fits. Moov boxes saved in front of other boxes can only
+            keep the free space left, so other sizes are rejected there.
+
+        Returns:
+          Bool, whether the moov box could be saved in place.
+        """
+        if padding is not None and (padding < 0 or 0 < padding < 8):
+            print("Error, padding must be 0 or at least 8 bytes.")
+            return False
+
+        index = self.contents.index(self.moov_box)
+        first = index
+        while (first > 0 and
+               self.contents[first - 1].name == constants.TAG_FREE):
+            first -= 1
+        last = index
+        while (last + 1 < len(self.contents) and
+               self.contents[last + 1].name == constants.TAG_FREE):
+            last += 1
+
+        fh.seek(0, 2)
+        file_size = fh.tell()
+        start = self.contents[first].position
+        end = file_size
+        if last + 1 < len(self.contents):
+            end = self.contents[last + 1].position
+        available = end - start
+
+        self.resize()
+        moov = io.BytesIO()
+        self.moov_box.save(fh, moov, 0)
+        moov = moov.getvalue()
+        slack = available - len(moov)
+        fits = slack == 0 or slack >= 8
+
+        if end == file_size:
+            if padding is None:
+                padding = slack if fits else self.free_space()
+            fh.seek(start)
+            fh.write(moov)
+            self.free_box = self.save_tail_padding(fh, padding)
+        elif fits and padding in (None, slack):
+            fh.seek(start)
+            fh.write(moov)
+            self.free_box = None
+            if slack > 0:
+                self.free_box = box.free_box(slack)
+                self.free_box.save_header(fh)
+        elif self.moov_box.position > self.first_mdat_box.position:
+            if padding is None:
+                padding = self.free_space()
+            # Until the old moov box is freed the file stays readable.
+            fh.seek(0, 2)
+            fh.write(moov)
+            self.free_box = self.save_tail_padding(fh, padding)
+            fh.flush()
+            os.fsync(fh.fileno())
+            fh.seek(start)
+            box.free_box(available).save_header(fh)
+        elif fits:
+            print("Error, padding cannot be changed in place when moov is "
+                  "followed by other boxes; %d bytes are free." % slack)
+            return False
+        else:
+            print("Error, not enough free space around moov to save in place.")
+            return False
+
+        return True
+
+    def save_tail_padding(self, fh, padding):
+        """Ends the file with a free box of padding bytes at the position of fh.
+
+        Returns:
+          box, the written free box or None.
+        """
+        free = None
+        if padding > 0:
+            free = box.free_box(padding)
+            free.save_header(fh)
+            fh.seek(free.content_size, 1)
+        fh.truncate()
+        return free
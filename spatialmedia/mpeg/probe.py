@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG4 probing with bounded I/O.
+
+Loads the moov box of a MP4/MOV file by reading top level box headers and
+then the moov box in a single read, so metadata can be parsed from memory.
+"""
+
+import struct
+
+from spatialmedia.mpeg import box
+from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import container
+from spatialmedia.mpeg import instrumentation
+from spatialmedia.mpeg import mpeg4_container
+
+# Amount read from the start of the file, usually enough to hold the
+# ftyp and moov boxes of files with moov in front of the media data.
+PROBE_READ_SIZE = 64 * 1024
+
+
+@instrumentation.instrumented("probe")
+def load(fh, read_size=PROBE_READ_SIZE):
+    """Loads the top level boxes of a file up to and including moov.
+
+    Args:
+      fh: file handle, input file handle.
+      read_size: int, amount of data to read from the start of the file.
+
+    Returns:
+      (mpeg4, reader), the loaded mpeg4 structure and a file handle serving
+      reads of moov contents from memory, or (None, None).
+    """
+    fh.seek(0, 2)
+    size = fh.tell()
+    fh.seek(0)
+    head = fh.read(min(read_size, size))
+
+    loaded_mpeg4 = mpeg4_container.Mpeg4Container()
+    position = 0
+    while position + 8 <= size:
+        if position + 16 <= len(head) or len(head) == size:
+            header = head[position:position + 16]
+        else:
+            fh.seek(position)
+            header = fh.read(16)
+
+        header_size = 8
+        box_size, name = struct.unpack_from(">I4s", header)
+        if box_size == 1:
+            box_size = struct.unpack_from(">Q", header, 8)[0]
+            header_size = 16
+        elif box_size == 0:
+            box_size = size - position
+
+        if box_size < 8 or position + box_size > size:
+            print("Error, invalid size", box_size, "in", name, "at", position)
+            return None, None
+
+        if name == constants.TAG_MOOV:
+            if position + box_size <= len(head):
+                buf = head
+                base = 0
+            else:
+                fh.seek(position)
+                buf = fh.read(box_size)
+                base = position
+
+            moov = container.load_buffer(
+                memoryview(buf), position, position + box_size, base)
+            if moov is None:
+                return None, None
+            moov.parent = loaded_mpeg4
+            loaded_mpeg4.contents.append(moov)
+            loaded_mpeg4.moov_box = moov
+            reader = BufferFile(buf, base, fh)
+            loaded_mpeg4.index_tracks(reader)
+            return loaded_mpeg4, reader
+
+        element = box.Box()
+        element.name = name
+        element.position = position
+        element.header_size = header_size
+        element.content_size = box_size - header_size
+        element.parent = loaded_mpeg4
+        loaded_mpeg4.contents.append(element)
+        if name == constants.TAG_FTYP:
+            loaded_mpeg4.ftyp_box = element
+        if name == constants.TAG_MDAT and not loaded_mpeg4.first_mdat_box:
+            loaded_mpeg4.first_mdat_box = element
+        position += box_size
+
+    print("Error, file does not contain moov box.")
+    return None, None
+
+
+class CountingFile(object):
+    """File handle wrapper counting the reads and seeks issued."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.reads = 0
+        self.bytes_read = 0
+        self.seeks = 0
+
+    def read(self, size=-1):
+        contents = self.fh.read(size)
+        self.reads += 1
+        self.bytes_read += len(contents)
+        return contents
+
+    def readinto(self, buf):
+        count = self.fh.readinto(buf)
+        self.reads += 1
+        self.bytes_read += count or 0
+        return count
+
+    def seek(self, offset, whence=0):
+        self.seeks += 1
+        return self.fh.seek(offset, whence)
+
+    def tell(self):
+        return self.fh.tell()
+
+
+class BufferFile(object):
+    """Read only file handle over a buffer holding part of a file.
+
+    Positions are file positions. Reads outside of the buffer are passed on
+    to the file handle of the whole file.
+    """
+
+    def __init__(self, buf, base, fh):
+        self.buf = buf
+        self.base = base
+        self.fh = fh
+        self.position = 0
+
+    def read(self, size=-1):
+        offset = self.position - self.base
+        if size < 0 or offset < 0 or offset + size > len(self.buf):
+            self.fh.seek(self.position)
+            contents = self.fh.read(size)
+        else:
+            contents = self.buf[offset:offset + size]
+        self.position += len(contents)
+        return contents
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            self.fh.seek(0, 2)
+            offset += self.fh.tell()
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
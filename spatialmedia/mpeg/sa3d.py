@@ -18,13 +18,21 @@
 """MPEG SA3D box processing classes.
 
 Enables the injection of an SA3D MPEG-4. The SA3D box specification
-conforms to that outlined in docs/spatial-audio-rfc.md
+conforms to that outlined in docs/spatial-audio-rfc.md. The fixed size
+fields are decoded and encoded with the SA3D layout of the schema module.
 """
 
 import struct
 
 from spatialmedia.mpeg import box
 from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import schema
+
+HEAD_LOCKED_STEREO = 0x80
+AMBISONIC_TYPE_MASK = 0x7F
+
+# Fields preceding the channel map.
+LAYOUT = schema.SA3D.layouts[0]
 
 
 def load(fh, position=None, end=None):
@@ -55,17 +63,44 @@ def load(fh, position=None, end=None):
         return None
 
     new_box.content_size = size - new_box.header_size
-    new_box.version = struct.unpack(">B", fh.read(1))[0]
-    new_box.ambisonic_type = struct.unpack(">B", fh.read(1))[0]
-    new_box.head_locked_stereo = (new_box.ambisonic_type & int('10000000', 2) != 0)
-    new_box.ambisonic_type = new_box.ambisonic_type & int('01111111', 2)
-    new_box.ambisonic_order = struct.unpack(">I", fh.read(4))[0]
-    new_box.ambisonic_channel_ordering = struct.unpack(">B", fh.read(1))[0]
-    new_box.ambisonic_normalization = struct.unpack(">B", fh.read(1))[0]
-    new_box.num_channels = struct.unpack(">I", fh.read(4))[0]
-    for i in range(0, new_box.num_channels):
-        new_box.channel_map.append(
-            struct.unpack(">I", fh.read(4))[0])
+    contents = fh.read(LAYOUT.size)
+    new_box.decode(contents)
+    channel_map = fh.read(4 * new_box.num_channels)
+    new_box.channel_map = list(struct.unpack(
+        ">%dI" % new_box.num_channels, channel_map))
+    return new_box
+
+
+def load_buffer(buf, position, end, base=0):
+    """ Loads the SA3D box located at position in a buffer holding an mp4
+        file.
+
+    Args:
+      buf: buffer, file contents starting at file position base.
+      position: int, file position of the box.
+      end: int, file position the box must not extend beyond.
+      base: int, file position of the first byte in buf.
+
+    Returns:
+      new_box: box, SA3D box loaded from the buffer location or None.
+    """
+    offset = position - base
+    new_box = SA3DBox()
+    new_box.position = position
+    size, name = struct.unpack_from(">I4s", buf, offset)
+
+    if (name != constants.TAG_SA3D):
+        print("Error: box is not an SA3D box.")
+        return None
+
+    if (position + size > end):
+        print("Error: SA3D box size exceeds bounds.")
+        return None
+
+    new_box.content_size = size - new_box.header_size
+    new_box.decode(buf, offset + 8)
+    new_box.channel_map = list(struct.unpack_from(
+        ">%dI" % new_box.num_channels, buf, offset + 8 + LAYOUT.size))
     return new_box
 
 
@@ -92,29 +127,44 @@ class SA3DBox(box.Box):
         new_box = SA3DBox()
         new_box.header_size = 8
         new_box.name = constants.TAG_SA3D
-        new_box.version = 0                     # uint8
-        new_box.content_size += 1               # uint8
+        new_box.version = 0
         new_box.ambisonic_type = SA3DBox.ambisonic_types[
             audio_metadata["ambisonic_type"]]
         new_box.head_locked_stereo = audio_metadata["head_locked_stereo"]
-        new_box.content_size += 1               # uint8
         new_box.ambisonic_order = audio_metadata["ambisonic_order"]
-        new_box.content_size += 4               # uint32
         new_box.ambisonic_channel_ordering = SA3DBox.ambisonic_orderings[
             audio_metadata["ambisonic_channel_ordering"]]
-        new_box.content_size += 1               # uint8
         new_box.ambisonic_normalization = SA3DBox.ambisonic_normalizations[
             audio_metadata["ambisonic_normalization"]]
-        new_box.content_size += 1               # uint8
         new_box.num_channels = num_channels
-        new_box.content_size += 4               # uint32
-
-        channel_map = audio_metadata["channel_map"]
-        for channel_element in channel_map:
-            new_box.channel_map.append(channel_element)
-            new_box.content_size += 4  # uint32
+        new_box.channel_map = list(audio_metadata["channel_map"])
+        new_box.content_size = LAYOUT.size + 4 * len(new_box.channel_map)
         return new_box
 
+    def decode(self, buf, offset=0):
+        """Sets the fields from the SA3D box contents at offset in buf."""
+        fields = LAYOUT.decode(buf, offset)
+        self.version = fields.version
+        self.head_locked_stereo = (
+            fields.ambisonic_type & HEAD_LOCKED_STEREO != 0)
+        self.ambisonic_type = fields.ambisonic_type & AMBISONIC_TYPE_MASK
+        self.ambisonic_order = fields.ambisonic_order
+        self.ambisonic_channel_ordering = fields.ambisonic_channel_ordering
+        self.ambisonic_normalization = fields.ambisonic_normalization
+        self.num_channels = fields.num_channels
+
+    def encode(self):
+        """Returns the SA3D box contents."""
+        ambisonic_type = self.ambisonic_type & AMBISONIC_TYPE_MASK
+        if self.head_locked_stereo:
+            ambisonic_type |= HEAD_LOCKED_STEREO
+        channel_map = [int(i) for i in self.channel_map if i is not None]
+        return LAYOUT.encode(LAYOUT.record(
+            self.version, ambisonic_type, self.ambisonic_order,
+            self.ambisonic_channel_ordering, self.ambisonic_normalization,
+            self.num_channels)) + struct.pack(
+                ">%dI" % len(channel_map), *channel_map)
+
     def ambisonic_type_name(self):
         return  next((key for key,value in SA3DBox.ambisonic_types.items()
                  if value==self.ambisonic_type))
@@ -154,23 +204,5 @@ class SA3DBox(box.Box):
         return metadata
 
     def save(self, in_fh, out_fh, delta):
-        if (self.header_size == 16):
-            out_fh.write(struct.pack(">I", 1))
-            out_fh.write(struct.pack(">Q", self.size()))
-            out_fh.write(self.name)
-        elif(self.header_size == 8):
-            out_fh.write(struct.pack(">I", self.size()))
-            out_fh.write(self.name)
-
-        ambisonic_type = (
-            self.ambisonic_type | int('10000000', 2) if
-            self.head_locked_stereo else self.ambisonic_type & int('01111111', 2))
-        out_fh.write(struct.pack(">B", self.version))
-        out_fh.write(struct.pack(">B", ambisonic_type))
-        out_fh.write(struct.pack(">I", self.ambisonic_order))
-        out_fh.write(struct.pack(">B", self.ambisonic_channel_ordering))
-        out_fh.write(struct.pack(">B", self.ambisonic_normalization))
-        out_fh.write(struct.pack(">I", self.num_channels))
-        for i in self.channel_map:
-            if (i != None):
-                out_fh.write(struct.pack(">I", int(i)))
+        self.save_header(out_fh)
+        out_fh.write(self.encode())
@@ -0,0 +1,521 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG4 sample tables.
+
+Indexes the samples of a track from the stsz or stz2, stsc, stts, ctts, stss
+and stco or co64 boxes of its sample table. The byte range, decode and
+presentation time and sync status of any sample are computed on request from
+compact tables: 4 bytes per sample for the sizes, 16 bytes per chunk and a
+few bytes per time run or sync sample. The run length coded tables are
+expanded and summed with NumPy when it is available, and with lists
+otherwise. Times are in units of the media timescale, edit lists and movie
+fragments are not taken into account.
+"""
+
+import array
+import bisect
+import collections
+import itertools
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from spatialmedia.mpeg import box
+from spatialmedia.mpeg import constants
+
+Sample = collections.namedtuple(
+    "Sample",
+    "index offset size decode_time presentation_time is_sync")
+
+# Columns of consecutive samples, NumPy arrays when NumPy is available,
+# lists otherwise.
+Samples = collections.namedtuple(
+    "Samples", "offsets sizes decode_times presentation_times")
+
+ENTRY_COUNT = struct.Struct(">I")
+SAMPLE_SIZE_HEADER = struct.Struct(">II")
+
+# struct codes of the NumPy types of table entries.
+STRUCT_CODES = {">u1": "B", ">u2": "H", ">u4": "I", ">i4": "i", ">u8": "Q"}
+
+
+def load(track, fh):
+    """Builds the sample table of a track.
+
+    Args:
+      track: track.Track, indexed track.
+      fh: file handle, source for uncached file contents.
+
+    Returns:
+      SampleTable, or None if the track has no valid sample table.
+    """
+    if track.stbl is None:
+        print("Error: track has no sample table.")
+        return None
+
+    def contents(name):
+        element = track.stbl.first(name)
+        if element is None:
+            return None
+        return box.read_index(fh, element)
+
+    sizes = contents(constants.TAG_STSZ)
+    compact = False
+    if sizes is None:
+        sizes = contents(constants.TAG_STZ2)
+        compact = True
+    sample_to_chunk = contents(constants.TAG_STSC)
+    time_to_sample = contents(constants.TAG_STTS)
+    if (sizes is None or sample_to_chunk is None or time_to_sample is None or
+            track.chunk_offsets is None):
+        print("Error: incomplete sample table.")
+        return None
+
+    chunk_dtype = ">u4"
+    if track.chunk_offsets.name == constants.TAG_CO64:
+        chunk_dtype = ">u8"
+    media_header = track.media_header(fh)
+
+    try:
+        return SampleTable(
+            sample_sizes(sizes, compact),
+            read_table(box.read_index(fh, track.chunk_offsets), chunk_dtype),
+            read_table(sample_to_chunk, ">u4", 3),
+            read_table(time_to_sample, ">u4", 2),
+            optional_table(contents(constants.TAG_CTTS), ">i4", 2),
+            optional_table(contents(constants.TAG_STSS), ">u4"),
+            media_header.timescale if media_header is not None else None)
+    except (ValueError, struct.error) as e:
+        print("Error: invalid sample table: {}".format(e))
+        return None
+
+
+def read_table(contents, dtype, columns=1):
+    """Returns the columns of the entry table of a full box.
+
+    The entry count follows the version and flags, followed by the entries.
+
+    Args:
+      contents: bytes-like, box contents.
+      dtype: string, NumPy type of the values, a key of STRUCT_CODES.
+      columns: int, number of values per entry.
+
+    Returns:
+      list of columns, NumPy arrays or tuples.
+
+    Raises:
+      ValueError, struct.error: the table exceeds the box.
+    """
+    count = ENTRY_COUNT.unpack_from(contents, 4)[0]
+    return read_entries(contents, 8, count, dtype, columns)
+
+
+def optional_table(contents, dtype, columns=1):
+    if contents is None:
+        return None
+    return read_table(contents, dtype, columns)
+
+
+def read_entries(contents, offset, count, dtype, columns=1):
+    item_size = struct.calcsize(">" + STRUCT_CODES[dtype])
+    if offset + count * columns * item_size > len(contents):
+        raise ValueError("table of {} entries exceeds its box".format(count))
+
+    if numpy is not None:
+        values = numpy.frombuffer(contents, dtype=dtype,
+                                  count=count * columns, offset=offset)
+        return [values[column::columns] for column in range(columns)]
+    values = struct.unpack_from(
+        ">%d%s" % (count * columns, STRUCT_CODES[dtype]), contents, offset)
+    return [values[column::columns] for column in range(columns)]
+
+
+def sample_sizes(contents, compact=False):
+    """Decodes the contents of a stsz or stz2 box.
+
+    Returns:
+      (sample_size, sample_count, sizes) where sizes is None when every
+      sample has sample_size bytes, and an array of the size of each sample
+      otherwise.
+    """
+    sample_size, sample_count = SAMPLE_SIZE_HEADER.unpack_from(contents, 4)
+    if not compact:
+        if sample_size != 0:
+            return sample_size, sample_count, None
+        sizes = read_entries(contents, 12, sample_count, ">u4")[0]
+    else:
+        field_size = sample_size & 0xFF
+        if field_size == 4:
+            # Two sizes per byte, the first in the high nibble.
+            packed = read_entries(
+                contents, 12, (sample_count + 1) // 2, ">u1")[0]
+            if numpy is not None:
+                sizes = numpy.stack([packed >> 4, packed & 0xF],
+                                    axis=-1).ravel()[:sample_count]
+            else:
+                sizes = [size for byte in packed
+                         for size in (byte >> 4, byte & 0xF)][:sample_count]
+        elif field_size in (8, 16):
+            sizes = read_entries(contents, 12, sample_count,
+                                 ">u%d" % (field_size // 8))[0]
+        else:
+            raise ValueError("invalid stz2 field size {}".format(field_size))
+
+    if numpy is not None:
+        return 0, sample_count, sizes.astype(numpy.uint32)
+    return 0, sample_count, array.array("I", sizes)
+
+
+def cumulative(values, initial=0):
+    """Returns initial followed by the cumulative sums of values."""
+    if numpy is not None:
+        sums = numpy.empty(len(values) + 1, dtype=numpy.int64)
+        sums[0] = initial
+        numpy.cumsum(values, dtype=numpy.int64, out=sums[1:])
+        sums[1:] += initial
+        return sums
+    return list(itertools.accumulate(itertools.chain([initial], values)))
+
+
+def coalesce(samples, gap, max_size):
+    """Groups samples stored one after the other into byte ranges.
+
+    Args:
+      samples: Samples, consecutive samples of a track.
+      gap: int, largest number of bytes between samples of a range.
+      max_size: int, size above which a range is split.
+
+    Returns:
+      list of (first, start, end), the index of the first sample of each
+      range within samples and its file positions.
+    """
+    if numpy is not None:
+        offsets = samples.offsets.astype(numpy.int64)
+        ends = offsets + samples.sizes
+        separations = offsets[1:] - ends[:-1]
+        firsts = numpy.flatnonzero((separations < 0) | (separations > gap))
+        firsts = numpy.concatenate([[0], firsts + 1]).tolist()
+        offsets = offsets.tolist()
+        ends = ends.tolist()
+    else:
+        offsets = samples.offsets
+        ends = [offset + size for offset, size in zip(offsets,
+                                                       samples.sizes)]
+        firsts = [0] + [index for index in range(1, len(offsets))
+                        if not 0 <= offsets[index] - ends[index - 1] <= gap]
+    if not offsets:
+        return []
+
+    ranges = list()
+    for first, last in zip(firsts, firsts[1:] + [len(offsets)]):
+        start = offsets[first]
+        for index in range(first, last):
+            if ends[index] - start > max_size and index > first:
+                ranges.append((first, start, ends[index - 1]))
+                first, start = index, offsets[index]
+        ranges.append((first, start, max(ends[first:last])))
+    return ranges
+
+
+def search(values, value):
+    """Returns the index of the last of sorted values not above value."""
+    if numpy is not None:
+        return int(numpy.searchsorted(values, value, "right")) - 1
+    return bisect.bisect_right(values, value) - 1
+
+
+class SampleTable(object):
+    """Sample index of a track.
+
+    Samples are numbered from 0. Times are in units of timescale.
+
+    Args:
+      sample_sizes: (sample_size, sample_count, sizes), see sample_sizes.
+      chunk_offsets: [offsets], column of the stco or co64 table.
+      sample_to_chunk: [first_chunk, samples_per_chunk, description_index],
+        columns of the stsc table.
+      time_to_sample: [sample_count, sample_delta], columns of the stts
+        table.
+      composition_offsets: [sample_count, sample_offset], columns of the ctts
+        table, or None.
+      sync_samples: [sample_number], column of the stss table, or None when
+        every sample is a sync sample.
+      timescale: int, media timescale or None.
+
+    Raises:
+      ValueError: the chunks hold fewer samples than the sample count.
+    """
+
+    def __init__(self, sample_sizes, chunk_offsets, sample_to_chunk,
+                 time_to_sample, composition_offsets=None, sync_samples=None,
+                 timescale=None):
+        self.sample_size, self.sample_count, self.sizes = sample_sizes
+        self.timescale = timescale
+
+        # Run length expansion of stsc, with the first sample of each chunk
+        # followed by the number of samples of all chunks.
+        offsets = chunk_offsets[0]
+        first_chunks, samples_per_chunk = sample_to_chunk[:2]
+        chunk_count = len(offsets)
+        if len(first_chunks) and first_chunks[0] != 1:
+            raise ValueError("sample to chunk table does not start at chunk 1")
+        if numpy is not None:
+            self.chunk_offsets = offsets.astype(numpy.uint64)
+            runs = numpy.diff(numpy.append(
+                first_chunks.astype(numpy.int64), chunk_count + 1))
+            if len(runs) and runs[:-1].min(initial=1) < 1:
+                raise ValueError("sample to chunk table is not sorted")
+            chunk_samples = numpy.repeat(
+                samples_per_chunk, numpy.clip(runs, 0, None))[:chunk_count]
+        else:
+            self.chunk_offsets = list(offsets)
+            ends = list(first_chunks[1:]) + [chunk_count + 1]
+            if any(end <= first for first, end in
+                   zip(first_chunks[:-1], ends[:-1])):
+                raise ValueError("sample to chunk table is not sorted")
+            chunk_samples = list(itertools.islice(
+                itertools.chain.from_iterable(
+                    itertools.repeat(count, max(end - first, 0))
+                    for first, end, count in zip(first_chunks, ends,
+                                                 samples_per_chunk)),
+                chunk_count))
+        if len(chunk_samples) < chunk_count:
+            raise ValueError("sample to chunk table misses chunks")
+        self.chunk_first_samples = cumulative(chunk_samples)
+        if self.chunk_first_samples[-1] < self.sample_count:
+            raise ValueError(
+                "chunks hold {} of {} samples".format(
+                    self.chunk_first_samples[-1], self.sample_count))
+
+        # Decode time runs, extended past the table with the last delta.
+        counts, self.time_deltas = time_to_sample
+        if not len(counts):
+            counts, self.time_deltas = [self.sample_count], [0]
+            if numpy is not None:
+                self.time_deltas = numpy.zeros(1, dtype=numpy.int64)
+        if numpy is not None:
+            self.time_deltas = numpy.asarray(self.time_deltas,
+                                             dtype=numpy.int64)
+            self.run_first_times = cumulative(
+                numpy.asarray(counts, dtype=numpy.int64) * self.time_deltas)
+        else:
+            self.time_deltas = list(self.time_deltas)
+            self.run_first_times = cumulative(
+                count * delta for count, delta in
+                zip(counts, self.time_deltas))
+        self.run_first_samples = cumulative(counts)
+        self.duration = int(self.run_first_times[-1])
+
+        self.composition_offsets = None
+        self.composition_first_samples = None
+        if composition_offsets is not None and len(composition_offsets[0]):
+            counts, self.composition_offsets = composition_offsets
+            self.composition_first_samples = cumulative(counts)
+
+        self.sync_samples = None
+        if sync_samples is not None:
+            # Sample numbers of stss start at 1.
+            if numpy is not None:
+                self.sync_samples = numpy.sort(
+                    sync_samples[0].astype(numpy.int64) - 1)
+            else:
+                self.sync_samples = sorted(number - 1
+                                           for number in sync_samples[0])
+
+    def __len__(self):
+        return self.sample_count
+
+    def size(self, index):
+        """Returns the size of a sample in bytes."""
+        if self.sizes is None:
+            return self.sample_size
+        return int(self.sizes[index])
+
+    def offset(self, index):
+        """Returns the file position of a sample."""
+        chunk = search(self.chunk_first_samples, index)
+        first = int(self.chunk_first_samples[chunk])
+        if self.sizes is None:
+            preceding = (index - first) * self.sample_size
+        elif numpy is not None:
+            preceding = int(self.sizes[first:index].sum(dtype=numpy.uint64))
+        else:
+            preceding = sum(self.sizes[first:index])
+        return int(self.chunk_offsets[chunk]) + preceding
+
+    def decode_time(self, index):
+        """Returns the decode time of a sample."""
+        run = min(search(self.run_first_samples, index),
+                  len(self.time_deltas) - 1)
+        return int(self.run_first_times[run] +
+                   (index - self.run_first_samples[run]) *
+                   self.time_deltas[run])
+
+    def presentation_time(self, index):
+        """Returns the presentation time of a sample."""
+        return self.decode_time(index) + self.composition_offset(index)
+
+    def composition_offset(self, index):
+        if self.composition_offsets is None:
+            return 0
+        run = min(search(self.composition_first_samples, index),
+                  len(self.composition_offsets) - 1)
+        return int(self.composition_offsets[run])
+
+    def is_sync(self, index):
+        """Returns whether a sample is a sync sample, or keyframe."""
+        if self.sync_samples is None:
+            return True
+        position = search(self.sync_samples, index)
+        return position >= 0 and bool(self.sync_samples[position] == index)
+
+    def sample(self, index):
+        """Returns the Sample describing a sample.
+
+        Raises:
+          IndexError: there is no such sample.
+        """
+        if index < 0:
+            index += self.sample_count
+        if not 0 <= index < self.sample_count:
+            raise IndexError("sample {} out of range".format(index))
+        return Sample(index, self.offset(index), self.size(index),
+                      self.decode_time(index), self.presentation_time(index),
+                      self.is_sync(index))
+
+    def sample_at(self, time):
+        """Returns the index of the sample decoded at a time or None.
+
+        The sample decoded at time is the last one whose decode time is not
+        after time. Decoding a frame accurately starts at keyframe_before of
+        that sample.
+        """
+        if time < 0 or time >= self.duration or self.sample_count == 0:
+            return None
+        # Runs of zero duration samples share their first time with the
+        # following run, which is found instead.
+        run = search(self.run_first_times, time)
+        delta = self.time_deltas[run]
+        run_end = self.run_first_samples[run + 1]
+        index = int(self.run_first_samples[run] +
+                    (time - self.run_first_times[run]) // max(delta, 1))
+        return min(index, int(run_end) - 1, self.sample_count - 1)
+
+    def keyframe_before(self, index):
+        """Returns the index of the last sync sample at or before a sample.
+        """
+        if self.sync_samples is None:
+            return index
+        position = search(self.sync_samples, index)
+        if position < 0:
+            return None
+        return int(self.sync_samples[position])
+
+    def keyframe_after(self, index):
+        """Returns the index of the first sync sample at or after a sample.
+        """
+        if self.sync_samples is None:
+            return index
+        position = search(self.sync_samples, index - 1) + 1
+        if position >= len(self.sync_samples):
+            return None
+        return int(self.sync_samples[position])
+
+    def nearest_keyframe(self, index):
+        """Returns the index of the sync sample closest in time to a sample.
+        """
+        before = self.keyframe_before(index)
+        after = self.keyframe_after(index)
+        if before is None or after is None:
+            return after if before is None else before
+        time = self.decode_time(index)
+        if self.decode_time(after) - time < time - self.decode_time(before):
+            return after
+        return before
+
+    def samples(self, start=0, stop=None):
+        """Returns the Samples of consecutive samples.
+
+        Memory use is proportional to the number of samples requested, so
+        long tracks are best read a range at a time.
+
+        Args:
+          start: int, index of the first sample.
+          stop: int, index following the last sample, defaults to the end.
+        """
+        if stop is None or stop > self.sample_count:
+            stop = self.sample_count
+        start = max(0, min(start, stop))
+        if numpy is None:
+            return self.samples_without_numpy(start, stop)
+
+        indices = numpy.arange(start, stop, dtype=numpy.int64)
+        chunks = numpy.searchsorted(self.chunk_first_samples, indices,
+                                    "right") - 1
+        firsts = self.chunk_first_samples[chunks]
+        if self.sizes is None:
+            sizes = numpy.full(len(indices), self.sample_size,
+                               dtype=numpy.uint32)
+            preceding = (indices - firsts) * self.sample_size
+        else:
+            # Sums start at the first sample of the chunk holding start.
+            window_start = int(firsts[0]) if len(firsts) else start
+            sums = cumulative(self.sizes[window_start:stop])
+            sizes = self.sizes[start:stop]
+            preceding = (sums[indices - window_start] -
+                         sums[firsts - window_start])
+        offsets = self.chunk_offsets[chunks] + preceding.astype(numpy.uint64)
+
+        runs = numpy.minimum(
+            numpy.searchsorted(self.run_first_samples, indices, "right") - 1,
+            len(self.time_deltas) - 1)
+        decode_times = (self.run_first_times[runs] +
+                        (indices - self.run_first_samples[runs]) *
+                        self.time_deltas[runs])
+        presentation_times = decode_times
+        if self.composition_offsets is not None:
+            runs = numpy.minimum(
+                numpy.searchsorted(self.composition_first_samples, indices,
+                                   "right") - 1,
+                len(self.composition_offsets) - 1)
+            presentation_times = (decode_times +
+                                  self.composition_offsets[runs])
+        return Samples(offsets, sizes, decode_times, presentation_times)
+
+    def samples_without_numpy(self, start, stop):
+        samples = Samples(list(), list(), list(), list())
+        if start == stop:
+            return samples
+        chunk = search(self.chunk_first_samples, start)
+        offset = self.offset(start)
+        for index in range(start, stop):
+            while index >= self.chunk_first_samples[chunk + 1]:
+                chunk += 1
+                offset = self.chunk_offsets[chunk]
+            size = self.size(index)
+            decode_time = self.decode_time(index)
+            samples.offsets.append(offset)
+            samples.sizes.append(size)
+            samples.decode_times.append(decode_time)
+            samples.presentation_times.append(
+                decode_time + self.composition_offset(index))
+            offset += size
+        return samples
@@ -0,0 +1,416 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Declarative layouts of the fixed size fields of MPEG4 boxes.
+
+Each layout lists the fields of one version of a box and is compiled once
+into a struct.Struct, so the box contents are decoded with a single
+unpack_from into a record with named attributes. Fixed point fields are
+decoded to floats.
+"""
+
+import collections
+import struct
+
+from spatialmedia.mpeg import constants
+
+
+class Format(object):
+    """Field format whose values are converted when decoded and encoded."""
+
+    def __init__(self, format, decode, encode):
+        self.format = format
+        self.decode = decode
+        self.encode = encode
+
+
+def fixed(format, fraction_bits):
+    """Returns the format of a fixed point field decoded to a float."""
+    scale = float(1 << fraction_bits)
+    return Format(format, lambda value: value / scale,
+                  lambda value: int(round(value * scale)))
+
+
+FIXED_16_16 = fixed("i", 16)
+UFIXED_16_16 = fixed("I", 16)
+FIXED_8_8 = fixed("h", 8)
+UINT24 = Format("3s", lambda value: int.from_bytes(value, "big"),
+                lambda value: value.to_bytes(3, "big"))
+
+
+class Layout(object):
+    """Fields of a box version, compiled into a single struct.
+
+    Args:
+      record: namedtuple type of the decoded fields, defined at module level
+        so records can be pickled.
+      fields: list of (name, format), where format is a struct format
+        character, possibly with a count, or a Format. Fields named None are
+        padding. Fields with a count other than one, such as "9i", are
+        decoded as tuples.
+
+    Raises:
+      ValueError: the named fields differ from the fields of record.
+    """
+
+    def __init__(self, record, fields):
+        formats = list()
+        names = list()
+        # (field name, first value, value count, Format or None)
+        self.fields = list()
+        value_count = 0
+        for field_name, field_format in fields:
+            converter = None
+            if isinstance(field_format, Format):
+                converter = field_format
+                field_format = field_format.format
+            formats.append(field_format)
+            count = len(struct.Struct(">" + field_format).unpack(
+                bytes(struct.calcsize(">" + field_format))))
+            if field_name is not None:
+                names.append(field_name)
+                self.fields.append(
+                    (field_name, value_count, count, converter))
+            value_count += count
+
+        self.codec = struct.Struct(">" + "".join(formats))
+        self.size = self.codec.size
+        if tuple(names) != record._fields:
+            raise ValueError("fields of {} do not match its layout".format(
+                record.__name__))
+        self.record = record
+        # Layouts without conversions map values straight to fields.
+        self.direct = (value_count == len(names) and
+                       all(count == 1 and converter is None
+                           for _, _, count, converter in self.fields))
+
+    def decode(self, buf, offset=0):
+        """Returns the record decoded from buf at offset."""
+        values = self.codec.unpack_from(buf, offset)
+        if self.direct:
+            return self.record._make(values)
+
+        decoded = list()
+        for name, first, count, converter in self.fields:
+            if count == 1:
+                value = values[first]
+                if converter is not None:
+                    value = converter.decode(value)
+            else:
+                value = values[first:first + count]
+                if converter is not None:
+                    value = tuple(converter.decode(v) for v in value)
+            decoded.append(value)
+        return self.record._make(decoded)
+
+    def encode(self, record):
+        """Returns the bytes of a record, padding fields are zeroed."""
+        values = list()
+        for name, first, count, converter in self.fields:
+            value = getattr(record, name)
+            if count == 1:
+                value = [value]
+            if converter is not None:
+                value = [converter.encode(v) for v in value]
+            values.append((first, value))
+
+        packed = [0] * (max(first + len(value) for first, value in values)
+                        if values else 0)
+        for first, value in values:
+            packed[first:first + len(value)] = value
+        return self.codec.pack(*packed)
+
+
+class Schema(object):
+    """Layouts of the versions of a box.
+
+    Args:
+      layouts: dictionary, Layout of each version.
+      version_format: string, struct format of the version field.
+      version_offset: int, position of the version field in the contents.
+    """
+
+    def __init__(self, layouts, version_format=">B", version_offset=0):
+        self.layouts = layouts
+        self.version_codec = struct.Struct(version_format)
+        self.version_offset = version_offset
+        self.size = max(layout.size for layout in layouts.values())
+
+    def layout(self, buf, offset=0):
+        """Returns the Layout of the box contents at offset or None."""
+        if len(self.layouts) == 1:
+            return next(iter(self.layouts.values()))
+        if offset + self.version_offset + self.version_codec.size > len(buf):
+            return None
+        version = self.version_codec.unpack_from(
+            buf, offset + self.version_offset)[0]
+        return self.layouts.get(version)
+
+    def decode(self, buf, offset=0):
+        """Returns the record of the box contents at offset or None."""
+        layout = self.layout(buf, offset)
+        if layout is None or offset + layout.size > len(buf):
+            return None
+        return layout.decode(buf, offset)
+
+
+# Records of the decoded fields, named like the module attributes holding
+# them so they can be pickled.
+MovieHeader = collections.namedtuple(
+    "MovieHeader",
+    "version flags creation_time modification_time timescale duration rate "
+    "volume matrix next_track_id")
+TrackHeader = collections.namedtuple(
+    "TrackHeader",
+    "version flags creation_time modification_time track_id duration layer "
+    "alternate_group volume matrix width height")
+MediaHeader = collections.namedtuple(
+    "MediaHeader",
+    "version flags creation_time modification_time timescale duration "
+    "language")
+Handler = collections.namedtuple(
+    "Handler", "version flags component_type handler_type")
+VisualSampleEntry = collections.namedtuple(
+    "VisualSampleEntry",
+    "data_reference_index width height horizontal_resolution "
+    "vertical_resolution frame_count compressor_name depth")
+SoundSampleEntry = collections.namedtuple(
+    "SoundSampleEntry",
+    "data_reference_index version revision_level vendor channels "
+    "sample_size compression_id packet_size sample_rate")
+SoundSampleEntryV1 = collections.namedtuple(
+    "SoundSampleEntryV1",
+    SoundSampleEntry._fields + ("samples_per_packet", "bytes_per_packet",
+                                "bytes_per_frame", "bytes_per_sample"))
+SoundSampleEntryV2 = collections.namedtuple(
+    "SoundSampleEntryV2",
+    "data_reference_index version revision_level vendor struct_size "
+    "sample_rate channels bits_per_channel format_flags bytes_per_packet "
+    "frames_per_packet")
+SpatialAudio = collections.namedtuple(
+    "SpatialAudio",
+    "version ambisonic_type ambisonic_order ambisonic_channel_ordering "
+    "ambisonic_normalization num_channels")
+
+# Transformation matrix, 16.16 fixed point but for the 2.30 u, v and w.
+MATRIX = ("matrix", "9i")
+
+MOVIE_HEADER = Schema({
+    0: Layout(MovieHeader, [
+        ("version", "B"),
+        ("flags", UINT24),
+        ("creation_time", "I"),
+        ("modification_time", "I"),
+        ("timescale", "I"),
+        ("duration", "I"),
+        ("rate", FIXED_16_16),
+        ("volume", FIXED_8_8),
+        (None, "10x"),
+        MATRIX,
+        (None, "24x"),
+        ("next_track_id", "I"),
+    ]),
+    1: Layout(MovieHeader, [
+        ("version", "B"),
+        ("flags", UINT24),
+        ("creation_time", "Q"),
+        ("modification_time", "Q"),
+        ("timescale", "I"),
+        ("duration", "Q"),
+        ("rate", FIXED_16_16),
+        ("volume", FIXED_8_8),
+        (None, "10x"),
+        MATRIX,
+        (None, "24x"),
+        ("next_track_id", "I"),
+    ]),
+})
+
+TRACK_HEADER = Schema({
+    0: Layout(TrackHeader, [
+        ("version", "B"),
+        ("flags", UINT24),
+        ("creation_time", "I"),
+        ("modification_time", "I"),
+        ("track_id", "I"),
+        (None, "4x"),
+        ("duration", "I"),
+        (None, "8x"),
+        ("layer", "h"),
+        ("alternate_group", "h"),
+        ("volume", FIXED_8_8),
+        (None, "2x"),
+        MATRIX,
+        ("width", UFIXED_16_16),
+        ("height", UFIXED_16_16),
+    ]),
+    1: Layout(TrackHeader, [
+        ("version", "B"),
+        ("flags", UINT24),
+        ("creation_time", "Q"),
+        ("modification_time", "Q"),
+        ("track_id", "I"),
+        (None, "4x"),
+        ("duration", "Q"),
+        (None, "8x"),
+        ("layer", "h"),
+        ("alternate_group", "h"),
+        ("volume", FIXED_8_8),
+        (None, "2x"),
+        MATRIX,
+        ("width", UFIXED_16_16),
+        ("height", UFIXED_16_16),
+    ]),
+})
+
+MEDIA_HEADER = Schema({
+    0: Layout(MediaHeader, [
+        ("version", "B"),
+        ("flags", UINT24),
+        ("creation_time", "I"),
+        ("modification_time", "I"),
+        ("timescale", "I"),
+        ("duration", "I"),
+        ("language", "H"),
+        (None, "2x"),
+    ]),
+    1: Layout(MediaHeader, [
+        ("version", "B"),
+        ("flags", UINT24),
+        ("creation_time", "Q"),
+        ("modification_time", "Q"),
+        ("timescale", "I"),
+        ("duration", "Q"),
+        ("language", "H"),
+        (None, "2x"),
+    ]),
+})
+
+HANDLER = Schema({
+    0: Layout(Handler, [
+        ("version", "B"),
+        ("flags", UINT24),
+        # Component type in QuickTime files, 0 otherwise.
+        ("component_type", "4s"),
+        ("handler_type", "4s"),
+    ]),
+})
+
+SAMPLE_ENTRY = [
+    (None, "6x"),
+    ("data_reference_index", "H"),
+]
+
+VISUAL_SAMPLE_ENTRY = Schema({
+    0: Layout(VisualSampleEntry, SAMPLE_ENTRY + [
+        (None, "16x"),
+        ("width", "H"),
+        ("height", "H"),
+        ("horizontal_resolution", UFIXED_16_16),
+        ("vertical_resolution", UFIXED_16_16),
+        (None, "4x"),
+        ("frame_count", "H"),
+        ("compressor_name", "32p"),
+        ("depth", "H"),
+        (None, "2x"),
+    ]),
+})
+
+SOUND_SAMPLE_ENTRY_HEADER = SAMPLE_ENTRY + [
+    ("version", "h"),
+    ("revision_level", "h"),
+    ("vendor", "4s"),
+]
+
+SOUND_SAMPLE_ENTRY_V0 = SOUND_SAMPLE_ENTRY_HEADER + [
+    ("channels", "h"),
+    ("sample_size", "h"),
+    ("compression_id", "h"),
+    ("packet_size", "h"),
+    ("sample_rate", UFIXED_16_16),
+]
+
+SOUND_SAMPLE_ENTRY = Schema({
+    0: Layout(SoundSampleEntry, SOUND_SAMPLE_ENTRY_V0),
+    1: Layout(SoundSampleEntryV1, SOUND_SAMPLE_ENTRY_V0 + [
+        ("samples_per_packet", "I"),
+        ("bytes_per_packet", "I"),
+        ("bytes_per_frame", "I"),
+        ("bytes_per_sample", "I"),
+    ]),
+    2: Layout(SoundSampleEntryV2, SOUND_SAMPLE_ENTRY_HEADER + [
+        (None, "12x"),
+        ("struct_size", "I"),
+        ("sample_rate", "d"),
+        ("channels", "I"),
+        (None, "4x"),
+        ("bits_per_channel", "I"),
+        ("format_flags", "I"),
+        ("bytes_per_packet", "I"),
+        ("frames_per_packet", "I"),
+    ]),
+}, ">h", 8)
+
+SA3D = Schema({
+    0: Layout(SpatialAudio, [
+        ("version", "B"),
+        ("ambisonic_type", "B"),
+        ("ambisonic_order", "I"),
+        ("ambisonic_channel_ordering", "B"),
+        ("ambisonic_normalization", "B"),
+        ("num_channels", "I"),
+    ]),
+})
+
+SCHEMAS = {
+    constants.TAG_MVHD: MOVIE_HEADER,
+    constants.TAG_TKHD: TRACK_HEADER,
+    constants.TAG_MDHD: MEDIA_HEADER,
+    constants.TAG_HDLR: HANDLER,
+    constants.TAG_SA3D: SA3D,
+}
+for name in constants.VISUAL_SAMPLE_DESCRIPTIONS:
+    SCHEMAS[name] = VISUAL_SAMPLE_ENTRY
+for name in constants.SOUND_SAMPLE_DESCRIPTIONS:
+    SCHEMAS[name] = SOUND_SAMPLE_ENTRY
+
+
+def decode(name, buf, offset=0):
+    """Returns the record of the contents of a name box at offset or None."""
+    return SCHEMAS[name].decode(buf, offset)
+
+
+def read(element, fh):
+    """Reads and decodes the fixed size fields of a box.
+
+    Boxes of unknown versions or too short for their fields are not decoded.
+
+    Args:
+      element: box, box with a schema in SCHEMAS.
+      fh: file handle, source for uncached file contents.
+
+    Returns:
+      record of the box fields, or None.
+    """
+    schema = SCHEMAS[element.name]
+    size = min(schema.size, element.content_size)
+    if element.contents and not isinstance(element.contents, list):
+        contents = element.contents[:size]
+    else:
+        fh.seek(element.content_start())
+        contents = fh.read(size)
+    return schema.decode(contents)
@@ -0,0 +1,227 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG4 stream processing.
+
+Functions for loading MP4/MOV files from non seekable streams such as pipes.
+Boxes are read into a seekable spool file until the moov box has been
+loaded, after which the rest of the stream can be copied straight through.
+The spool file is bounded: a stream whose boxes up to moov do not fit is
+rejected.
+"""
+
+import struct
+
+from spatialmedia.mpeg import box
+from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import container
+from spatialmedia.mpeg import fragment
+from spatialmedia.mpeg import instrumentation
+from spatialmedia.mpeg import mpeg4_container
+from spatialmedia.mpeg import probe
+
+
+def read_exactly(stream, size):
+    """Reads size bytes from a stream, returning fewer only at its end."""
+    chunks = list()
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_header(stream):
+    """Reads a box header from a stream.
+
+    Returns:
+      (header, name, size, header_size) or None at the end of the stream.
+      size is None for a box extending to the end of the stream.
+    """
+    header = read_exactly(stream, 8)
+    if not header:
+        return None
+    if len(header) < 8:
+        print("Error, stream ends within a box header.")
+        return None
+
+    header_size = 8
+    size, name = struct.unpack(">I4s", header)
+    if size == 1:
+        header += read_exactly(stream, 8)
+        size = struct.unpack(">Q", header[8:16])[0]
+        header_size = 16
+    elif size == 0:
+        size = None
+    return header, name, size, header_size
+
+
+def spool_copy(in_stream, spool, size):
+    """Copies a block of data from a stream to a spool file.
+
+    The copy always goes through a single reused buffer, as asking a spooled
+    temporary file for its descriptor, as kernel copies do, writes it to
+    disk.
+
+    Args:
+      in_stream: file handle, input stream.
+      spool: file handle, seekable file for the loaded stream contents.
+      size: int, amount of data to copy.
+    """
+    instrumentation.add("bytes_copied", size)
+    block_size = min(size, box.COPY_BLOCK_SIZE)
+    view = memoryview(bytearray(block_size))
+    while size > 0:
+        count = in_stream.readinto(view[:min(size, block_size)])
+        if not count:
+            break
+        spool.write(view[:count])
+        size -= count
+
+
+def load(in_stream, spool, limit=None):
+    """Load the mpeg4 file structure of a stream up to its moov box.
+
+    Boxes are copied to spool, a seekable file receiving the stream
+    contents at their original positions. When moov precedes the media
+    data, reading stops after the header of the first mdat box, which is
+    loaded as a StreamedBox copying its contents from the stream once saved.
+
+    Args:
+      in_stream: file handle, input stream positioned at the file start.
+      spool: file handle, seekable file for the loaded stream contents.
+      limit: int or None, largest amount of data to copy to spool. Loading
+        fails before reading a box that would exceed it.
+
+    return:
+      mpeg4, the loaded mpeg4 structure.
+    """
+    contents = list()
+    position = 0
+    moov_loaded = False
+    while True:
+        header = read_header(in_stream)
+        if header is None:
+            break
+        header, name, size, header_size = header
+
+        if name == constants.TAG_MDAT and moov_loaded:
+            new_box = StreamedBox(in_stream, header)
+            new_box.name = name
+            new_box.position = position
+            new_box.header_size = header_size
+            if size is not None:
+                new_box.content_size = size - header_size
+            contents.append(new_box)
+            break
+
+        if size is None:
+            print("Error, no moov box before box extending to end of stream.")
+            return None
+        if limit is not None and position + size > limit:
+            print("Error, stream needs more than %d bytes of buffering to "
+                  "reach its moov box." % limit)
+            return None
+
+        spool.seek(position)
+        spool.write(header)
+        spool_copy(in_stream, spool, size - header_size)
+        if spool.tell() != position + size:
+            print("Error, stream ends within", name, "box.")
+            return None
+
+        new_box = container.load(spool, position, position + size)
+        if new_box is None:
+            return None
+        contents.append(new_box)
+        position += size
+
+        if name == constants.TAG_MOOV:
+            if any(element.name == constants.TAG_MDAT
+                   for element in contents):
+                break
+            moov_loaded = True
+
+    return mpeg4_container.from_contents(contents, spool)
+
+
+def copy_remaining(in_stream, out_stream, delta):
+    """Copies the boxes remaining in a stream after load.
+
+    Movie fragment offsets are updated as when saving a file.
+
+    Args:
+      in_stream: file handle, input stream positioned at a box header.
+      out_stream: file handle, destination for the copied boxes.
+      delta: int, change in position of the remaining boxes.
+    """
+    while True:
+        header = read_header(in_stream)
+        if header is None:
+            return
+        header, name, size, header_size = header
+
+        if (size is not None and delta != 0 and
+                name in (constants.TAG_MOOF, constants.TAG_MFRA)):
+            new_box = fragment.FragmentBox()
+            new_box.name = name
+            new_box.header_size = header_size
+            new_box.content_size = size - header_size
+            contents = read_exactly(in_stream, new_box.content_size)
+            new_box.save(probe.BufferFile(contents, header_size, None),
+                         out_stream, delta)
+            continue
+
+        out_stream.write(header)
+        if size is None:
+            copy_to_end(in_stream, out_stream)
+        else:
+            box.tag_copy(in_stream, out_stream, size - header_size)
+
+
+def copy_to_end(in_stream, out_stream):
+    """Copies a stream to its end."""
+    while True:
+        contents = in_stream.read(box.COPY_BLOCK_SIZE)
+        if not contents:
+            return
+        out_stream.write(contents)
+
+
+class StreamedBox(box.Box):
+    """Box whose contents are copied from the remainder of an input stream."""
+
+    def __init__(self, stream, header):
+        box.Box.__init__(self)
+        self.stream = stream
+        self.header = header
+
+    def save(self, in_fh, out_fh, delta):
+        """Saves the original box header followed by the streamed contents.
+
+        Args:
+          in_fh: file handle, unused as contents come from the stream.
+          out_fh: file handle, destination for written box contents.
+          delta: int, unused.
+        """
+        out_fh.write(self.header)
+        if struct.unpack(">I", self.header[:4])[0] == 0:
+            copy_to_end(self.stream, out_fh)
+        else:
+            box.tag_copy(self.stream, out_fh, self.content_size)
@@ -0,0 +1,408 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG spherical video V2 box processing classes.
+
+Enables the injection and parsing of the st3d and sv3d boxes of visual
+sample descriptions. The boxes conform to docs/spherical-video-v2-rfc.md.
+The leaf boxes are decoded when loaded with precompiled structs, so their
+metadata is available without further reads. sv3d and proj are loaded as
+containers.
+"""
+
+import struct
+import zlib
+
+from spatialmedia.mpeg import box
+from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import container
+from spatialmedia.mpeg import mesh
+
+STEREO_MODES = {
+    "none": 0,
+    "top-bottom": 1,
+    "left-right": 2,
+    "stereo-custom": 3,
+}
+
+PROJECTIONS = {
+    constants.TAG_EQUI: "equirectangular",
+    constants.TAG_CBMP: "cubemap",
+    constants.TAG_MSHP: "mesh",
+}
+
+DEFAULT_METADATA_SOURCE = "Spherical Metadata Tool"
+
+# Fixed point scale of the pose angles.
+POSE_SCALE = 1 << 16
+
+
+def load(fh, position, end):
+    """Loads the spherical video V2 box located at position in a mp4 file.
+
+    Args:
+      fh: file handle, input file handle.
+      position: int or None, current file position.
+      end: int, file position the box must not extend beyond.
+
+    Returns:
+      new_box: box, decoded box from the file location or None.
+    """
+    leaf = box.load(fh, position, end)
+    if leaf is None:
+        return None
+    fh.seek(leaf.content_start())
+    return from_box(leaf, fh.read(leaf.content_size))
+
+
+def load_buffer(buf, position, end, base=0):
+    """Loads the spherical video V2 box located at position in a buffer.
+
+    Args:
+      buf: buffer, file contents starting at file position base.
+      position: int, file position of the box.
+      end: int, file position the box must not extend beyond.
+      base: int, file position of the first byte in buf.
+
+    Returns:
+      new_box: box, decoded box from the buffer location or None.
+    """
+    leaf = box.load_buffer(buf, position, end, base)
+    if leaf is None:
+        return None
+    start = leaf.content_start() - base
+    return from_box(leaf, bytes(buf[start:start + leaf.content_size]))
+
+
+def from_box(leaf, contents):
+    """Decodes the contents of a loaded leaf box.
+
+    Boxes too short for their fields are left undecoded, as plain boxes.
+    """
+    box_class = BOX_CLASSES[leaf.name]
+    if len(contents) < box_class.codec.size:
+        return leaf
+
+    new_box = box_class()
+    new_box.name = leaf.name
+    new_box.position = leaf.position
+    new_box.header_size = leaf.header_size
+    new_box.content_size = leaf.content_size
+    # Contents are kept, including any bytes following the known fields.
+    new_box.contents = contents
+    new_box.decode(contents)
+    return new_box
+
+
+class FullBox(box.Box):
+    """Spherical video V2 full box with fixed size fields.
+
+    Subclasses name their fields, which follow the version and flags, and
+    the struct encoding them.
+    """
+
+    name_tag = None
+    fields = ()
+    codec = struct.Struct(">I")
+
+    def __init__(self):
+        box.Box.__init__(self)
+        self.name = self.name_tag
+        self.header_size = 8
+        self.version = 0
+        self.flags = 0
+
+    @classmethod
+    def create(cls, *values):
+        """Returns a new box holding the given field values."""
+        new_box = cls()
+        for field, value in zip(cls.fields, values):
+            setattr(new_box, field, value)
+        new_box.encode()
+        return new_box
+
+    def decode(self, contents):
+        values = self.codec.unpack_from(contents)
+        self.version = values[0] >> 24
+        self.flags = values[0] & 0xFFFFFF
+        for field, value in zip(self.fields, values[1:]):
+            setattr(self, field, value)
+
+    def encode(self):
+        """Sets the box contents from the field values."""
+        self.set(self.codec.pack(
+            (self.version << 24) | self.flags,
+            *[getattr(self, field) for field in self.fields]))
+
+    def metadata(self):
+        """Returns the (name, value) pairs describing the box."""
+        return []
+
+
+class ST3DBox(FullBox):
+    """Stereoscopic 3D video box."""
+
+    name_tag = constants.TAG_ST3D
+    fields = ("stereo_mode",)
+    codec = struct.Struct(">IB")
+
+    def __init__(self):
+        FullBox.__init__(self)
+        self.stereo_mode = 0
+
+    def stereo_mode_name(self):
+        for name, value in STEREO_MODES.items():
+            if value == self.stereo_mode:
+                return name
+        return "unknown (%d)" % self.stereo_mode
+
+    def metadata(self):
+        return [("StereoMode", self.stereo_mode_name())]
+
+
+class SVHDBox(FullBox):
+    """Spherical video header box."""
+
+    name_tag = constants.TAG_SVHD
+
+    def __init__(self):
+        FullBox.__init__(self)
+        self.metadata_source = ""
+
+    @classmethod
+    def create(cls, metadata_source):
+        new_box = cls()
+        new_box.metadata_source = metadata_source
+        new_box.encode()
+        return new_box
+
+    def decode(self, contents):
+        FullBox.decode(self, contents)
+        source = bytes(contents[self.codec.size:]).split(b"\0", 1)[0]
+        self.metadata_source = source.decode("utf-8", "replace")
+
+    def encode(self):
+        self.set(self.codec.pack((self.version << 24) | self.flags) +
+                 self.metadata_source.encode("utf-8") + b"\0")
+
+    def metadata(self):
+        return [("MetadataSource", self.metadata_source)]
+
+
+class PRHDBox(FullBox):
+    """Projection header box, holding the pose as 16.16 fixed point."""
+
+    name_tag = constants.TAG_PRHD
+    fields = ("pose_yaw", "pose_pitch", "pose_roll")
+    codec = struct.Struct(">Iiii")
+
+    def __init__(self):
+        FullBox.__init__(self)
+        self.pose_yaw = 0
+        self.pose_pitch = 0
+        self.pose_roll = 0
+
+    @classmethod
+    def create_degrees(cls, yaw, pitch, roll):
+        """Returns a new box with a pose given in degrees."""
+        return cls.create(int(round(yaw * POSE_SCALE)),
+                          int(round(pitch * POSE_SCALE)),
+                          int(round(roll * POSE_SCALE)))
+
+    def metadata(self):
+        return [("PoseYawDegrees", self.pose_yaw / float(POSE_SCALE)),
+                ("PosePitchDegrees", self.pose_pitch / float(POSE_SCALE)),
+                ("PoseRollDegrees", self.pose_roll / float(POSE_SCALE))]
+
+
+class EquiBox(FullBox):
+    """Equirectangular projection box, holding bounds as 0.32 fixed point."""
+
+    name_tag = constants.TAG_EQUI
+    fields = ("bounds_top", "bounds_bottom", "bounds_left", "bounds_right")
+    codec = struct.Struct(">IIIII")
+
+    def __init__(self):
+        FullBox.__init__(self)
+        self.bounds_top = 0
+        self.bounds_bottom = 0
+        self.bounds_left = 0
+        self.bounds_right = 0
+
+    def metadata(self):
+        return [("ProjectionType", "equirectangular"),
+                ("ProjectionBoundsTop", self.bounds_top),
+                ("ProjectionBoundsBottom", self.bounds_bottom),
+                ("ProjectionBoundsLeft", self.bounds_left),
+                ("ProjectionBoundsRight", self.bounds_right)]
+
+
+class CbmpBox(FullBox):
+    """Cubemap projection box."""
+
+    name_tag = constants.TAG_CBMP
+    fields = ("layout", "padding")
+    codec = struct.Struct(">III")
+
+    def __init__(self):
+        FullBox.__init__(self)
+        self.layout = 0
+        self.padding = 0
+
+    def metadata(self):
+        return [("ProjectionType", "cubemap"),
+                ("CubemapLayout", self.layout),
+                ("CubemapPadding", self.padding)]
+
+
+class MSHPBox(FullBox):
+    """Mesh projection box.
+
+    The meshes are decoded from the compressed payload on first use.
+    """
+
+    name_tag = constants.TAG_MSHP
+    fields = ("crc", "encoding")
+    codec = struct.Struct(">II4s")
+
+    def __init__(self):
+        FullBox.__init__(self)
+        self.crc = 0
+        self.encoding = mesh.ENCODING_DFL8
+        self.payload = b""
+        self.decoded_meshes = None
+
+    @classmethod
+    def create(cls, meshes, encoding=mesh.ENCODING_DFL8):
+        """Returns a new box holding meshes.
+
+        Args:
+          meshes: list of mesh.Mesh, a single mesh, or the left and right eye
+            meshes.
+          encoding: bytes, mesh.ENCODING_DFL8 or mesh.ENCODING_RAW.
+        """
+        new_box = cls()
+        new_box.encoding = encoding
+        new_box.payload = mesh.encode_meshes(meshes, encoding)
+        new_box.crc = mesh.crc(encoding, new_box.payload)
+        new_box.decoded_meshes = list(meshes)
+        new_box.encode()
+        return new_box
+
+    def decode(self, contents):
+        FullBox.decode(self, contents)
+        self.payload = contents[self.codec.size:]
+        self.decoded_meshes = None
+
+    def encode(self):
+        self.set(self.codec.pack((self.version << 24) | self.flags,
+                                 self.crc, self.encoding) + self.payload)
+
+    def meshes(self):
+        """Returns the list of mesh.Mesh of the box, or None if invalid."""
+        if self.decoded_meshes is None:
+            if mesh.crc(self.encoding, self.payload) != self.crc:
+                print("Error: mesh projection CRC mismatch.")
+                return None
+            try:
+                self.decoded_meshes = mesh.decode_meshes(
+                    self.payload, self.encoding)
+            except (ValueError, struct.error, zlib.error) as e:
+                print("Error: invalid mesh projection: {}".format(e))
+                return None
+        return self.decoded_meshes
+
+    def metadata(self):
+        metadata = [("ProjectionType", "mesh"),
+                    ("MeshEncoding", self.encoding.decode("latin1"))]
+        meshes = self.meshes()
+        if meshes is None:
+            return metadata
+        metadata.append(("MeshCount", len(meshes)))
+        for i, projection_mesh in enumerate(meshes):
+            metadata.append(("Mesh%dVertexCount" % i,
+                             projection_mesh.vertex_count()))
+            metadata.append(("Mesh%dIndexCount" % i,
+                             projection_mesh.index_count()))
+        return metadata
+
+
+BOX_CLASSES = {
+    constants.TAG_ST3D: ST3DBox,
+    constants.TAG_SVHD: SVHDBox,
+    constants.TAG_PRHD: PRHDBox,
+    constants.TAG_EQUI: EquiBox,
+    constants.TAG_CBMP: CbmpBox,
+    constants.TAG_MSHP: MSHPBox,
+}
+
+
+def new_container(name):
+    new_box = container.Container()
+    new_box.name = name
+    new_box.header_size = 8
+    return new_box
+
+
+def create_sv3d(projection_box, pose=(0, 0, 0),
+                metadata_source=DEFAULT_METADATA_SOURCE):
+    """Returns a sv3d box.
+
+    Args:
+      projection_box: box, projection data box such as an EquiBox.
+      pose: (yaw, pitch, roll), pose of the projection in degrees.
+      metadata_source: string, name of the tool writing the metadata.
+    """
+    proj = new_container(constants.TAG_PROJ)
+    proj.append(PRHDBox.create_degrees(*pose))
+    proj.append(projection_box)
+
+    sv3d = new_container(constants.TAG_SV3D)
+    sv3d.append(SVHDBox.create(metadata_source))
+    sv3d.append(proj)
+    return sv3d
+
+
+def spherical_metadata(sample_description):
+    """Returns the (name, value) pairs of the V2 boxes of a sample description.
+
+    Args:
+      sample_description: container, visual sample description.
+
+    Returns:
+      list of (name, value) pairs, empty without st3d and sv3d boxes.
+    """
+    metadata = list()
+    st3d = sample_description.first(constants.TAG_ST3D)
+    if isinstance(st3d, ST3DBox):
+        metadata.extend(st3d.metadata())
+
+    sv3d = sample_description.first(constants.TAG_SV3D)
+    if sv3d is None:
+        return metadata
+    svhd = sv3d.first(constants.TAG_SVHD)
+    if isinstance(svhd, SVHDBox):
+        metadata.extend(svhd.metadata())
+    proj = sv3d.first(constants.TAG_PROJ)
+    if proj is None:
+        return metadata
+    for element in proj.contents:
+        if isinstance(element, FullBox):
+            metadata.extend(element.metadata())
+        elif element.name in PROJECTIONS:
+            metadata.append(("ProjectionType", PROJECTIONS[element.name]))
+    return metadata
@@ -0,0 +1,316 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""MPEG4 track index.
+
+Describes every trak box of a moov box in a single pass: its handler type,
+sample descriptions, number of audio channels, uuid, SA3D and spherical
+video V2 boxes and the boxes on the way to its sample table. The few values
+stored in the file rather than in memory are read once while indexing. The
+track, media and sample entry headers are decoded with the layouts of the
+schema module when first requested.
+"""
+
+import struct
+
+from spatialmedia.mpeg import constants
+from spatialmedia.mpeg import container
+from spatialmedia.mpeg import sample_table
+from spatialmedia.mpeg import schema
+
+
+class Track(object):
+    """Index entry of a trak box.
+
+    Box attributes are None when the trak box does not contain them.
+    Functions adding or removing uuid, SA3D, st3d or sv3d boxes update the
+    matching lists so the index stays current, and Container.remove_all
+    drops removed boxes through Mpeg4Container.boxes_removed.
+    """
+
+    def __init__(self, trak):
+        self.trak = trak
+        self.tkhd = None
+        self.mdia = None
+        self.mdhd = None
+        self.hdlr = None
+        self.minf = None
+        self.stbl = None
+        self.stsd = None
+        self.chunk_offsets = None
+        self.handler_type = None
+        self.sample_descriptions = list()
+        self.sound_descriptions = list()
+        # Visual sample descriptions loaded as containers.
+        self.visual_descriptions = list()
+        self.num_audio_channels = -1
+        # (usertype, box) of every uuid box directly within trak.
+        self.uuids = list()
+        self.sa3d_boxes = list()
+        self.st3d_boxes = list()
+        self.sv3d_boxes = list()
+        # Decoded schema records, by box name.
+        self.records = dict()
+
+    def is_video(self):
+        return self.handler_type == constants.TRAK_TYPE_VIDE
+
+    def is_audio(self):
+        return self.handler_type == constants.TAG_SOUN
+
+    def record(self, element, fh):
+        """Returns the decoded schema record of a box of the track or None.
+        """
+        if element is None:
+            return None
+        if element.name not in self.records:
+            self.records[element.name] = schema.read(element, fh)
+        return self.records[element.name]
+
+    def header(self, fh):
+        """Returns the record of the tkhd box or None."""
+        return self.record(self.tkhd, fh)
+
+    def media_header(self, fh):
+        """Returns the record of the mdhd box or None."""
+        return self.record(self.mdhd, fh)
+
+    def sample_entry(self, fh):
+        """Returns the record of the first visual or sound sample description
+        or None.
+        """
+        for sample_description in self.sample_descriptions:
+            if sample_description.name in schema.SCHEMAS:
+                return self.record(sample_description, fh)
+        return None
+
+    def duration(self, fh):
+        """Returns the duration of the media in seconds or None."""
+        media_header = self.media_header(fh)
+        if media_header is None or not media_header.timescale:
+            return None
+        return media_header.duration / float(media_header.timescale)
+
+    def resolution(self, fh):
+        """Returns the (width, height) of a video track in pixels or None.
+
+        The coded size of the sample description is preferred over the
+        presentation size of the track header.
+        """
+        if not self.is_video():
+            return None
+        sample_entry = self.sample_entry(fh)
+        if sample_entry is not None and sample_entry.width:
+            return sample_entry.width, sample_entry.height
+        header = self.header(fh)
+        if header is not None and header.width:
+            return int(header.width), int(header.height)
+        return None
+
+    def sample_table(self, fh):
+        """Builds the sample_table.SampleTable of the track.
+
+        The table is not kept by the track, callers hold on to it.
+
+        Returns:
+          sample_table.SampleTable, or None without a valid sample table.
+        """
+        return sample_table.load(self, fh)
+
+    def drop_detached(self, root):
+        """Drops the sample descriptions, uuid, SA3D, st3d and sv3d boxes
+        no longer within root.
+        """
+        self.uuids = [(usertype, element) for usertype, element in self.uuids
+                      if attached(element, root)]
+        for name in ("sample_descriptions", "sound_descriptions",
+                     "visual_descriptions", "sa3d_boxes", "st3d_boxes",
+                     "sv3d_boxes"):
+            setattr(self, name, [element for element in getattr(self, name)
+                                 if attached(element, root)])
+
+    def usertype(self, element):
+        """Returns the usertype of a uuid box of the track or None."""
+        for usertype, uuid_box in self.uuids:
+            if uuid_box is element:
+                return usertype
+        return None
+
+
+def attached(element, root):
+    """Returns whether a box is within root, following its parents."""
+    while element is not None:
+        if element is root:
+            return True
+        element = element.parent
+    return False
+
+
+def read_contents(element, fh, offset, size):
+    """Reads size bytes at offset within the contents of a box."""
+    if element.contents:
+        return bytes(element.contents[offset:offset + size])
+    fh.seek(element.content_start() + offset)
+    return fh.read(size)
+
+
+def index_tracks(moov, fh):
+    """Indexes the trak boxes of a moov box.
+
+    Args:
+      moov: container, loaded moov box.
+      fh: file handle, source for uncached file contents.
+
+    Returns:
+      list of Track, in the order of the trak boxes.
+    """
+    return [index_track(trak, fh)
+            for trak in moov.children(constants.TAG_TRAK)]
+
+
+def index_track(trak, fh):
+    """Returns the Track describing a trak box."""
+    track = Track(trak)
+    for element in trak.children(constants.TAG_UUID):
+        track.uuids.append((read_contents(element, fh, 0, 16), element))
+
+    track.tkhd = trak.first(constants.TAG_TKHD)
+    track.mdia = trak.first(constants.TAG_MDIA)
+    if track.mdia is None:
+        return track
+    track.mdhd = track.mdia.first(constants.TAG_MDHD)
+    track.hdlr = track.mdia.first(constants.TAG_HDLR)
+    handler = track.record(track.hdlr, fh)
+    if handler is not None:
+        track.handler_type = handler.handler_type
+    track.minf = track.mdia.first(constants.TAG_MINF)
+    if track.minf is not None:
+        track.stbl = track.minf.first(constants.TAG_STBL)
+    if track.stbl is None:
+        return track
+    track.stsd = track.stbl.first(constants.TAG_STSD)
+    track.chunk_offsets = (track.stbl.first(constants.TAG_STCO) or
+                           track.stbl.first(constants.TAG_CO64))
+    if track.stsd is None:
+        return track
+
+    track.sample_descriptions = list(track.stsd.contents)
+    for sample_description in track.sample_descriptions:
+        if sample_description.name in constants.SOUND_SAMPLE_DESCRIPTIONS:
+            track.sound_descriptions.append(sample_description)
+            track.sa3d_boxes.extend(
+                sample_description.children(constants.TAG_SA3D))
+        elif (sample_description.name in
+              constants.VISUAL_SAMPLE_DESCRIPTIONS and
+              isinstance(sample_description, container.Container)):
+            track.visual_descriptions.append(sample_description)
+            track.st3d_boxes.extend(
+                sample_description.children(constants.TAG_ST3D))
+            track.sv3d_boxes.extend(
+                sample_description.children(constants.TAG_SV3D))
+    if track.sound_descriptions:
+        track.num_audio_channels = num_audio_channels(
+            track.sound_descriptions[0], fh)
+    return track
+
+
+def num_audio_channels(sample_description, fh):
+    """Reads the number of audio channels of a sound sample description."""
+    if sample_description.name == constants.TAG_MP4A:
+        return aac_num_channels(sample_description, fh)
+    return sample_description_num_channels(sample_description, fh)
+
+
+def sample_description_num_channels(sample_description, fh):
+    """Reads the number of audio channels from a sound sample description.
+    """
+    p = fh.tell()
+    sound_sample_entry = schema.read(sample_description, fh)
+    fh.seek(p)
+    if sound_sample_entry is None:
+        print("Unsupported version for " +
+              sample_description.name.decode("latin1") + " box")
+        return -1
+    return sound_sample_entry.channels
+
+
+def descriptor_length(fh):
+    """Derives the length of the MP4 elementary stream descriptor at the
+       current position in the input file.
+    """
+    length = 0
+    for i in range(4):
+        size_byte = struct.unpack(">c", fh.read(1))[0]
+        length = (length << 7 | ord(size_byte) & int("0x7f", 0))
+        if (ord(size_byte) != int("0x80", 0)):
+            break
+    return length
+
+
+def aac_num_channels(element, fh):
+    """Reads the number of audio channels from AAC's AudioSpecificConfig
+       descriptor within the esds child box of the input mp4a or wave box.
+    """
+    p = fh.tell()
+    if element.name not in [constants.TAG_MP4A, constants.TAG_WAVE]:
+        return -1
+
+    channel_configuration = -1
+    for sub_element in element.contents:
+        if sub_element.name == constants.TAG_WAVE:
+            # Handle .mov with AAC audio, where the structure is:
+            #     stsd -> mp4a -> wave -> esds
+            channel_configuration = aac_num_channels(sub_element, fh)
+            break
+
+        if sub_element.name != constants.TAG_ESDS:
+            continue
+        fh.seek(sub_element.content_start() + 4)
+        descriptor_tag = struct.unpack(">c", fh.read(1))[0]
+
+        # Verify the read descriptor is an elementary stream descriptor
+        if ord(descriptor_tag) != 3:  # Not an MP4 elementary stream.
+            print("Error: failed to read elementary stream descriptor.")
+            return -1
+        descriptor_length(fh)
+        fh.seek(3, 1)  # Seek to the decoder configuration descriptor
+        config_descriptor_tag = struct.unpack(">c", fh.read(1))[0]
+
+        # Verify the read descriptor is a decoder config. descriptor.
+        if ord(config_descriptor_tag) != 4:
+            print("Error: failed to read decoder config. descriptor.")
+            return -1
+        descriptor_length(fh)
+        fh.seek(13, 1) # offset to the decoder specific config descriptor.
+        decoder_specific_descriptor_tag = struct.unpack(">c", fh.read(1))[0]
+
+        # Verify the read descriptor is a decoder specific info descriptor
+        if ord(decoder_specific_descriptor_tag) != 5:
+            print("Error: failed to read MP4 audio decoder specific config.")
+            return -1
+        audio_specific_descriptor_size = descriptor_length(fh)
+        assert audio_specific_descriptor_size >= 2
+        decoder_descriptor = struct.unpack(">h", fh.read(2))[0]
+        sampling_frequency_index = (int("0780", 16) & decoder_descriptor) >> 7
+        if sampling_frequency_index == 0:
+            # TODO: If the sample rate is 96kHz an additional 24 bit offset
+            # value here specifies the actual sample rate.
+            print("Error: Greater than 48khz audio is currently not supported.")
+            return -1
+        channel_configuration = (int("0078", 16) & decoder_descriptor) >> 3
+    fh.seek(p)
+    return channel_configuration
@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the offsets of fragmented files updated when injecting."""
+
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from benchmarks import synthesize
+from spatialmedia import metadata_utils
+
+TRACK_ID = 1
+
+
+def sidx(version, first_offset):
+    if version == 1:
+        times = struct.pack(">QQ", 0, first_offset)
+    else:
+        times = struct.pack(">II", 0, first_offset)
+    return synthesize.full_box(
+        b"sidx", version, 0, struct.pack(">II", TRACK_ID, 1000) + times +
+        struct.pack(">HHIII", 0, 1, 64, 1000, 0))
+
+
+def moof(base_data_offset):
+    tfhd = synthesize.full_box(
+        b"tfhd", 0, 1, struct.pack(">IQ", TRACK_ID, base_data_offset))
+    trun = synthesize.full_box(b"trun", 0, 1, struct.pack(">Ii", 1, 0))
+    return synthesize.box(
+        b"moof", synthesize.full_box(b"mfhd", 0, 0, struct.pack(">I", 1)) +
+        synthesize.box(b"traf", tfhd + trun))
+
+
+def mfra(moof_offset):
+    tfra = synthesize.full_box(
+        b"tfra", 1, 0, struct.pack(">III", TRACK_ID, 0, 1) +
+        struct.pack(">QQBBB", 0, moof_offset, 1, 1, 1))
+    mfro = synthesize.full_box(b"mfro", 0, 0, struct.pack(">I", 16))
+    return synthesize.box(b"mfra", tfra + mfro)
+
+
+def write_fragmented(path, version):
+    """Writes ftyp, sidx, moov, sidx, moof, mdat and mfra boxes.
+
+    The sidx boxes surround moov, so the material indexed by the first one,
+    of the given version, moves relative to it when moov grows, but not for
+    the second one.
+    """
+    ftyp = synthesize.box(b"ftyp", b"isom\0\0\0\0isomiso6")
+    moov = synthesize.movie(0, 1, 0, 1, False, 64, "sowt", 0, 2)
+    payload = bytes(range(64))
+    sidx_size = len(sidx(version, 0))
+    moof_position = (len(ftyp) + sidx_size + len(moov) +
+                     len(sidx(1 - version, 0)))
+    mdat_position = moof_position + len(moof(0))
+    with open(path, "wb") as out_fh:
+        out_fh.write(ftyp)
+        out_fh.write(sidx(version, moof_position - len(ftyp) - sidx_size))
+        out_fh.write(moov)
+        out_fh.write(sidx(1 - version, 0))
+        out_fh.write(moof(mdat_position + 8))
+        out_fh.write(synthesize.box(b"mdat", payload))
+        out_fh.write(mfra(moof_position))
+
+
+def top_level_boxes(contents):
+    boxes = list()
+    position = 0
+    while position < len(contents):
+        size, name = struct.unpack_from(">I4s", contents, position)
+        boxes.append((name, position, contents[position + 8:position + size]))
+        position += size
+    return boxes
+
+
+class FragmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "input.mp4")
+        self.metadata = metadata_utils.Metadata()
+        self.assertTrue(metadata_utils.generate_metadata(
+            self.metadata, "top-bottom", None, "1", "equirectangular"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertOffsets(self, contents):
+        boxes = top_level_boxes(contents)
+        self.assertEqual([name for name, _, _ in boxes],
+                         [b"ftyp", b"sidx", b"moov", b"sidx", b"moof",
+                          b"mdat", b"mfra"])
+        positions = dict((name, position) for name, position, _ in boxes)
+        with open(self.path, "rb") as in_fh:
+            original = dict((name, position) for name, position, _ in
+                            top_level_boxes(in_fh.read()))
+        self.assertGreater(positions[b"moof"], original[b"moof"])
+
+        for name, position, box_contents in boxes:
+            if name == b"sidx":
+                if box_contents[0] == 1:
+                    first_offset = struct.unpack_from(">Q", box_contents, 20)[0]
+                else:
+                    first_offset = struct.unpack_from(">I", box_contents, 16)[0]
+                self.assertEqual(position + 8 + len(box_contents) +
+                                 first_offset, positions[b"moof"])
+            elif name == b"moof":
+                tfhd = box_contents.index(b"tfhd") + 4
+                base_data_offset = struct.unpack_from(
+                    ">Q", box_contents, tfhd + 8)[0]
+                self.assertEqual(base_data_offset, positions[b"mdat"] + 8)
+            elif name == b"mfra":
+                tfra = box_contents.index(b"tfra") + 4
+                moof_offset = struct.unpack_from(
+                    ">Q", box_contents, tfra + 24)[0]
+                self.assertEqual(moof_offset, positions[b"moof"])
+        self.assertEqual(dict((name, box_contents) for name, _, box_contents
+                              in boxes)[b"mdat"], bytes(range(64)))
+
+    def test_file_offsets_shift(self):
+        output_path = os.path.join(self.directory, "output.mp4")
+        for version in (0, 1):
+            write_fragmented(self.path, version)
+            metadata_utils.inject_mpeg4(self.path, output_path, self.metadata,
+                                        lambda *args: None)
+            with open(output_path, "rb") as output_fh:
+                self.assertOffsets(output_fh.read())
+
+    def test_stream_offsets_shift(self):
+        for version in (0, 1):
+            write_fragmented(self.path, version)
+            out_stream = io.BytesIO()
+            with open(self.path, "rb") as in_stream:
+                metadata_utils.inject_mpeg4_stream(
+                    in_stream, out_stream, self.metadata, lambda *args: None)
+            self.assertOffsets(out_stream.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of in place metadata injection."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from benchmarks import synthesize
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+
+
+def read_samples(path):
+    with open(path, "rb") as in_fh:
+        mpeg4_file = mpeg.load(in_fh)
+        return [(position, index, bytes(payload))
+                for position, (selected, index, pts, payload) in enumerate(
+                    mpeg4_file.read_samples(in_fh))]
+
+
+def top_level_boxes(path):
+    with open(path, "rb") as in_fh:
+        mpeg4_file = mpeg.load(in_fh)
+        return [(element.name, element.position)
+                for element in mpeg4_file.contents]
+
+
+class InPlaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "input.mp4")
+        self.messages = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def synthesize(self, moov_first):
+        synthesize.synthesize(self.path, chunks=50, mdat_size=256 * 1024,
+                              moov_first=moov_first, sparse=False)
+        self.samples = read_samples(self.path)
+        self.assertEqual(len(self.samples), 100)
+
+    def inject(self, path, in_place=True, padding=None):
+        metadata = metadata_utils.Metadata()
+        self.assertTrue(metadata_utils.generate_metadata(
+            metadata, "top-bottom", None, "1", "equirectangular"))
+        metadata_utils.inject_mpeg4(path, path + ".out", metadata,
+                                    self.messages.append, in_place,
+                                    padding=padding)
+
+    def assertInjected(self):
+        self.assertEqual(
+            [message for message in self.messages if "Error" in message], [])
+        parsed = metadata_utils.parse_metadata(self.path, lambda *args: None)
+        self.assertEqual(parsed.video["Track 0"]["StereoMode"], "top-bottom")
+        self.assertEqual(read_samples(self.path), self.samples)
+
+    def test_moov_first_with_free_box(self):
+        self.synthesize(moov_first=True)
+        self.inject(self.path, in_place=False, padding=4096)
+        os.rename(self.path + ".out", self.path)
+        size = os.path.getsize(self.path)
+
+        self.inject(self.path)
+        self.assertInjected()
+        self.assertEqual(os.path.getsize(self.path), size)
+        names = [name for name, position in top_level_boxes(self.path)]
+        self.assertEqual(names, [b"ftyp", b"moov", b"free", b"mdat"])
+
+    def test_moov_first_without_free_box(self):
+        self.synthesize(moov_first=True)
+        with open(self.path, "rb") as in_fh:
+            contents = in_fh.read()
+
+        self.inject(self.path)
+        self.assertIn("Error metadata could not be injected in place.",
+                      self.messages)
+        with open(self.path, "rb") as in_fh:
+            self.assertEqual(in_fh.read(), contents)
+
+    def test_tail_moov(self):
+        self.synthesize(moov_first=False)
+        boxes = top_level_boxes(self.path)
+
+        self.inject(self.path)
+        self.assertInjected()
+        self.assertEqual(top_level_boxes(self.path), boxes)
+
+    def test_relocation(self):
+        self.synthesize(moov_first=False)
+        with open(self.path, "ab") as out_fh:
+            out_fh.write(synthesize.box(b"skip", bytes(16)))
+        moov_position = dict(top_level_boxes(self.path))[b"moov"]
+        size = os.path.getsize(self.path)
+
+        self.inject(self.path)
+        self.assertInjected()
+        boxes = top_level_boxes(self.path)
+        self.assertEqual([name for name, position in boxes],
+                         [b"ftyp", b"mdat", b"free", b"skip", b"moov"])
+        self.assertEqual(dict(boxes)[b"free"], moov_position)
+        self.assertEqual(dict(boxes)[b"moov"], size)
+
+    def test_tail_moov_keeps_padding(self):
+        self.synthesize(moov_first=False)
+        self.inject(self.path, padding=600)
+        self.assertInjected()
+        size = os.path.getsize(self.path)
+
+        self.inject(self.path)
+        self.assertInjected()
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertIn("Free space after moov box: 600 bytes", self.messages)
+
+    def test_padding_in_front_of_media_data(self):
+        self.synthesize(moov_first=True)
+        self.inject(self.path, in_place=False, padding=4096)
+        os.rename(self.path + ".out", self.path)
+        with open(self.path, "rb") as in_fh:
+            contents = in_fh.read()
+
+        self.inject(self.path, padding=8192)
+        self.assertIn("Error metadata could not be injected in place.",
+                      self.messages)
+        with open(self.path, "rb") as in_fh:
+            self.assertEqual(in_fh.read(), contents)
+
+    def test_negative_padding(self):
+        self.synthesize(moov_first=False)
+        with open(self.path, "rb") as in_fh:
+            mpeg4_file = mpeg.load(in_fh)
+        self.assertFalse(mpeg4_file.set_padding(-16))
+        self.assertEqual(mpeg4_file.free_space(), 0)
+
+    def test_relocation_keeps_old_moov_until_synced(self):
+        self.synthesize(moov_first=False)
+        with open(self.path, "ab") as out_fh:
+            out_fh.write(synthesize.box(b"skip", bytes(16)))
+        moov_position = dict(top_level_boxes(self.path))[b"moov"]
+
+        with mock.patch.object(mpeg.mpeg4_container.os, "fsync",
+                               side_effect=OSError("no space left")):
+            with self.assertRaises(OSError):
+                self.inject(self.path)
+        boxes = top_level_boxes(self.path)
+        self.assertEqual([name for name, position in boxes][:4],
+                         [b"ftyp", b"mdat", b"moov", b"skip"])
+        self.assertEqual(boxes[2], (b"moov", moov_position))
+        self.assertEqual(read_samples(self.path), self.samples)
+
+
+if __name__ == "__main__":
+    unittest.main()
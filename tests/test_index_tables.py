@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of chunk offset tables crossing 4 GiB when injecting."""
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from benchmarks import synthesize
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+
+# Bytes of saved files kept in memory, covering every box before mdat.
+HEAD_SIZE = 16 * 1024 * 1024
+
+PADDING = 8 * 1024 * 1024
+
+
+class HeadFile(object):
+    """Output file handle keeping only the first HEAD_SIZE bytes written."""
+
+    def __init__(self):
+        self.head = bytearray()
+
+    def write(self, contents):
+        if len(self.head) < HEAD_SIZE:
+            self.head += contents[:HEAD_SIZE - len(self.head)]
+        return len(contents)
+
+
+def top_level_boxes(contents):
+    """Returns the (name, position, size) of boxes until the end of contents."""
+    boxes = list()
+    position = 0
+    while position + 8 <= len(contents):
+        size, name = struct.unpack_from(">I4s", contents, position)
+        if size == 1:
+            size = struct.unpack_from(">Q", contents, position + 8)[0]
+        boxes.append((name, position, size))
+        position += size
+    return boxes
+
+
+def index_tables(moov, name):
+    """Returns the entries of the stco or co64 boxes of a moov box."""
+    mode = ">I" if name == b"stco" else ">Q"
+    tables = list()
+    start = moov.find(name)
+    while start >= 0:
+        count = struct.unpack_from(">I", moov, start + 8)[0]
+        tables.append(list(struct.unpack_from(
+            ">%d%s" % (count, mode[1]), moov, start + 12)))
+        start = moov.find(name, start + 12 + count * struct.calcsize(mode))
+    return tables
+
+
+class IndexTablesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "input.mp4")
+        # A sparse file whose last chunks sit just under 4 GiB.
+        synthesize.synthesize(self.path, chunks=1000, co64=False,
+                              mdat_size=0xFFFFFFFF - 1024 * 1024,
+                              sparse=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stco_promoted_to_co64(self):
+        with open(self.path, "rb") as in_fh:
+            contents = in_fh.read(HEAD_SIZE)
+            boxes = top_level_boxes(contents)
+            self.assertEqual([name for name, _, _ in boxes],
+                             [b"ftyp", b"moov", b"mdat"])
+            _, moov_position, moov_size = boxes[1]
+            mdat_position = boxes[2][1]
+            stco_tables = index_tables(
+                contents[moov_position:moov_position + moov_size], b"stco")
+            self.assertEqual(len(stco_tables), 2)
+            self.assertTrue(all(max(table) + PADDING > 0xFFFFFFFF
+                                for table in stco_tables))
+
+            mpeg4_file = mpeg.load(in_fh)
+            metadata = metadata_utils.Metadata()
+            self.assertTrue(metadata_utils.generate_metadata(
+                metadata, "top-bottom", None, "1", "equirectangular"))
+            metadata_utils.mpeg4_add_metadata(mpeg4_file, in_fh, metadata,
+                                              lambda *args: None)
+            self.assertTrue(mpeg4_file.set_padding(PADDING))
+            out_fh = HeadFile()
+            mpeg4_file.save(in_fh, out_fh)
+
+        boxes = top_level_boxes(bytes(out_fh.head))
+        self.assertEqual([name for name, _, _ in boxes[:4]],
+                         [b"ftyp", b"moov", b"free", b"mdat"])
+        delta = boxes[3][1] - mdat_position
+        self.assertGreater(delta, PADDING)
+        _, moov_position, moov_size = boxes[1]
+        moov = bytes(out_fh.head[moov_position:moov_position + moov_size])
+        self.assertEqual(index_tables(moov, b"stco"), [])
+        self.assertEqual(index_tables(moov, b"co64"),
+                         [[offset + delta for offset in table]
+                          for table in stco_tables])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the asyncio API."""
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from benchmarks import synthesize
+from spatialmedia import metadata_async
+
+
+class MetadataAsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "input.mp4")
+        synthesize.synthesize(self.path, chunks=10, mdat_size=4096)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_default_injector_across_event_loops(self):
+        async def parse_all():
+            return await asyncio.gather(*[
+                metadata_async.parse_metadata(self.path)
+                for _ in range(3 * metadata_async.DEFAULT_CONCURRENCY)])
+
+        for _ in range(2):
+            parsed = asyncio.run(parse_all())
+            self.assertTrue(all(metadata.num_audio_channels == 4
+                                for metadata in parsed))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the cache of parsed files."""
+
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from benchmarks import synthesize
+from spatialmedia import metadata_cache
+from spatialmedia import metadata_utils
+
+
+def quiet_console(contents):
+    pass
+
+
+class MetadataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "input.mp4")
+        synthesize.synthesize(self.path, chunks=100, mdat_size=64 * 1024)
+        self.cache = metadata_cache.MetadataCache(
+            os.path.join(self.directory, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def parse(self, path):
+        return metadata_utils.parse_metadata(path, quiet_console,
+                                             cache=self.cache)
+
+    def test_second_parse_is_served_from_cache(self):
+        parsed = self.parse(self.path)
+        self.assertGreater(parsed.bytes_read, 0)
+        self.assertEqual(len(self.cache.entries()), 1)
+
+        cached = self.parse(self.path)
+        self.assertEqual(cached.bytes_read, 0)
+        self.assertEqual(cached.num_audio_channels, 4)
+        self.assertEqual((cached.width, cached.height), (1920, 1080))
+
+    def test_injection_invalidates_entry(self):
+        output_path = os.path.join(self.directory, "output.mp4")
+        shutil.copyfile(self.path, output_path)
+        self.parse(output_path)
+        entry = self.cache.lookup(output_path)
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry.metadata.video, dict())
+
+        metadata = metadata_utils.Metadata()
+        self.assertTrue(metadata_utils.generate_metadata(
+            metadata, "top-bottom", None, "1", "equirectangular"))
+        metadata_utils.inject_metadata(self.path, output_path, metadata,
+                                       quiet_console, cache=self.cache)
+        self.assertIsNone(self.cache.lookup(output_path))
+        self.assertEqual(self.cache.entries(), [])
+
+        self.parse(output_path)
+        entry = self.cache.lookup(output_path)
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry.metadata.video["Track 0"]["StereoMode"],
+                         "top-bottom")
+
+    def test_unpicklable_entry_raises(self):
+        with open(self.path, "rb") as in_fh:
+            stat_result = os.fstat(in_fh.fileno())
+            with self.assertRaises((pickle.PicklingError, TypeError)):
+                self.cache.store(stat_result, in_fh, None, [])
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_cache_failure_does_not_fail_parse(self):
+        messages = []
+        with mock.patch.object(self.cache, "store",
+                               side_effect=RecursionError("too deep")):
+            parsed = metadata_utils.parse_metadata(
+                self.path, messages.append, cache=self.cache)
+        self.assertEqual(parsed.num_audio_channels, 4)
+        self.assertEqual(
+            [message for message in messages if "cached" in message],
+            ["Warning parsed file could not be cached: too deep"])
+        self.assertEqual(self.cache.entries(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
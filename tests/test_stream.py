@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of injection into mpeg4 files read from streams."""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from benchmarks import synthesize
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+
+
+def quiet_console(contents):
+    pass
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "input.mp4")
+        synthesize.synthesize(self.path, chunks=100, mdat_size=2 * 1024 * 1024,
+                              moov_first=False, sparse=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def metadata(self):
+        metadata = metadata_utils.Metadata()
+        self.assertTrue(metadata_utils.generate_metadata(
+            metadata, "top-bottom", None, "1", "equirectangular"))
+        return metadata
+
+    def test_tail_moov_stays_in_memory(self):
+        with open(self.path, "rb") as in_stream:
+            with tempfile.SpooledTemporaryFile(
+                    max_size=metadata_utils.STREAM_SPOOL_SIZE) as spool:
+                mpeg4_file = mpeg.stream.load(in_stream, spool)
+                self.assertIsNotNone(mpeg4_file)
+                self.assertIsNotNone(mpeg4_file.moov_box)
+                self.assertFalse(spool._rolled)
+
+    def test_stream_matches_file_injection(self):
+        output_path = os.path.join(self.directory, "output.mp4")
+        metadata_utils.inject_mpeg4(self.path, output_path, self.metadata(),
+                                    quiet_console)
+        out_stream = io.BytesIO()
+        with open(self.path, "rb") as in_stream:
+            metadata_utils.inject_mpeg4_stream(
+                in_stream, out_stream, self.metadata(), quiet_console)
+        with open(output_path, "rb") as output_fh:
+            self.assertEqual(out_stream.getvalue(), output_fh.read())
+
+    def test_spool_limit(self):
+        messages = []
+        out_stream = io.BytesIO()
+        with open(self.path, "rb") as in_stream:
+            metadata_utils.inject_mpeg4_stream(
+                in_stream, out_stream, self.metadata(), messages.append,
+                spool_limit=1024 * 1024)
+        self.assertEqual(out_stream.getvalue(), b"")
+        self.assertEqual(messages, ["Error stream could not be loaded."])
+
+
+if __name__ == "__main__":
+    unittest.main()
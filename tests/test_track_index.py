@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the track index kept by mpeg4 files."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from benchmarks import synthesize
+from spatialmedia import metadata_utils
+from spatialmedia import mpeg
+
+
+def quiet_console(contents):
+    pass
+
+
+class TrackIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "input.mp4")
+        synthesize.synthesize(self.path, chunks=100, mdat_size=64 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def metadata(self):
+        metadata = metadata_utils.Metadata()
+        self.assertTrue(metadata_utils.generate_metadata(
+            metadata, "top-bottom", None, "both", "equirectangular"))
+        metadata.audio = metadata_utils.get_spatial_audio_metadata(1, False)
+        return metadata
+
+    def test_remove_all_updates_tracks(self):
+        with open(self.path, "rb") as in_fh:
+            mpeg4_file = mpeg.load(in_fh)
+            metadata_utils.mpeg4_add_metadata(
+                mpeg4_file, in_fh, self.metadata(), quiet_console)
+            video, audio = mpeg4_file.tracks
+            self.assertEqual(len(video.uuids), 1)
+            self.assertEqual(len(audio.sa3d_boxes), 1)
+
+            removed = mpeg4_file.moov_box.remove_all(
+                [b"uuid", b"SA3D", b"st3d", b"sv3d"])
+            self.assertEqual(len(removed.boxes), 4)
+            self.assertEqual(video.uuids, [])
+            self.assertEqual(video.st3d_boxes, [])
+            self.assertEqual(video.sv3d_boxes, [])
+            self.assertEqual(audio.sa3d_boxes, [])
+
+            metadata_utils.mpeg4_add_metadata(
+                mpeg4_file, in_fh, self.metadata(), quiet_console)
+            self.assertEqual(len(audio.sa3d_boxes), 1)
+            self.assertEqual(len(video.sv3d_boxes), 1)
+
+    def test_removed_trak_leaves_index(self):
+        with open(self.path, "rb") as in_fh:
+            mpeg4_file = mpeg.load(in_fh)
+            mpeg4_file.moov_box.remove_all(
+                lambda element: element is mpeg4_file.tracks[1].trak)
+            self.assertEqual(len(mpeg4_file.tracks), 1)
+            self.assertTrue(mpeg4_file.tracks[0].is_video())
+
+
+if __name__ == "__main__":
+    unittest.main()